@@ -0,0 +1,66 @@
+"""Add materialized timelines
+
+Revision ID: 04c8557d67f1
+Revises: 452b6570044e
+Create Date: 2026-10-18 11:40:12.402318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from app.config import settings
+
+
+# revision identifiers, used by Alembic.
+revision = '04c8557d67f1'
+down_revision = '452b6570044e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('Timelines',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('author_id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.TIMESTAMP(timezone=True), nullable=False),
+    sa.ForeignKeyConstraint(['author_id'], ['Users.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['post_id'], ['Posts.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['Users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id', 'post_id')
+    )
+    op.create_index('ix_Timelines_user_id_created_at', 'Timelines',
+                    ['user_id', 'created_at', 'post_id'], unique=False)
+    op.create_index('ix_Timelines_user_id_author_id', 'Timelines',
+                    ['user_id', 'author_id'], unique=False)
+
+    # Backfill timelines from the existing follow graph and own posts, with
+    # the newest posts of each user up to the timeline length and without
+    # the authors read at feed time, as the app keeps them
+    op.execute(sa.text("""
+        INSERT INTO "Timelines" (user_id, post_id, author_id, created_at)
+        SELECT user_id, post_id, author_id, created_at
+        FROM (SELECT entries.*,
+                     row_number() OVER (PARTITION BY user_id
+                                        ORDER BY created_at DESC, post_id DESC) AS position
+              FROM (SELECT p.author_id AS user_id, p.id AS post_id, p.author_id, p.created_at
+                    FROM "Posts" p
+                    WHERE p.author_id IS NOT NULL
+                    UNION
+                    SELECT uf.user_id, p.id, p.author_id, p.created_at
+                    FROM "Posts" p
+                    JOIN user_follow uf ON uf.following_id = p.author_id
+                    WHERE p.author_id NOT IN (SELECT following_id
+                                              FROM user_follow
+                                              GROUP BY following_id
+                                              HAVING count(*) > :fanout_limit)
+                    ) AS entries) AS ranked
+        WHERE position <= :max_length
+    """).bindparams(fanout_limit=settings.timeline_fanout_limit,
+                    max_length=settings.timeline_max_length))
+
+
+def downgrade() -> None:
+    op.drop_index('ix_Timelines_user_id_author_id', table_name='Timelines')
+    op.drop_index('ix_Timelines_user_id_created_at', table_name='Timelines')
+    op.drop_table('Timelines')
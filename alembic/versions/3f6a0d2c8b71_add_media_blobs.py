@@ -0,0 +1,28 @@
+"""Add media blob reference counts
+
+Revision ID: 3f6a0d2c8b71
+Revises: 928c661eff5e
+Create Date: 2026-10-18 13:02:47.218653
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f6a0d2c8b71'
+down_revision = '928c661eff5e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('MediaBlobs',
+                    sa.Column('url', sa.String(), nullable=False),
+                    sa.Column('ref_count', sa.Integer(),
+                              server_default='0', nullable=False),
+                    sa.PrimaryKeyConstraint('url'))
+
+
+def downgrade() -> None:
+    op.drop_table('MediaBlobs')
@@ -0,0 +1,37 @@
+"""Add user search document and indexes
+
+Revision ID: 5e2c7a9d41f8
+Revises: b7d41e9a5c03
+Create Date: 2026-10-18 14:06:33.871942
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '5e2c7a9d41f8'
+down_revision = 'b7d41e9a5c03'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('Users', sa.Column(
+        'search_vector', postgresql.TSVECTOR(),
+        sa.Computed("setweight(to_tsvector('simple', username), 'A') || "
+                    "setweight(to_tsvector('simple', fullname), 'B') || "
+                    "setweight(to_tsvector('simple', coalesce(description, '')), 'C')",
+                    persisted=True),
+        nullable=True))
+    op.create_index('ix_Users_search_vector', 'Users', ['search_vector'],
+                    unique=False, postgresql_using='gin')
+    op.create_index('ix_Users_username_prefix', 'Users',
+                    [sa.text('lower(username) COLLATE "C"'), 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_Users_username_prefix', table_name='Users')
+    op.drop_index('ix_Users_search_vector', table_name='Users')
+    op.drop_column('Users', 'search_vector')
@@ -0,0 +1,27 @@
+"""Add comment thread indexes
+
+Revision ID: 8c3f1e6b2a47
+Revises: 5e2c7a9d41f8
+Create Date: 2026-10-18 14:38:05.264119
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8c3f1e6b2a47'
+down_revision = '5e2c7a9d41f8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_Comments_post_id_created_at', 'Comments',
+                    ['post_id', 'created_at', 'id'], unique=False)
+    op.create_index('ix_Comments_parent_id_created_at', 'Comments',
+                    ['parent_id', 'created_at', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_Comments_parent_id_created_at', table_name='Comments')
+    op.drop_index('ix_Comments_post_id_created_at', table_name='Comments')
@@ -0,0 +1,41 @@
+"""Add denormalized post counters
+
+Revision ID: 91b2e29d1689
+Revises: 04c8557d67f1
+Create Date: 2026-10-18 12:02:47.118930
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '91b2e29d1689'
+down_revision = '04c8557d67f1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('Posts', sa.Column('like_count', sa.Integer(),
+                                     server_default='0', nullable=False))
+    op.add_column('Posts', sa.Column('comment_count', sa.Integer(),
+                                     server_default='0', nullable=False))
+
+    # Backfill counters from the existing likes and comments
+    op.execute("""
+        UPDATE "Posts" p
+        SET like_count = (SELECT count(*) FROM "Likes" l
+                          WHERE l.post_id = p.id),
+            comment_count = (SELECT count(*) FROM "Comments" c
+                             WHERE c.post_id = p.id)
+    """)
+
+    op.create_index('ix_Posts_like_count_id', 'Posts',
+                    ['like_count', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_Posts_like_count_id', table_name='Posts')
+    op.drop_column('Posts', 'comment_count')
+    op.drop_column('Posts', 'like_count')
@@ -0,0 +1,25 @@
+"""Add post processing status
+
+Revision ID: 928c661eff5e
+Revises: 91b2e29d1689
+Create Date: 2026-10-18 12:31:05.734109
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '928c661eff5e'
+down_revision = '91b2e29d1689'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('Posts', sa.Column('status', sa.String(),
+                                     server_default='ready', nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column('Posts', 'status')
@@ -0,0 +1,55 @@
+"""Add hot path indexes
+
+Revision ID: a6d9c2f47e18
+Revises: e41b9d7c3f25
+Create Date: 2026-10-18 16:12:37.904518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6d9c2f47e18'
+down_revision = 'e41b9d7c3f25'
+branch_labels = None
+depends_on = None
+
+
+# The tables are live and large, so the indexes are built without blocking
+# writes. CREATE INDEX CONCURRENTLY cannot run in a transaction, and one
+# that fails leaves an invalid index behind that has to be dropped before
+# running the migration again.
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index('ix_Posts_author_id_created_at', 'Posts',
+                        ['author_id', 'created_at', 'id'], unique=False,
+                        postgresql_concurrently=True)
+        op.create_index('ix_Posts_author_id_created_at_visible', 'Posts',
+                        ['author_id', 'created_at', 'id'], unique=False,
+                        postgresql_where=sa.text("published AND status = 'ready'"),
+                        postgresql_concurrently=True)
+        op.create_index('ix_Likes_post_id', 'Likes',
+                        ['post_id', 'user_id'], unique=False,
+                        postgresql_concurrently=True)
+        op.create_index('ix_Follow_Requests_receiver_id', 'Follow_Requests',
+                        ['receiver_id'], unique=False,
+                        postgresql_concurrently=True)
+        op.create_index('ix_Follow_Requests_sender_id_receiver_id', 'Follow_Requests',
+                        ['sender_id', 'receiver_id'], unique=False,
+                        postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_Follow_Requests_sender_id_receiver_id',
+                      table_name='Follow_Requests', postgresql_concurrently=True)
+        op.drop_index('ix_Follow_Requests_receiver_id',
+                      table_name='Follow_Requests', postgresql_concurrently=True)
+        op.drop_index('ix_Likes_post_id', table_name='Likes',
+                      postgresql_concurrently=True)
+        op.drop_index('ix_Posts_author_id_created_at_visible', table_name='Posts',
+                      postgresql_concurrently=True)
+        op.drop_index('ix_Posts_author_id_created_at', table_name='Posts',
+                      postgresql_concurrently=True)
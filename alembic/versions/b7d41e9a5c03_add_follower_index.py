@@ -0,0 +1,24 @@
+"""Add reverse index on follow edges
+
+Revision ID: b7d41e9a5c03
+Revises: 3f6a0d2c8b71
+Create Date: 2026-10-18 13:41:12.508236
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d41e9a5c03'
+down_revision = '3f6a0d2c8b71'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_user_follow_following_id', 'user_follow',
+                    ['following_id', 'user_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_user_follow_following_id', table_name='user_follow')
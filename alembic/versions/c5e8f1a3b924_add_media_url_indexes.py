@@ -0,0 +1,33 @@
+"""Add media url indexes
+
+Revision ID: c5e8f1a3b924
+Revises: a6d9c2f47e18
+Create Date: 2026-10-18 18:04:51.263117
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5e8f1a3b924'
+down_revision = 'a6d9c2f47e18'
+branch_labels = None
+depends_on = None
+
+
+# Built without blocking writes like the hot path indexes, see a6d9c2f47e18.
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index('ix_Posts_image_url', 'Posts', ['image_url'],
+                        unique=False, postgresql_concurrently=True)
+        op.create_index('ix_Users_profile_pic', 'Users', ['profile_pic'],
+                        unique=False, postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_Users_profile_pic', table_name='Users',
+                      postgresql_concurrently=True)
+        op.drop_index('ix_Posts_image_url', table_name='Posts',
+                      postgresql_concurrently=True)
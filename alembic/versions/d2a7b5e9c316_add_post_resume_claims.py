@@ -0,0 +1,25 @@
+"""Add post resume claims
+
+Revision ID: d2a7b5e9c316
+Revises: c5e8f1a3b924
+Create Date: 2026-10-18 18:41:09.716254
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2a7b5e9c316'
+down_revision = 'c5e8f1a3b924'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('Posts', sa.Column('resume_claimed_at',
+                                     sa.TIMESTAMP(timezone=True), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('Posts', 'resume_claimed_at')
@@ -0,0 +1,37 @@
+"""Add denormalized follow counters
+
+Revision ID: e41b9d7c3f25
+Revises: 8c3f1e6b2a47
+Create Date: 2026-10-18 15:04:51.630287
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e41b9d7c3f25'
+down_revision = '8c3f1e6b2a47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('Users', sa.Column('follower_count', sa.Integer(),
+                                     server_default='0', nullable=False))
+    op.add_column('Users', sa.Column('following_count', sa.Integer(),
+                                     server_default='0', nullable=False))
+
+    # Backfill counters from the existing follow edges
+    op.execute("""
+        UPDATE "Users" u
+        SET follower_count = (SELECT count(*) FROM user_follow f
+                              WHERE f.following_id = u.id),
+            following_count = (SELECT count(*) FROM user_follow f
+                               WHERE f.user_id = u.id)
+    """)
+
+
+def downgrade() -> None:
+    op.drop_column('Users', 'following_count')
+    op.drop_column('Users', 'follower_count')
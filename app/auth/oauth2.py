@@ -2,12 +2,15 @@
 
 # Imports
 
+import time
 from datetime import datetime, timedelta
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
 from jose import JWTError, jwt
 
+from app.cache import bus
+from app.cache.lru import LRUCache
 from app.schema import schemas
 from app.db import models
 from app.db.db_setup import get_db
@@ -34,9 +37,52 @@ def create_access_token(data: dict) -> str:
     return encoded_jwt
 
 
-def get_current_user(token: str = Depends(oauth2_scheme),
-                     db: Session = Depends(get_db)) -> any:
-    """ Verifies user using encoded JWT and returns user """
+# Authenticated principals
+#
+# Verified tokens are cached with a snapshot of their user, so handlers
+# that only need the user's id or username authenticate without touching
+# the database. Entries expire with their token or after
+# PRINCIPAL_CACHE_TTL_SECONDS and are dropped when the user is edited or
+# deleted.
+
+class Principal:
+    """ Lightweight snapshot of an authenticated user """
+
+    __slots__ = ("id", "username")
+
+    def __init__(self, user_id: int, username: str):
+        self.id = user_id
+        self.username = username
+
+
+_principals = LRUCache(maxsize=settings.principal_cache_size,
+                       ttl=settings.principal_cache_ttl_seconds)
+
+
+def _evict_users(user_ids: list) -> None:
+    """ Drops the cached principals of users """
+
+    user_ids = {int(user_id) for user_id in user_ids}
+    _principals.invalidate(lambda principal: principal.id in user_ids)
+
+
+def invalidate_user(user_id: int) -> None:
+    """ Drops the cached principals of a user after it changes, in every worker """
+
+    _evict_users([user_id])
+    bus.publish("principals", [user_id])
+
+
+bus.subscribe("principals", _evict_users, _principals.clear)
+
+
+def get_current_principal(token: str = Depends(oauth2_scheme),
+                          db: Session = Depends(get_db)) -> Principal:
+    """ Verifies user using encoded JWT and returns a snapshot of the user """
+
+    principal = _principals.get(token)
+    if principal is not None:
+        return principal
 
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -53,6 +99,26 @@ def get_current_user(token: str = Depends(oauth2_scheme),
     except JWTError as exc:
         raise credentials_exception from exc
 
-    user = db.query(models.User).filter(
+    version = _principals.version
+    user = db.query(models.User.id, models.User.username).filter(
         models.User.id == token_data.id).first()
+    if user is None:
+        raise credentials_exception
+
+    principal = Principal(user.id, user.username)
+    expires_in = payload["exp"] - time.time() if "exp" in payload else None
+    _principals.set(token, principal, ttl=expires_in, version=version)
+    return principal
+
+
+def get_current_user(principal: Principal = Depends(get_current_principal),
+                     db: Session = Depends(get_db)) -> any:
+    """ Returns the authenticated user, for handlers using its relationships """
+
+    user = db.query(models.User).filter(
+        models.User.id == principal.id).first()
+    if user is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="Could not validate credentials",
+                            headers={"WWW-Authenticate": "Bearer"})
     return user
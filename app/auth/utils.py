@@ -1,20 +1,84 @@
 """ Handles password hashing and verifying"""
 
 # Imports
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+from typing import Optional, Tuple
+from fastapi import HTTPException, status
 from passlib.context import CryptContext
 
+from app.config import settings
+from app.metrics import registry
+
 
 # Password context
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto",
+                           bcrypt__rounds=settings.bcrypt_rounds)
+
+
+# Hashing pool
+#
+# bcrypt is pure CPU work that releases the GIL, so it runs on its own
+# bounded pool instead of the shared request threadpool. Once every worker
+# is busy and the queue is full, requests fail fast with a 503.
+
+_hash_pool = ThreadPoolExecutor(max_workers=settings.password_hash_workers,
+                                thread_name_prefix="password-hash")
+_hash_slots = BoundedSemaphore(settings.password_hash_workers +
+                               settings.password_hash_queue_depth)
+
+HASH_SECONDS = registry.histogram(
+    "chitros_password_hash_duration_seconds",
+    "Time bcrypt took to hash or verify a password, without queueing",
+    ["operation"])
+
+
+def _timed(func, *args) -> any:
+    """ Runs a hashing function, recording how long it took """
+
+    started = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        HASH_SECONDS.labels(func.__name__).observe(time.perf_counter() - started)
+
+
+def _run_in_pool(func, *args) -> any:
+    """ Runs a hashing function on the hashing pool and waits for it """
+
+    if not _hash_slots.acquire(blocking=False):
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Server busy, try again",
+                            headers={"Retry-After": "1"})
+
+    try:
+        future = _hash_pool.submit(_timed, func, *args)
+    except RuntimeError:
+        _hash_slots.release()
+        raise
+
+    future.add_done_callback(lambda _: _hash_slots.release())
+    return future.result()
 
 
 # Creating and verifying hashed passwords
 
 def get_password(password) -> str:
     """  Hashes password string """
-    return pwd_context.hash(password)
+    return _run_in_pool(pwd_context.hash, password)
 
 
-def verify_password(input_password, hashed_password) -> str:
+def verify_password(input_password, hashed_password) -> bool:
     """ Verifies password """
-    return pwd_context.verify(input_password, hashed_password)
+    return _run_in_pool(pwd_context.verify, input_password, hashed_password)
+
+
+def verify_and_update_password(input_password,
+                               hashed_password) -> Tuple[bool, Optional[str]]:
+    """
+    Verifies password, also returning a new hash when the stored one was
+    made with a different cost factor than BCRYPT_ROUNDS
+    """
+    return _run_in_pool(pwd_context.verify_and_update,
+                        input_password, hashed_password)
@@ -0,0 +1,195 @@
+""" Module with the storage backends of the shared response cache """
+
+# Imports
+
+import socket
+from queue import Empty, Full, LifoQueue
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+from app.cache.lru import LRUCache
+
+
+# Backends
+#
+# Backends store bytes under string keys, each expiring after a ttl. They
+# only need to get, set and add (set unless present) many keys at once,
+# which every Redis compatible server supports in one round trip.
+
+class CacheBackend:
+    """ Interface of the response cache backends """
+
+    def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        """ Returns the value of each key, None for missing ones """
+        raise NotImplementedError
+
+    def set_many(self, items: Dict[str, bytes], ttl: float) -> None:
+        """ Stores values, replacing existing ones """
+        raise NotImplementedError
+
+    def add_many(self, items: Dict[str, bytes], ttl: float) -> None:
+        """ Stores values only under keys that are not set """
+        raise NotImplementedError
+
+
+class MemoryBackend(CacheBackend):
+    """ Backend keeping entries in this process, in a bounded LRU cache """
+
+    def __init__(self, maxsize: int, max_ttl: float):
+        self._entries = LRUCache(maxsize, max_ttl)
+
+    def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        return [self._entries.get(key) for key in keys]
+
+    def set_many(self, items: Dict[str, bytes], ttl: float) -> None:
+        for key, value in items.items():
+            self._entries.set(key, value, ttl)
+
+    def add_many(self, items: Dict[str, bytes], ttl: float) -> None:
+        for key, value in items.items():
+            self._entries.add(key, value, ttl)
+
+    def clear(self) -> None:
+        """ Drops every entry """
+        self._entries.clear()
+
+
+# Redis protocol
+
+class ProtocolError(Exception):
+    """ Raised on error replies and malformed responses """
+
+
+def encode_command(*parts: any) -> bytes:
+    """ Encodes a command as a RESP array of bulk strings """
+
+    encoded = [part if isinstance(part, bytes) else str(part).encode()
+               for part in parts]
+    return b"".join([b"*%d\r\n" % len(encoded),
+                     *(b"$%d\r\n%s\r\n" % (len(part), part) for part in encoded)])
+
+
+def read_reply(stream: any) -> any:
+    """ Reads one RESP reply """
+
+    line = stream.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("Connection closed")
+
+    kind, payload = line[:1], line[1:-2]
+    if kind == b"+":
+        return payload
+    if kind == b"-":
+        raise ProtocolError(payload.decode(errors="replace"))
+    if kind == b":":
+        return int(payload)
+    if kind == b"$":
+        length = int(payload)
+        if length < 0:
+            return None
+        data = stream.read(length + 2)
+        if len(data) != length + 2:
+            raise ConnectionError("Connection closed")
+        return data[:-2]
+    if kind == b"*":
+        length = int(payload)
+        return None if length < 0 else [read_reply(stream) for _ in range(length)]
+    raise ProtocolError(f"Unexpected reply {line!r}")
+
+
+class _Connection:
+    """ A socket to the server with a buffered reader """
+
+    def __init__(self, host: str, port: int, timeout: float):
+        self.socket = socket.create_connection((host, port), timeout=timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.stream = self.socket.makefile("rb")
+
+    def execute(self, commands: List[tuple]) -> list:
+        """ Pipelines commands, returning their replies in order """
+
+        self.socket.sendall(b"".join(encode_command(*command)
+                                     for command in commands))
+        replies, error = [], None
+        for _ in commands:
+            try:
+                replies.append(read_reply(self.stream))
+            except ProtocolError as exc:
+                # Keep reading so the connection stays in sync
+                error = error or exc
+        if error:
+            raise error
+        return replies
+
+    def close(self) -> None:
+        """ Closes the socket """
+
+        self.stream.close()
+        self.socket.close()
+
+
+class RedisBackend(CacheBackend):
+    """
+    Backend on any server speaking the Redis protocol, such as Redis,
+    Valkey or the stand-in of app.cache.standin. Connections are pooled
+    and every call is a single pipelined round trip.
+    """
+
+    def __init__(self, url: str, timeout: float, max_idle: int = 16):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.database = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self._idle: LifoQueue = LifoQueue(maxsize=max_idle)
+
+    def _connect(self) -> _Connection:
+        """ Opens and sets up a new connection """
+
+        connection = _Connection(self.host, self.port, self.timeout)
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.password))
+        if self.database:
+            setup.append(("SELECT", self.database))
+        if setup:
+            connection.execute(setup)
+        return connection
+
+    def _execute(self, commands: List[tuple]) -> list:
+        """ Runs commands on a pooled connection, dropping it on failure """
+
+        try:
+            connection = self._idle.get_nowait()
+        except Empty:
+            connection = self._connect()
+
+        try:
+            replies = connection.execute(commands)
+        except (OSError, ProtocolError):
+            connection.close()
+            raise
+
+        try:
+            self._idle.put_nowait(connection)
+        except Full:
+            connection.close()
+        return replies
+
+    def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        if not keys:
+            return []
+        return self._execute([("MGET", *keys)])[0]
+
+    def set_many(self, items: Dict[str, bytes], ttl: float) -> None:
+        if items:
+            milliseconds = int(ttl * 1000)
+            self._execute([("SET", key, value, "PX", milliseconds)
+                           for key, value in items.items()])
+
+    def add_many(self, items: Dict[str, bytes], ttl: float) -> None:
+        if items:
+            milliseconds = int(ttl * 1000)
+            self._execute([("SET", key, value, "PX", milliseconds, "NX")
+                           for key, value in items.items()])
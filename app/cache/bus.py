@@ -0,0 +1,266 @@
+"""
+Module broadcasting cache invalidations between workers over Postgres
+LISTEN/NOTIFY
+"""
+
+# Imports
+
+import logging
+import os
+import secrets
+import select
+import time
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, List, Optional, Tuple
+import orjson
+from sqlalchemy import create_engine, func
+from sqlalchemy.pool import NullPool
+
+from app.config import settings
+from app.db import pool
+from app.db.db_setup import engine
+
+
+# Bus settings
+
+ENABLED = settings.invalidation_bus
+HEARTBEAT_SECONDS = settings.invalidation_heartbeat_seconds
+RETRY_SECONDS = 1.0
+LISTEN_URL = settings.invalidation_bus_database_url
+CHANNEL = "cache_invalidation"
+MAX_PAYLOAD_BYTES = 7000
+
+logger = logging.getLogger(__name__)
+
+
+# Subscriptions
+#
+# Each in-process cache subscribes to a topic with an evict callback, given
+# the keys another worker invalidated, and a reset callback that drops
+# everything. Workers evict their own entries before publishing, so they
+# ignore their own messages.
+
+WORKER_ID = f"{os.getpid()}-{secrets.token_hex(4)}"
+
+_subscribers: Dict[str, Tuple[Callable[[List[str]], None], Callable[[], None]]] = {}
+
+
+def subscribe(topic: str, evict: Callable[[List[str]], None],
+              reset: Callable[[], None]) -> None:
+    """ Registers the callbacks of a cache """
+    _subscribers[topic] = (evict, reset)
+
+
+def _reset_all() -> None:
+    """ Drops every subscribed cache, as invalidations may have been missed """
+
+    for topic, (_, reset) in _subscribers.items():
+        try:
+            reset()
+        except Exception:
+            logger.exception("Resetting the %s cache failed", topic)
+
+    with _stats_lock:
+        _stats["resets"] += 1
+
+
+# Metrics
+
+_stats_lock = Lock()
+_stats = {"published": 0, "received": 0, "resets": 0,
+          "lag_count": 0, "lag_sum": 0.0, "lag_max": 0.0, "lag_last": 0.0}
+_listening = {"connected": False}
+
+
+def _record_lag(lag: float) -> None:
+    """ Records how long a message took from publishing to delivery """
+
+    with _stats_lock:
+        _stats["received"] += 1
+        _stats["lag_count"] += 1
+        _stats["lag_sum"] += lag
+        _stats["lag_max"] = max(_stats["lag_max"], lag)
+        _stats["lag_last"] = lag
+
+
+def stats() -> dict:
+    """ Returns the message counts and notification lag of this worker """
+
+    with _stats_lock:
+        count = _stats["lag_count"]
+        return {"enabled": ENABLED,
+                "connected": _listening["connected"],
+                "published": _stats["published"],
+                "received": _stats["received"],
+                "resets": _stats["resets"],
+                "lag_seconds": {"last": _stats["lag_last"],
+                                "max": _stats["lag_max"],
+                                "avg": _stats["lag_sum"] / count if count else 0.0}}
+
+
+# Publishing
+
+def _messages(topic: str, keys: List[str]) -> List[str]:
+    """ Encodes keys into messages that fit in a notification payload """
+
+    messages, chunk, size = [], [], 0
+    for key in keys:
+        if chunk and size + len(key) + 3 > MAX_PAYLOAD_BYTES:
+            messages.append(chunk)
+            chunk, size = [], 0
+        chunk.append(key)
+        size += len(key) + 3
+    if chunk:
+        messages.append(chunk)
+
+    sent_at = time.time()
+    return [orjson.dumps({"worker": WORKER_ID, "sent_at": sent_at,
+                          "topic": topic, "keys": chunk}).decode()
+            for chunk in messages]
+
+
+def publish(topic: str, keys: List[any]) -> None:
+    """
+    Tells the other workers to evict keys from a cache. Call once the write
+    committed and the keys were evicted locally.
+    """
+
+    if not ENABLED or not keys:
+        return
+
+    try:
+        with engine.begin() as connection:
+            for message in _messages(topic, [str(key) for key in keys]):
+                connection.execute(func.pg_notify(CHANNEL, message).select())
+    except Exception:
+        # Other workers reset their caches if they missed messages, but a
+        # message never sent is only covered by the caches' ttl
+        logger.exception("Publishing %s invalidations failed", topic)
+        return
+
+    with _stats_lock:
+        _stats["published"] += 1
+
+
+# Listening
+#
+# Each worker keeps one connection listening on the channel. Staleness is
+# bounded: the listener pings itself through the channel every heartbeat,
+# and when the connection fails or a ping is not back within two heartbeats
+# it resets every cache, then keeps resetting them every RETRY_SECONDS until
+# it listens again. So another worker's write shows here after the
+# notification lag, or at worst within two heartbeats.
+#
+# Listening needs a session of its own, which PgBouncer's transaction
+# pooling does not give, so behind it the listener connects to Postgres
+# directly at LISTEN_URL. Publishing works through either.
+
+if ENABLED and pool.PGBOUNCER and not LISTEN_URL:
+    raise ValueError("The invalidation bus cannot listen through PgBouncer, "
+                     "set INVALIDATION_BUS_DATABASE_URL to reach Postgres directly")
+
+_listen_engine = create_engine(LISTEN_URL, poolclass=NullPool) if LISTEN_URL else engine
+_stop = Event()
+_listener: Optional[Thread] = None
+
+
+def _connect() -> any:
+    """ Opens a connection outside the pool and starts listening """
+
+    pooled = _listen_engine.raw_connection()
+    pooled.detach()
+    connection = pooled.connection
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute(f"LISTEN {CHANNEL}")
+    return connection
+
+
+def _ping(connection: any) -> None:
+    """ Sends a message back to this worker through the channel """
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_notify(%s, %s)",
+                       (CHANNEL, orjson.dumps({"worker": WORKER_ID,
+                                               "sent_at": time.time(),
+                                               "topic": "ping",
+                                               "keys": []}).decode()))
+
+
+def _deliver(payload: str) -> bool:
+    """ Applies a message, returning whether it was this worker's ping """
+
+    message = orjson.loads(payload)
+    _record_lag(max(time.time() - message["sent_at"], 0.0))
+    if message["worker"] == WORKER_ID:
+        return message["topic"] == "ping"
+
+    subscriber = _subscribers.get(message["topic"])
+    if subscriber is not None:
+        evict, _ = subscriber
+        evict(message["keys"])
+    return False
+
+
+def _listen_once() -> None:
+    """ Listens until the connection fails or the bus stops """
+
+    connection = _connect()
+    try:
+        # Anything cached before listening may have missed invalidations
+        _reset_all()
+        _listening["connected"] = True
+
+        pinged_at = pong_at = time.monotonic()
+        _ping(connection)
+        while not _stop.is_set():
+            # Pings come back with their own query's result
+            if not connection.notifies:
+                select.select([connection], [], [], HEARTBEAT_SECONDS / 2)
+                connection.poll()
+            while connection.notifies:
+                if _deliver(connection.notifies.pop(0).payload):
+                    pong_at = time.monotonic()
+
+            now = time.monotonic()
+            if now - pong_at > 2 * HEARTBEAT_SECONDS:
+                raise ConnectionError("Invalidation heartbeat lost")
+            if now - pinged_at >= HEARTBEAT_SECONDS:
+                _ping(connection)
+                pinged_at = now
+    finally:
+        _listening["connected"] = False
+        connection.close()
+
+
+def _listen() -> None:
+    """ Listener thread loop """
+
+    while not _stop.is_set():
+        try:
+            _listen_once()
+        except Exception:
+            logger.exception("Invalidation listener failed, reconnecting")
+            _reset_all()
+            _stop.wait(RETRY_SECONDS)
+
+
+def start() -> None:
+    """ Starts listening when the bus is enabled """
+
+    global _listener
+    if ENABLED and _listener is None:
+        _stop.clear()
+        _listener = Thread(target=_listen, name="invalidation-listener",
+                           daemon=True)
+        _listener.start()
+
+
+def stop() -> None:
+    """ Stops listening """
+
+    global _listener
+    if _listener is not None:
+        _stop.set()
+        _listener.join()
+        _listener = None
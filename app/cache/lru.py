@@ -0,0 +1,99 @@
+""" Module with a size bounded, expiring, least recently used in-process cache """
+
+# Imports
+
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, Hashable, Optional
+
+
+# Cache
+
+class LRUCache:
+    """
+    Thread safe cache holding at most maxsize entries, each expiring ttl
+    seconds after it was stored. The least recently used entry is evicted
+    when the cache is full.
+
+    Invalidating bumps the cache's version. A value computed before an
+    invalidation is not stored if set is passed the version read before
+    computing it, so a slow reader cannot put stale data back.
+    """
+
+    _missing = object()
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version = 0
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: any = None) -> any:
+        """ Returns a live entry, marking it as recently used """
+
+        with self._lock:
+            value, expires_at = self._entries.get(key, (self._missing, 0.0))
+            if value is self._missing:
+                return default
+
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: any, ttl: Optional[float] = None,
+            version: Optional[int] = None) -> None:
+        """
+        Stores an entry, expiring after ttl seconds or the cache's ttl if
+        sooner. Skipped if the cache was invalidated since version.
+        """
+
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def add(self, key: Hashable, value: any, ttl: Optional[float] = None) -> bool:
+        """ Stores an entry unless a live one exists, returning whether it did """
+
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self._lock:
+            _, expires_at = self._entries.get(key, (None, 0.0))
+            if expires_at > time.monotonic():
+                return False
+
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            return True
+
+    def invalidate(self, predicate: Callable[[any], bool]) -> int:
+        """ Drops the entries whose value matches predicate, returning how many """
+
+        with self._lock:
+            self.version += 1
+            keys = [key for key, (value, _) in self._entries.items()
+                    if predicate(value)]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def clear(self) -> None:
+        """ Drops every entry """
+
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
@@ -0,0 +1,352 @@
+""" Module caching rendered post bodies, profile cards and feed pages """
+
+# Imports
+
+import logging
+import secrets
+import time
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Tuple
+import orjson
+from fastapi import Response
+from sqlalchemy.orm import Session
+
+from app.cache import bus
+from app.cache.backends import (CacheBackend, MemoryBackend, ProtocolError,
+                                RedisBackend)
+from app.config import settings
+from app.db import comments, loaders, models, replicas
+from app.schema import serializers
+
+
+# Response cache settings
+
+BACKEND = settings.cache_backend
+POST_TTL = settings.cache_post_ttl_seconds
+PROFILE_TTL = settings.cache_profile_ttl_seconds
+FEED_TTL = settings.cache_feed_ttl_seconds
+GENERATION_TTL = 24 * 3600
+RETRY_SECONDS = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+def _create_backend() -> Optional[CacheBackend]:
+    """ Returns the configured backend, None when caching is off """
+
+    if BACKEND == "memory":
+        return MemoryBackend(settings.cache_memory_entries, GENERATION_TTL)
+    if BACKEND == "redis":
+        return RedisBackend(settings.cache_url, settings.cache_timeout_seconds)
+    if BACKEND != "none":
+        raise ValueError(f"Unknown cache backend {BACKEND!r}, "
+                         f"expected none, memory or redis")
+    return None
+
+
+backend = _create_backend()
+ENABLED = backend is not None
+
+
+# Hit rates
+#
+# Counted per process, since each worker has its own view of the backend.
+
+_stats_lock = Lock()
+_stats = {"post": [0, 0], "profile": [0, 0], "feed": [0, 0]}
+_errors = 0
+
+
+def _count(kind: str, hits: int, misses: int) -> None:
+    """ Records lookups of one kind of entry """
+
+    with _stats_lock:
+        _stats[kind][0] += hits
+        _stats[kind][1] += misses
+
+
+def stats() -> dict:
+    """ Returns the hits, misses and hit rate of each kind of entry """
+
+    with _stats_lock:
+        kinds = {kind: {"hits": hits, "misses": misses,
+                        "hit_rate": hits / (hits + misses) if hits + misses else 0.0}
+                 for kind, (hits, misses) in _stats.items()}
+        return {"backend": BACKEND, **kinds, "errors": _errors}
+
+
+# Backend calls
+#
+# The cache is never the source of truth, so a backend that is down or slow
+# only costs the lookups: failures are logged and treated as misses, and the
+# backend is left alone for RETRY_SECONDS before it is tried again.
+
+_retry_at = 0.0
+
+
+def _failed(exc: Exception) -> None:
+    """ Logs and counts a backend failure, pausing the cache """
+
+    global _errors, _retry_at
+    with _stats_lock:
+        _errors += 1
+    _retry_at = time.monotonic() + RETRY_SECONDS
+    logger.warning("Response cache unavailable: %s", exc)
+
+
+def _available() -> bool:
+    return time.monotonic() >= _retry_at
+
+
+def _get_many(keys: List[str]) -> List[Optional[bytes]]:
+    if _available():
+        try:
+            return backend.get_many(keys)
+        except (OSError, ProtocolError) as exc:
+            _failed(exc)
+    return [None] * len(keys)
+
+
+def _set_many(items: Dict[str, bytes], ttl: float) -> None:
+    if _available():
+        try:
+            backend.set_many(items, ttl)
+        except (OSError, ProtocolError) as exc:
+            _failed(exc)
+
+
+def _add_many(items: Dict[str, bytes], ttl: float) -> None:
+    if _available():
+        try:
+            backend.add_many(items, ttl)
+        except (OSError, ProtocolError) as exc:
+            _failed(exc)
+
+
+# Invalidation
+#
+# Every entry belongs to a tag, such as one post or one user, and its key
+# embeds the tag's current generation, a random token stored under the tag.
+# Writes publish an invalidation event by replacing the token, which orphans
+# every entry of the tag at once, in every process sharing the backend, and
+# orphaned entries age out by their ttl. Events are published after the
+# write commits, so a reader rendering a stale row around the commit stores
+# it under the old generation, where nobody looks again.
+#
+# A tag without a generation gets one, but the lookup that created it does
+# not store its entry, since a concurrent event may have been lost to the
+# same expiry or eviction.
+#
+# Generations carry the time they were issued. Entries rendered from a read
+# replica are only stored once their generation is older than the replica
+# may lag, otherwise the replica could still show the write that replaced
+# it and the stale render would be stored under the new generation.
+
+def post_tag(post_id: int) -> str:
+    """ Tag of a post's body, covering its likes and top comments """
+    return f"post:{post_id}"
+
+
+def user_tag(username: str) -> str:
+    """ Tag of a user's profile card """
+    return f"user:{username}"
+
+
+def feed_tag(user_id: int) -> str:
+    """
+    Tag of a user's feed pages. New posts of the people a user follows reach
+    the cached pages within FEED_TTL, their own actions invalidate them.
+    """
+    return f"feed:{user_id}"
+
+
+def _new_generation() -> bytes:
+    return f"{time.time():.3f}-{secrets.token_hex(6)}".encode()
+
+
+def _storable(token: Optional[str], staleness: float) -> bool:
+    """ Tells whether an entry rendered under a generation may be stored """
+
+    if token is None:
+        return False
+    issued_at, _, _ = token.partition("-")
+    try:
+        return time.time() - float(issued_at) > staleness
+    except ValueError:
+        return True
+
+
+def _generations(tags: List[str]) -> List[Optional[str]]:
+    """ Returns the current generation of each tag, None for new tags """
+
+    tokens = _get_many([f"gen:{tag}" for tag in tags])
+    missing = {f"gen:{tag}": _new_generation()
+               for tag, token in zip(tags, tokens) if token is None}
+    if missing:
+        _add_many(missing, GENERATION_TTL)
+    return [token.decode() if token is not None else None for token in tokens]
+
+
+def _bump(tags: List[str]) -> None:
+    """ Replaces the generations of tags """
+    _set_many({f"gen:{tag}": _new_generation() for tag in tags}, GENERATION_TTL)
+
+
+def invalidate(*tags: str) -> None:
+    """ Publishes invalidation events for tags, call once the write committed """
+
+    if ENABLED and tags:
+        tags = list(set(tags))
+        _bump(tags)
+        # Memory backends are per worker, the others hear of it on the bus
+        if BACKEND == "memory":
+            bus.publish("responses", tags)
+
+
+def invalidate_user(db: Session, user_id: int, username: str) -> None:
+    """
+    Publishes invalidation events for a user's profile card and the posts
+    they wrote, which embed their name and picture
+    """
+
+    if ENABLED:
+        post_ids = db.query(models.Post.id).\
+            filter(models.Post.author_id == user_id).all()
+        invalidate(user_tag(username),
+                   *(post_tag(post_id) for (post_id,) in post_ids))
+
+
+if BACKEND == "memory":
+    bus.subscribe("responses", _bump, backend.clear)
+
+
+# Post bodies
+
+def _render_posts(db: Session, post_ids: List[int]) -> Dict[int, bytes]:
+    """ Loads and encodes ready posts like the post routes do """
+
+    posts = db.query(models.Post).\
+        options(*loaders.post_response()).\
+        filter(models.Post.id.in_(post_ids),
+               models.Post.status == models.PostStatus.READY).all()
+    comments.attach_previews(db, posts)
+    return {post.id: serializers.encode(serializers.post(post)) for post in posts}
+
+
+def post_bodies(db: Session, post_ids: List[int]) -> List[bytes]:
+    """
+    Returns the encoded schemas.PostResponse of each post in order, rendering
+    and storing the ones not cached. Posts that are gone are left out.
+    """
+
+    if not post_ids:
+        return []
+
+    tokens = _generations([post_tag(post_id) for post_id in post_ids])
+    keys = [f"body:{post_id}:{token}" if token else None
+            for post_id, token in zip(post_ids, tokens)]
+    cached_keys = [key for key in keys if key]
+    cached = dict(zip(cached_keys, _get_many(cached_keys)))
+
+    bodies = {post_id: cached[key] for post_id, key in zip(post_ids, keys)
+              if key and cached[key] is not None}
+    missing = [post_id for post_id in post_ids if post_id not in bodies]
+    _count("post", len(bodies), len(missing))
+
+    if missing:
+        rendered = _render_posts(db, missing)
+        bodies.update(rendered)
+        staleness = replicas.staleness(db)
+        _set_many({key: rendered[post_id]
+                   for post_id, key, token in zip(post_ids, keys, tokens)
+                   if post_id in rendered and _storable(token, staleness)
+                   and cached[key] is None},
+                  POST_TTL)
+
+    return [bodies[post_id] for post_id in post_ids if post_id in bodies]
+
+
+def post_body(db: Session, post_id: int, author_id: int) -> Optional[bytes]:
+    """ Returns the encoded body of a post by author_id, None if there is none """
+
+    bodies = post_bodies(db, [post_id])
+    if bodies and orjson.loads(bodies[0])["author"]["id"] == author_id:
+        return bodies[0]
+    return None
+
+
+# Profile cards
+
+def profile_card(db: Session, username: str) -> Optional[dict]:
+    """ Returns a user as schemas.UserProfileViewUnfollower, None if missing """
+
+    token, = _generations([user_tag(username)])
+    key = f"card:{username}:{token}"
+    if token:
+        cached, = _get_many([key])
+        if cached is not None:
+            _count("profile", 1, 0)
+            return orjson.loads(cached)
+
+    _count("profile", 0, 1)
+    user = db.query(models.User).\
+        filter(models.User.username == username).first()
+    if user is None:
+        return None
+
+    card = serializers.profile_unfollower(user)
+    if _storable(token, replicas.staleness(db)):
+        _set_many({key: serializers.encode(card)}, PROFILE_TTL)
+    return card
+
+
+# Pages
+
+def page(db: Session, tag: str, params: str,
+         load: Callable[[], Tuple[List[int], Optional[str]]]) -> Tuple[List[int], Optional[str]]:
+    """
+    Returns the post ids and next cursor of a feed page under tag, calling
+    load on a miss. db is the session load reads from, params tells apart
+    the pages of one tag.
+    """
+
+    token, = _generations([tag])
+    key = f"page:{tag}:{token}:{params}"
+    if token:
+        cached, = _get_many([key])
+        if cached is not None:
+            _count("feed", 1, 0)
+            post_ids, next_cursor = orjson.loads(cached)
+            return post_ids, next_cursor
+
+    _count("feed", 0, 1)
+    post_ids, next_cursor = load()
+    if _storable(token, replicas.staleness(db)):
+        _set_many({key: orjson.dumps([post_ids, next_cursor])}, FEED_TTL)
+    return post_ids, next_cursor
+
+
+# Responses
+
+def encode_list(bodies: List[bytes]) -> bytes:
+    """ Joins encoded bodies into a JSON array """
+    return b"[" + b",".join(bodies) + b"]"
+
+
+def encode_profile(card: dict, bodies: List[bytes]) -> bytes:
+    """ Encodes schemas.UserProfileView from a profile card and post bodies """
+
+    # Splice the encoded posts in rather than decoding them again
+    head = serializers.encode({"id": card["id"],
+                               "username": card["username"],
+                               "fullname": card["fullname"],
+                               "profile_pic": card["profile_pic"],
+                               "description": card["description"]})
+    tail = serializers.encode({"follower_count": card["follower_count"],
+                               "following_count": card["following_count"]})
+    return head[:-1] + b',"posts":' + encode_list(bodies) + b"," + tail[1:]
+
+
+def json_response(body: bytes, response: Response) -> Response:
+    """ Returns an encoded body, keeping the headers set on the route's response """
+    return Response(body, media_type="application/json", headers=response.headers)
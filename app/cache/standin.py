@@ -0,0 +1,101 @@
+"""
+Minimal in-memory server speaking the subset of the Redis protocol used by
+the response cache, for development and load tests without Redis
+
+Usage - python -m app.cache.standin [--port 6379] [--maxsize 1000000]
+"""
+
+# Imports
+
+import argparse
+import socketserver
+
+from app.cache.backends import ProtocolError, read_reply
+from app.cache.lru import LRUCache
+
+
+# Stand-in settings
+
+MAX_TTL_SECONDS = 7 * 24 * 3600
+
+
+# Commands
+
+def _set(entries: LRUCache, key: bytes, value: bytes, *options: bytes) -> bytes:
+    """ SET key value [PX milliseconds | EX seconds] [NX] """
+
+    options = [option.upper() for option in options]
+    ttl = MAX_TTL_SECONDS
+    if b"PX" in options:
+        ttl = int(options[options.index(b"PX") + 1]) / 1000
+    elif b"EX" in options:
+        ttl = int(options[options.index(b"EX") + 1])
+
+    if b"NX" in options:
+        return b"+OK\r\n" if entries.add(key, value, ttl) else b"$-1\r\n"
+    entries.set(key, value, ttl)
+    return b"+OK\r\n"
+
+
+def _bulk(value: bytes) -> bytes:
+    """ Encodes a bulk string reply """
+
+    if value is None:
+        return b"$-1\r\n"
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+def execute(entries: LRUCache, command: list) -> bytes:
+    """ Runs a command, returning its encoded reply """
+
+    name, arguments = command[0].upper(), command[1:]
+    if name == b"GET":
+        return _bulk(entries.get(arguments[0]))
+    if name == b"MGET":
+        return b"*%d\r\n" % len(arguments) + \
+            b"".join(_bulk(entries.get(key)) for key in arguments)
+    if name == b"SET":
+        return _set(entries, *arguments)
+    if name == b"FLUSHDB":
+        entries.clear()
+        return b"+OK\r\n"
+    if name in (b"PING", b"SELECT", b"AUTH"):
+        return b"+PONG\r\n" if name == b"PING" else b"+OK\r\n"
+    return b"-ERR unknown command '%s'\r\n" % name
+
+
+# Server
+
+class Handler(socketserver.StreamRequestHandler):
+    """ Serves the commands of one client connection """
+
+    def handle(self):
+        while True:
+            try:
+                command = read_reply(self.rfile)
+            except (ConnectionError, ProtocolError):
+                return
+            self.wfile.write(execute(self.server.entries, command))
+
+
+class StandInServer(socketserver.ThreadingTCPServer):
+    """ Threaded server sharing one LRU cache between its clients """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: tuple, maxsize: int):
+        super().__init__(address, Handler)
+        self.entries = LRUCache(maxsize, MAX_TTL_SECONDS)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--maxsize", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    with StandInServer((args.host, args.port), args.maxsize) as server:
+        print(f"Serving a Redis protocol stand-in on {args.host}:{args.port}")
+        server.serve_forever()
@@ -28,12 +28,98 @@ class Settings(BaseSettings):
     access_token_expire_minutes: int
     cors_origin_whitelist: str
 
+    # Connection pools
+    database_pool_size: int = 5
+    database_max_overflow: int = 10
+    database_pool_timeout_seconds: float = 30.0
+    database_pool_recycle_seconds: int = -1
+    database_pool_pre_ping: bool = False
+    database_statement_timeout_ms: int = 0
+    database_pgbouncer: bool = False
+
+    # Read replicas
+    database_replica_urls: str = ""
+    replica_max_lag_seconds: float = 5.0
+    replica_check_seconds: float = 1.0
+    replica_sticky_seconds: float = 10.0
+
+    # Threadpool running the synchronous route handlers
+    worker_threads: int = 40
+    fast_json_responses: bool = True
+
+    # Authenticated principal cache
+    principal_cache_size: int = 10000
+    principal_cache_ttl_seconds: int = 60
+
+    # Password hashing
+    bcrypt_rounds: int = 12
+    password_hash_workers: int = 2
+    password_hash_queue_depth: int = 16
+
+    # Image processing
+    image_workers: int = 2
+    image_queue_depth: int = 32
+    image_job_retries: int = 2
+    image_worker_niceness: int = 10
+    media_index_refresh_seconds: int = 300
+    media_index_miss_seconds: float = 2.0
+
+    # Likes
+    like_write_behind: bool = False
+    like_flush_seconds: float = 1.0
+    like_flush_batch_size: int = 5000
+
+    # Comments
+    comment_preview_size: int = 3
+
+    # Response cache
+    cache_backend: str = "none"
+    cache_url: str = "redis://localhost:6379/0"
+    cache_memory_entries: int = 100000
+    cache_timeout_seconds: float = 0.25
+    cache_post_ttl_seconds: int = 60
+    cache_profile_ttl_seconds: int = 60
+    cache_feed_ttl_seconds: int = 10
+
+    # Invalidation bus between workers
+    invalidation_bus: bool = False
+    invalidation_heartbeat_seconds: float = 5.0
+    invalidation_bus_database_url: str = ""
+
+    # Pagination
+    page_size_default: int = 10
+    page_size_max: int = 50
+
+    # Metrics
+    request_metrics: bool = True
+
+    # Query instrumentation
+    query_budget_strict: bool = False
+    query_count_header: bool = False
+    sql_profiling: bool = False
+    sql_n_plus_one_threshold: int = 3
+    sql_slow_query_ms: float = 0.0
+    sql_profile_reports: int = 100
+
+    # Feed timelines
+    timeline_fanout_limit: int = 10000
+    timeline_max_length: int = 1000
+    timeline_celebrity_refresh_seconds: int = 300
+    timeline_trim_seconds: float = 1.0
+    timeline_trim_batch_size: int = 500
+
     @validator('cors_origin_whitelist')
     def split_cors_origin_string(cls, cors_origin_whitelist):
         """ Convert cors_origin_whitelist string to list """
 
         return cors_origin_whitelist.split(',')
 
+    @validator('database_replica_urls')
+    def split_database_replica_urls(cls, database_replica_urls):
+        """ Convert database_replica_urls string to list """
+
+        return [url for url in database_replica_urls.split(',') if url]
+
     class Config:
         """ Link env file name """
         env_file = ".\local.env"
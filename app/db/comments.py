@@ -0,0 +1,96 @@
+""" Module reading comment threads a page at a time with a fixed number of queries """
+
+# Imports
+
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import Integer, column, func, select, true, values
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.db import loaders, models, pagination
+
+
+# Comment settings
+
+PREVIEW_SIZE = settings.comment_preview_size
+
+
+# Threads
+#
+# Top level comments hang off a post and replies off a comment, one level
+# deep. Posts only carry their comment_count and newest comments, the rest
+# of a thread is paged through on demand, newest comments first and
+# replies in the order they were written. Reply counts are attached to
+# every page with one grouped count.
+
+def _attach_reply_counts(db: Session, comments: List[models.Comment]) -> None:
+    """ Sets reply_count on comments with a single query """
+
+    counts = {}
+    if comments:
+        counts = dict(db.execute(
+            select(models.Comment.parent_id, func.count()).
+            where(models.Comment.parent_id.in_([comment.id for comment in comments])).
+            group_by(models.Comment.parent_id)).all())
+
+    for comment in comments:
+        comment.reply_count = counts.get(comment.id, 0)
+
+
+def attach_previews(db: Session, posts: List[models.Post]) -> None:
+    """
+    Sets top_comments on posts to their newest comments, reading at most
+    PREVIEW_SIZE comments of each post whatever the size of its thread
+    """
+
+    previews: Dict[int, List[models.Comment]] = {post.id: [] for post in posts}
+
+    if posts and PREVIEW_SIZE > 0:
+        page = values(column("id", Integer), name="page").\
+            data([(post_id,) for post_id in previews])
+        newest = select(models.Comment.id).\
+            where(models.Comment.post_id == page.c.id).\
+            order_by(models.Comment.created_at.desc(), models.Comment.id.desc()).\
+            limit(PREVIEW_SIZE).\
+            lateral("newest")
+        preview_ids = select(newest.c.id).select_from(page.join(newest, true()))
+
+        comments = db.query(models.Comment).\
+            options(*loaders.comment_response()).\
+            filter(models.Comment.id.in_(preview_ids)).\
+            order_by(models.Comment.created_at.desc(), models.Comment.id.desc()).\
+            all()
+        _attach_reply_counts(db, comments)
+        for comment in comments:
+            previews[comment.post_id].append(comment)
+
+    for post in posts:
+        post.top_comments = previews[post.id]
+
+
+def page_comments(db: Session, post_id: int, cursor: Optional[str],
+                  limit: Optional[int]) -> Tuple[List[models.Comment], Optional[str]]:
+    """ Returns one page of a post's comments, newest first, with their reply counts """
+
+    comment_query = db.query(models.Comment).\
+        options(*loaders.comment_response()).\
+        filter(models.Comment.post_id == post_id)
+
+    comments, next_cursor = pagination.paginate(
+        comment_query, [models.Comment.created_at, models.Comment.id],
+        cursor, limit)
+    _attach_reply_counts(db, comments)
+    return comments, next_cursor
+
+
+def page_replies(db: Session, comment_id: int, cursor: Optional[str],
+                 limit: Optional[int]) -> Tuple[List[models.Comment], Optional[str]]:
+    """ Returns one page of a comment's replies, oldest first """
+
+    reply_query = db.query(models.Comment).\
+        options(*loaders.comment_response()).\
+        filter(models.Comment.parent_id == comment_id)
+
+    return pagination.paginate(
+        reply_query, [models.Comment.created_at, models.Comment.id],
+        cursor, limit, descending=False)
@@ -0,0 +1,151 @@
+""" Module keeping the denormalized counters of posts and users in sync """
+
+# Imports
+
+from typing import Dict
+from sqlalchemy import Integer, case, column, func, select, update, values
+from sqlalchemy.orm import Session
+
+from app.db import models
+from app.db.db_setup import SessionLocal
+
+
+# Counter updates
+
+def adjust(db: Session, post_id: int, likes: int = 0, comments: int = 0) -> None:
+    """ Atomically adds the given deltas to a post's counters """
+
+    db.execute(update(models.Post).
+               where(models.Post.id == post_id).
+               values(like_count=models.Post.like_count + likes,
+                      comment_count=models.Post.comment_count + comments).
+               execution_options(synchronize_session=False))
+
+
+def adjust_likes(db: Session, deltas: Dict[int, int]) -> None:
+    """ Adds like count deltas to many posts in a single statement """
+
+    changes = sorted((post_id, delta) for post_id, delta in deltas.items() if delta)
+    if not changes:
+        return
+
+    rows = values(column("post_id", Integer), column("delta", Integer),
+                  name="deltas").data(changes)
+    db.execute(update(models.Post).
+               where(models.Post.id == rows.c.post_id).
+               values(like_count=models.Post.like_count + rows.c.delta).
+               execution_options(synchronize_session=False))
+
+
+def adjust_follows(db: Session, follower_id: int, followee_id: int,
+                   delta: int) -> None:
+    """
+    Atomically adds a delta to the following count of a follower and the
+    follower count of a followee
+    """
+
+    db.execute(update(models.User).
+               where(models.User.id.in_([follower_id, followee_id])).
+               values(following_count=models.User.following_count +
+                      case((models.User.id == follower_id, delta), else_=0),
+                      follower_count=models.User.follower_count +
+                      case((models.User.id == followee_id, delta), else_=0)).
+               execution_options(synchronize_session=False))
+
+
+def release_user(db: Session, user_id: int) -> None:
+    """
+    Removes a user's likes, comments and follows from the counters of other
+    posts and users. Must run before the user is deleted, as the rows go
+    away by cascade.
+    """
+
+    liked_posts = select(models.Like.post_id).\
+        where(models.Like.user_id == user_id)
+    db.execute(update(models.Post).
+               where(models.Post.id.in_(liked_posts)).
+               values(like_count=models.Post.like_count - 1).
+               execution_options(synchronize_session=False))
+
+    comments = select(models.Comment.post_id,
+                      func.count().label("total")).\
+        where(models.Comment.author_id == user_id,
+              models.Comment.post_id.isnot(None)).\
+        group_by(models.Comment.post_id).\
+        subquery()
+    db.execute(update(models.Post).
+               where(models.Post.id == comments.c.post_id).
+               values(comment_count=models.Post.comment_count - comments.c.total).
+               execution_options(synchronize_session=False))
+
+    followed = select(models.user_follow.c.following_id).\
+        where(models.user_follow.c.user_id == user_id)
+    db.execute(update(models.User).
+               where(models.User.id.in_(followed)).
+               values(follower_count=models.User.follower_count - 1).
+               execution_options(synchronize_session=False))
+
+    followers = select(models.user_follow.c.user_id).\
+        where(models.user_follow.c.following_id == user_id)
+    db.execute(update(models.User).
+               where(models.User.id.in_(followers)).
+               values(following_count=models.User.following_count - 1).
+               execution_options(synchronize_session=False))
+
+
+# Reconciliation
+
+def reconcile(db: Session) -> int:
+    """ Recomputes drifted counters from the Likes and Comments tables """
+
+    like_totals = select(func.count()).\
+        where(models.Like.post_id == models.Post.id).\
+        scalar_subquery()
+    comment_totals = select(func.count()).\
+        where(models.Comment.post_id == models.Post.id).\
+        scalar_subquery()
+    totals = select(models.Post.id.label("id"),
+                    like_totals.label("likes"),
+                    comment_totals.label("comments")).\
+        subquery()
+
+    result = db.execute(update(models.Post).
+                        where(models.Post.id == totals.c.id,
+                              (models.Post.like_count != totals.c.likes) |
+                              (models.Post.comment_count != totals.c.comments)).
+                        values(like_count=totals.c.likes,
+                               comment_count=totals.c.comments).
+                        execution_options(synchronize_session=False))
+    db.commit()
+    return result.rowcount
+
+
+def reconcile_users(db: Session) -> int:
+    """ Recomputes drifted follower and following counters from user_follow """
+
+    follower_totals = select(func.count()).\
+        where(models.user_follow.c.following_id == models.User.id).\
+        scalar_subquery()
+    following_totals = select(func.count()).\
+        where(models.user_follow.c.user_id == models.User.id).\
+        scalar_subquery()
+    totals = select(models.User.id.label("id"),
+                    follower_totals.label("followers"),
+                    following_totals.label("following")).\
+        subquery()
+
+    result = db.execute(update(models.User).
+                        where(models.User.id == totals.c.id,
+                              (models.User.follower_count != totals.c.followers) |
+                              (models.User.following_count != totals.c.following)).
+                        values(follower_count=totals.c.followers,
+                               following_count=totals.c.following).
+                        execution_options(synchronize_session=False))
+    db.commit()
+    return result.rowcount
+
+
+if __name__ == "__main__":
+    with SessionLocal() as session:
+        print(f"Reconciled counters of {reconcile(session)} posts")
+        print(f"Reconciled counters of {reconcile_users(session)} users")
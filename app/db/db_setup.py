@@ -1,11 +1,11 @@
 """ Module handling the SQLalchemy database connection and session setup """
 
 # Imports
-from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 from app.config import settings
+from app.db.pool import create_pooled_engine
 
 # Database metadata
 DATABASE_USERNAME = settings.database_username
@@ -18,8 +18,12 @@ DATABASE_PORT = settings.database_port
 # Database connection URL for Postgres
 SQLALCHEMY_DATABASE_URL = f"postgresql://{DATABASE_USERNAME}:{DATABASE_PASSWORD}@{DATABASE_HOSTNAME}:{DATABASE_PORT}/{DATABASE_NAME}"
 
-# Database Engine for Postgres
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+# Database Engine for Postgres, pooled as configured in app.db.pool
+engine = create_pooled_engine("primary", SQLALCHEMY_DATABASE_URL)
+
+# Database Engines for the read replicas, see app.db.replicas
+replica_engines = [create_pooled_engine(f"replica-{number}", url)
+                   for number, url in enumerate(settings.database_replica_urls, 1)]
 
 # Database connection URL for sqlite3
 # SQLALCHEMY_DATABASE_URL = "sqlite:///./Chitros.db"
@@ -0,0 +1,94 @@
+""" Module answering and updating follow relationships with indexed queries """
+
+# Imports
+
+from typing import List, Optional, Tuple
+from sqlalchemy import delete, exists, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from app.db import counters, models, pagination
+
+
+# Follow edges
+#
+# user_follow is keyed by (user_id, following_id), so checking an edge is a
+# single primary key lookup instead of loading a user's whole following
+# list. ix_user_follow_following_id serves the reverse direction.
+
+follows_table = models.user_follow
+
+
+# Membership checks
+
+def follows(db: Session, follower_id: int, followee_id: int) -> bool:
+    """ Checks whether follower follows followee """
+
+    return db.execute(select(exists().where(
+        follows_table.c.user_id == follower_id,
+        follows_table.c.following_id == followee_id))).scalar()
+
+
+def can_view(db: Session, viewer_id: int, author_id: int) -> bool:
+    """ Checks whether a viewer may see an author's posts and profile """
+    return viewer_id == author_id or follows(db, viewer_id, author_id)
+
+
+# Updating edges
+
+def follow(db: Session, follower_id: int, followee_id: int) -> bool:
+    """ Adds and counts a follow edge, returning False if it already existed """
+
+    result = db.execute(insert(follows_table).
+                        values(user_id=follower_id, following_id=followee_id).
+                        on_conflict_do_nothing())
+    if result.rowcount != 1:
+        return False
+
+    counters.adjust_follows(db, follower_id, followee_id, 1)
+    return True
+
+
+def unfollow(db: Session, follower_id: int, followee_id: int) -> bool:
+    """ Removes and uncounts a follow edge, returning False if there was none """
+
+    result = db.execute(delete(follows_table).
+                        where(follows_table.c.user_id == follower_id,
+                              follows_table.c.following_id == followee_id))
+    if result.rowcount != 1:
+        return False
+
+    counters.adjust_follows(db, follower_id, followee_id, -1)
+    return True
+
+
+# Follow lists
+#
+# Lists are paged by the id of the listed users, which is the second
+# column of the index read, so each page is a short range scan.
+
+def _page(db: Session, user_column: any, owner_column: any, owner_id: int,
+          cursor: Optional[str],
+          limit: Optional[int]) -> Tuple[List[models.User], Optional[str]]:
+    """ Pages the users at one end of the edges whose other end is a user """
+
+    user_query = db.query(models.User).\
+        join(follows_table, user_column == models.User.id).\
+        filter(owner_column == owner_id)
+    return pagination.paginate(user_query, [user_column], cursor, limit,
+                               descending=False,
+                               key_values=lambda user: [user.id])
+
+
+def followers(db: Session, user_id: int, cursor: Optional[str],
+              limit: Optional[int]) -> Tuple[List[models.User], Optional[str]]:
+    """ Returns one page of a user's followers """
+    return _page(db, follows_table.c.user_id, follows_table.c.following_id,
+                 user_id, cursor, limit)
+
+
+def following(db: Session, user_id: int, cursor: Optional[str],
+              limit: Optional[int]) -> Tuple[List[models.User], Optional[str]]:
+    """ Returns one page of the users a user follows """
+    return _page(db, follows_table.c.following_id, follows_table.c.user_id,
+                 user_id, cursor, limit)
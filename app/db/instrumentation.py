@@ -0,0 +1,143 @@
+""" Module counting and timing the SQL statements issued while serving each request """
+
+# Imports
+
+import json
+import logging
+import time
+from contextvars import ContextVar
+from typing import Optional
+from sqlalchemy import event
+
+from app.config import settings
+from app.db.db_setup import engine, replica_engines
+
+
+# Instrumentation settings
+
+QUERY_BUDGET_STRICT = settings.query_budget_strict
+QUERY_COUNT_HEADER = settings.query_count_header
+
+logger = logging.getLogger(__name__)
+
+
+# Per-request statistics
+
+class RequestStats:
+    """ SQL statistics of a single request """
+
+    __slots__ = ("query_count", "query_seconds", "query_budget")
+
+    def __init__(self):
+        self.query_count = 0
+        self.query_seconds = 0.0
+        self.query_budget: Optional[int] = None
+
+
+_request_stats: ContextVar[Optional[RequestStats]] = ContextVar(
+    "request_stats", default=None)
+
+
+def current_stats() -> Optional[RequestStats]:
+    """ Returns the statistics of the request being served, if any """
+    return _request_stats.get()
+
+
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    """ Counts every statement sent to the database during a request """
+
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.query_count += 1
+        conn.info["statement_started"] = time.perf_counter()
+
+
+def _time_statement(conn, cursor, statement, parameters, context, executemany):
+    """ Adds up the time the database took on the statements of a request """
+
+    stats = _request_stats.get()
+    started = conn.info.pop("statement_started", None)
+    if stats is not None and started is not None:
+        stats.query_seconds += time.perf_counter() - started
+
+
+for bound in [engine, *replica_engines]:
+    event.listen(bound, "before_cursor_execute", _count_statement)
+    event.listen(bound, "after_cursor_execute", _time_statement)
+
+
+# Query budgets
+
+def query_budget(limit: int) -> any:
+    """
+    Returns a route dependency declaring the most statements the route may
+    issue, including authentication and response serialization. The limit
+    is kept on the dependency for checks reading the routes' budgets.
+    """
+
+    async def declare_budget() -> None:
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.query_budget = limit
+
+    declare_budget.limit = limit
+    return declare_budget
+
+
+class QueryCountMiddleware:
+    """
+    ASGI middleware tracking the statements of each request. Requests over
+    their declared budget are logged, or fail with a 500 when
+    QUERY_BUDGET_STRICT is set so that tests and local runs catch N+1s.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        replaced = False
+
+        async def send_with_stats(message):
+            nonlocal replaced
+
+            if replaced:
+                return
+
+            if message["type"] == "http.response.start":
+                over_budget = stats.query_budget is not None and \
+                    stats.query_count > stats.query_budget
+
+                if over_budget:
+                    logger.warning("%s %s issued %d queries, budget is %d",
+                                   scope["method"], scope["path"],
+                                   stats.query_count, stats.query_budget)
+
+                if over_budget and QUERY_BUDGET_STRICT:
+                    replaced = True
+                    body = json.dumps({
+                        "detail": "Query budget exceeded",
+                        "query_count": stats.query_count,
+                        "query_budget": stats.query_budget}).encode()
+                    await send({"type": "http.response.start",
+                                "status": 500,
+                                "headers": [(b"content-type", b"application/json"),
+                                            (b"content-length", str(len(body)).encode())]})
+                    await send({"type": "http.response.body", "body": body})
+                    return
+
+                if QUERY_COUNT_HEADER:
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"x-query-count", str(stats.query_count).encode())]
+
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_stats)
+        finally:
+            _request_stats.reset(token)
@@ -0,0 +1,230 @@
+""" Module recording likes as keyed writes, optionally buffered and flushed in batches """
+
+# Imports
+
+import logging
+from collections import Counter
+from threading import Event, Lock, Thread
+from typing import Dict, Optional, Tuple
+from sqlalchemy import Integer, column, delete, exists, select, tuple_, values
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from app.cache import responses as response_cache
+from app.config import settings
+from app.db import counters, models
+from app.db.db_setup import SessionLocal
+
+
+# Like settings
+
+WRITE_BEHIND = settings.like_write_behind
+FLUSH_SECONDS = settings.like_flush_seconds
+FLUSH_BATCH_SIZE = settings.like_flush_batch_size
+
+logger = logging.getLogger(__name__)
+
+
+# Direct writes
+#
+# Likes are keyed by (user_id, post_id), so liking and unliking are single
+# primary key writes whose row counts tell whether anything changed.
+
+def _insert(db: Session, user_id: int, post_id: int) -> bool:
+    """ Stores a like and counts it, returning False if it existed """
+
+    result = db.execute(insert(models.Like).
+                        values(user_id=user_id, post_id=post_id).
+                        on_conflict_do_nothing())
+    if result.rowcount != 1:
+        return False
+
+    counters.adjust(db, post_id, likes=1)
+    return True
+
+
+def _delete(db: Session, user_id: int, post_id: int) -> bool:
+    """ Removes a like and uncounts it, returning False if there was none """
+
+    result = db.execute(delete(models.Like).
+                        where(models.Like.user_id == user_id,
+                              models.Like.post_id == post_id))
+    if result.rowcount != 1:
+        return False
+
+    counters.adjust(db, post_id, likes=-1)
+    return True
+
+
+# Write-behind buffer
+#
+# With LIKE_WRITE_BEHIND set, likes are only recorded in memory and a
+# background thread writes them every LIKE_FLUSH_SECONDS, or sooner once
+# LIKE_FLUSH_BATCH_SIZE are waiting. Only the latest action of a user on a
+# post is kept, so like/unlike pairs cost at most one write. Buffered likes
+# are lost if the process dies before a flush, and counters lag behind by
+# up to one flush. The batch being written stays visible until it commits.
+#
+# Each process buffers on its own and only sees its own buffered actions,
+# so write-behind is meant for a single worker process. With several, a
+# like buffered by one worker is unknown to the others until it is
+# flushed, so they may accept it twice or refuse its unlike.
+
+_pending: Dict[Tuple[int, int], bool] = {}
+_flushing: Dict[Tuple[int, int], bool] = {}
+_pending_lock = Lock()
+_flush_lock = Lock()
+_wake = Event()
+_stop = Event()
+_flusher: Optional[Thread] = None
+
+
+def _is_liked(db: Session, user_id: int, post_id: int) -> bool:
+    """ Returns whether a user likes a post, buffered actions included """
+
+    with _pending_lock:
+        liked = _pending.get((user_id, post_id))
+        if liked is None:
+            liked = _flushing.get((user_id, post_id))
+    if liked is not None:
+        return liked
+
+    return db.execute(select(exists().where(
+        models.Like.user_id == user_id,
+        models.Like.post_id == post_id))).scalar()
+
+
+def _buffer(user_id: int, post_id: int, liked: bool) -> None:
+    """ Records the latest like action of a user on a post """
+
+    with _pending_lock:
+        _pending[(user_id, post_id)] = liked
+        if len(_pending) >= FLUSH_BATCH_SIZE:
+            _wake.set()
+
+
+def _write_batch(db: Session, batch: Dict[Tuple[int, int], bool]) -> None:
+    """
+    Applies buffered actions with one insert and one delete, then moves
+    every affected counter in a single update. Likes on posts or by users
+    deleted in the meantime are dropped.
+    """
+
+    deltas = Counter()
+    liked = sorted(key for key, value in batch.items() if value)
+    unliked = sorted(key for key, value in batch.items() if not value)
+
+    if liked:
+        rows = values(column("user_id", Integer), column("post_id", Integer),
+                      name="liked").data(liked)
+        existing = select(rows.c.user_id, rows.c.post_id).\
+            join(models.Post, models.Post.id == rows.c.post_id).\
+            join(models.User, models.User.id == rows.c.user_id)
+        inserted = db.execute(insert(models.Like).
+                              from_select(["user_id", "post_id"], existing).
+                              on_conflict_do_nothing().
+                              returning(models.Like.post_id)).scalars()
+        deltas.update(inserted)
+
+    if unliked:
+        deleted = db.execute(delete(models.Like).
+                             where(tuple_(models.Like.user_id,
+                                          models.Like.post_id).in_(unliked)).
+                             returning(models.Like.post_id)).scalars()
+        deltas.subtract(deleted)
+
+    counters.adjust_likes(db, deltas)
+
+
+def flush() -> int:
+    """ Writes every buffered action, returning how many were written """
+
+    global _pending, _flushing
+    with _flush_lock:
+        with _pending_lock:
+            batch, _pending = _pending, {}
+            _flushing = batch
+        if not batch:
+            return 0
+
+        try:
+            with SessionLocal() as db:
+                _write_batch(db, batch)
+                db.commit()
+        except Exception:
+            # Put the batch back without overriding newer actions
+            with _pending_lock:
+                for key, liked in batch.items():
+                    _pending.setdefault(key, liked)
+                _flushing = {}
+            raise
+
+        with _pending_lock:
+            _flushing = {}
+
+        response_cache.invalidate(*(response_cache.post_tag(post_id)
+                                    for _, post_id in batch),
+                                  *(response_cache.feed_tag(user_id)
+                                    for user_id, _ in batch))
+        return len(batch)
+
+
+def _flush_periodically() -> None:
+    """ Flusher thread loop """
+
+    while not _stop.is_set():
+        _wake.wait(FLUSH_SECONDS)
+        _wake.clear()
+        try:
+            flush()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Could not flush buffered likes, retrying")
+
+
+def start_flusher() -> None:
+    """ Starts the background flushes when write-behind is enabled """
+
+    global _flusher
+    if WRITE_BEHIND and _flusher is None:
+        _stop.clear()
+        _flusher = Thread(target=_flush_periodically, name="like-flusher",
+                          daemon=True)
+        _flusher.start()
+
+
+def stop_flusher() -> None:
+    """ Stops the background flushes, writing what is still buffered """
+
+    global _flusher
+    if _flusher is not None:
+        _stop.set()
+        _wake.set()
+        _flusher.join()
+        _flusher = None
+    flush()
+
+
+# Liking posts
+
+def like(db: Session, user_id: int, post_id: int) -> bool:
+    """ Likes a post, returning False if it is already liked """
+
+    if not WRITE_BEHIND:
+        return _insert(db, user_id, post_id)
+
+    if _is_liked(db, user_id, post_id):
+        return False
+    _buffer(user_id, post_id, True)
+    return True
+
+
+def unlike(db: Session, user_id: int, post_id: int) -> bool:
+    """ Unlikes a post, returning False if it was not liked """
+
+    if not WRITE_BEHIND:
+        return _delete(db, user_id, post_id)
+
+    if not _is_liked(db, user_id, post_id):
+        return False
+    _buffer(user_id, post_id, False)
+    return True
@@ -0,0 +1,36 @@
+""" Module defining the eager loading options for each response shape """
+
+# Imports
+
+from sqlalchemy.orm import selectinload
+
+from app.db import models
+
+
+# Loader options
+#
+# selectinload on a many-to-one relationship only fetches the ids that are
+# not already in the session, so authors shared across posts, likes,
+# comments and replies are loaded once per page.
+
+def post_response() -> tuple:
+    """
+    Loads the relationships serialized by schemas.PostResponse, top
+    comments being attached by app.db.comments.attach_previews
+    """
+
+    return (
+        selectinload(models.Post.author),
+        selectinload(models.Post.likes).
+        selectinload(models.Like.user),
+    )
+
+
+def comment_response() -> tuple:
+    """ Loads the authors serialized by schemas.CommentResponse and ReplyResponse """
+    return (selectinload(models.Comment.author),)
+
+
+def follow_request() -> tuple:
+    """ Loads everything serialized by schemas.FollowRequest """
+    return (selectinload(models.FollowRequest.sender),)
@@ -2,9 +2,10 @@
 
 # Imports
 from sqlalchemy import (TIMESTAMP, Column, ForeignKey,
-                        Integer, String, Boolean, Table,
-                        select, text, func)
-from sqlalchemy.orm import relationship, backref, column_property
+                        Integer, String, Boolean, Table, Index,
+                        Computed, text, func)
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import relationship, backref, deferred
 
 from app.db.db_setup import Base
 
@@ -16,7 +17,8 @@ user_follow = Table(
     Column('user_id', Integer, ForeignKey(
         "Users.id", ondelete="CASCADE"), primary_key=True),
     Column('following_id', Integer, ForeignKey(
-        "Users.id", ondelete="CASCADE"), primary_key=True)
+        "Users.id", ondelete="CASCADE"), primary_key=True),
+    Index("ix_user_follow_following_id", "following_id", "user_id")
 )
 
 
@@ -33,6 +35,12 @@ class FollowRequest(Base):
     receiver = relationship(
         "User", back_populates="received_requests", foreign_keys=[receiver_id])
 
+    __table_args__ = (
+        Index("ix_Follow_Requests_receiver_id", "receiver_id"),
+        Index("ix_Follow_Requests_sender_id_receiver_id",
+              "sender_id", "receiver_id"),
+    )
+
 
 class User(Base):
 
@@ -54,6 +62,14 @@ class User(Base):
     # For sqlite3
     # created_at = Column(TIMESTAMP(timezone=True), nullable=False, default=func.now())
     
+    # Search document weighting usernames over names over descriptions,
+    # see app.db.search
+    search_vector = deferred(Column(TSVECTOR, Computed(
+        "setweight(to_tsvector('simple', username), 'A') || "
+        "setweight(to_tsvector('simple', fullname), 'B') || "
+        "setweight(to_tsvector('simple', coalesce(description, '')), 'C')",
+        persisted=True)))
+
     following = relationship("User",
                              secondary=user_follow,
                              primaryjoin="User.id==user_follow.c.user_id",
@@ -67,6 +83,19 @@ class User(Base):
     received_requests = relationship(
         "FollowRequest", back_populates="receiver", foreign_keys=[FollowRequest.receiver_id])
 
+    # Denormalized counters, kept in sync by app.db.counters
+    follower_count = Column(Integer, nullable=False, server_default='0')
+    following_count = Column(Integer, nullable=False, server_default='0')
+
+    __table_args__ = (
+        Index("ix_Users_search_vector", "search_vector",
+              postgresql_using="gin"),
+        Index("ix_Users_username_prefix",
+              func.lower(username).collate("C"), "id"),
+        # Media lookups of urls missing from a worker's media index
+        Index("ix_Users_profile_pic", "profile_pic"),
+    )
+
     # Methods
 
     def follow(self, second_user):
@@ -82,6 +111,15 @@ class User(Base):
             self.following.remove(second_user)
 
 
+class PostStatus:
+
+    """ Processing states of a post's image """
+
+    PROCESSING = "processing"
+    READY = "ready"
+    FAILED = "failed"
+
+
 class Post(Base):
 
     """ Table model for posts """
@@ -92,6 +130,9 @@ class Post(Base):
     description = Column(String, nullable=True)
     published = Column(Boolean, nullable=False, server_default='TRUE')
     location = Column(String, nullable=True)
+    status = Column(String, nullable=False, server_default=PostStatus.READY)
+    # When a worker last queued the post's image, on upload or after a restart
+    resume_claimed_at = Column(TIMESTAMP(timezone=True), nullable=True)
     
     # For postgres
     created_at = Column(TIMESTAMP(timezone=True),
@@ -110,6 +151,21 @@ class Post(Base):
     likes = relationship("Like", back_populates="post")
     comments = relationship("Comment", back_populates="post")
 
+    # Denormalized counters, kept in sync by app.db.counters
+    like_count = Column(Integer, nullable=False, server_default='0')
+    comment_count = Column(Integer, nullable=False, server_default='0')
+
+    __table_args__ = (
+        Index("ix_Posts_like_count_id", "like_count", "id"),
+        Index("ix_Posts_author_id_created_at", "author_id", "created_at", "id"),
+        # Posts other users can see, read by profiles and followed celebrities
+        Index("ix_Posts_author_id_created_at_visible",
+              "author_id", "created_at", "id",
+              postgresql_where=text("published AND status = 'ready'")),
+        # Media lookups of urls missing from a worker's media index
+        Index("ix_Posts_image_url", "image_url"),
+    )
+
 
 class Comment(Base):
 
@@ -133,6 +189,11 @@ class Comment(Base):
     # For sqlite3
     # created_at = Column(TIMESTAMP(timezone=True), nullable=False, default=func.now())
 
+    __table_args__ = (
+        Index("ix_Comments_post_id_created_at", "post_id", "created_at", "id"),
+        Index("ix_Comments_parent_id_created_at", "parent_id", "created_at", "id"),
+    )
+
 
 class Like(Base):
 
@@ -146,8 +207,36 @@ class Like(Base):
     post = relationship("Post", back_populates="likes")
     user = relationship("User", back_populates="likes")
 
+    __table_args__ = (
+        Index("ix_Likes_post_id", "post_id", "user_id"),
+    )
+
+
+class TimelineEntry(Base):
+
+    """ Table model for materialized home timelines """
+
+    __tablename__ = "Timelines"
+    user_id = Column(Integer, ForeignKey(
+        "Users.id", ondelete="CASCADE"), primary_key=True)
+    post_id = Column(Integer, ForeignKey(
+        "Posts.id", ondelete="CASCADE"), primary_key=True)
+    author_id = Column(Integer, ForeignKey(
+        "Users.id", ondelete="CASCADE"), nullable=False)
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False)
+
+    __table_args__ = (
+        Index("ix_Timelines_user_id_created_at",
+              "user_id", "created_at", "post_id"),
+        Index("ix_Timelines_user_id_author_id", "user_id", "author_id"),
+    )
+
+
+
+class MediaBlob(Base):
+
+    """ Table model for reference counts of content addressed media files """
 
-# Column Properties
-Post.likes_count = column_property(select(func.count(Like.user_id)).
-                                   where(Like.post_id == Post.id).
-                                   scalar_subquery())
+    __tablename__ = "MediaBlobs"
+    url = Column(String, primary_key=True, nullable=False)
+    ref_count = Column(Integer, nullable=False, server_default='0')
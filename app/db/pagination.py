@@ -0,0 +1,140 @@
+""" Module handling cursor tokens and keyset pagination of list endpoints """
+
+# Imports
+
+import base64
+import binascii
+import json
+from datetime import datetime
+from functools import partial
+from typing import Callable, List, Optional, Tuple
+from fastapi import HTTPException, status
+from sqlalchemy import tuple_
+from sqlalchemy.orm import Query
+
+from app.config import settings
+
+
+# Pagination settings
+
+DEFAULT_PAGE_SIZE = settings.page_size_default
+MAX_PAGE_SIZE = settings.page_size_max
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+# Cursor tokens
+
+def _dump_value(value: any) -> any:
+    """ Makes a keyset value JSON serializable """
+
+    if isinstance(value, datetime):
+        return {"dt": value.isoformat()}
+    return value
+
+
+def _load_value(value: any) -> any:
+    """ Restores a keyset value dumped by _dump_value """
+
+    if isinstance(value, dict):
+        return datetime.fromisoformat(value["dt"])
+    return value
+
+
+def encode_cursor(values: list) -> str:
+    """ Encodes the keyset values of the last row into an opaque token """
+
+    raw = json.dumps([_dump_value(value) for value in values],
+                     separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def _key_type(key: any) -> Optional[type]:
+    """ Returns the Python type of a keyset column, None if it has none """
+
+    try:
+        return key.type.python_type
+    except NotImplementedError:
+        return None
+
+
+def _is_instance(value: any, expected: Optional[type]) -> bool:
+    """ Checks a decoded keyset value can be compared with its column """
+
+    if expected is None:
+        return True
+    if isinstance(value, bool):
+        return expected is bool
+    if expected is float:
+        return isinstance(value, (int, float))
+    return isinstance(value, expected)
+
+
+def decode_cursor(cursor: str, keys: list) -> list:
+    """
+    Decodes an opaque cursor token back into keyset values, checking each
+    has the type of its key so that a cursor of another listing or sort
+    fails as invalid rather than in the database
+    """
+
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(values, list) or len(values) != len(keys):
+            raise ValueError(cursor)
+        values = [_load_value(value) for value in values]
+        if not all(_is_instance(value, _key_type(key))
+                   for value, key in zip(values, keys)):
+            raise ValueError(cursor)
+        return values
+    except (ValueError, KeyError, TypeError, binascii.Error) as exc:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Invalid cursor") from exc
+
+
+# Keyset pagination
+
+def _attribute_values(keys: list, row: any) -> list:
+    """ Reads the keyset values of an ORM row from its mapped attributes """
+    return [getattr(row, key.key) for key in keys]
+
+
+def page_size(limit: Optional[int]) -> int:
+    """ Clamps a client chosen page size to the allowed range """
+
+    if limit is None:
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def paginate(query: Query,
+             keys: list,
+             cursor: Optional[str],
+             limit: Optional[int],
+             descending: bool = True,
+             key_values: Callable = None) -> Tuple[List, Optional[str]]:
+    """
+    Returns one page of rows ordered by the keyset columns along with the
+    cursor of the next page. The last key must be unique, usually the id.
+    """
+
+    limit = page_size(limit)
+    if key_values is None:
+        key_values = partial(_attribute_values, keys)
+
+    if cursor:
+        values = decode_cursor(cursor, keys)
+        if descending:
+            query = query.filter(tuple_(*keys) < tuple_(*values))
+        else:
+            query = query.filter(tuple_(*keys) > tuple_(*values))
+
+    query = query.order_by(*[key.desc() if descending else key.asc()
+                             for key in keys])
+    rows = query.limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(key_values(rows[-1]))
+
+    return rows, next_cursor
@@ -0,0 +1,180 @@
+""" Module configuring the database connection pools and measuring their checkouts """
+
+# Imports
+
+import bisect
+import time
+from threading import Lock
+from typing import Dict, List
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+from app.config import settings
+
+
+# Pool settings
+
+POOL_SIZE = settings.database_pool_size
+MAX_OVERFLOW = settings.database_max_overflow
+POOL_TIMEOUT_SECONDS = settings.database_pool_timeout_seconds
+POOL_RECYCLE_SECONDS = settings.database_pool_recycle_seconds
+POOL_PRE_PING = settings.database_pool_pre_ping
+STATEMENT_TIMEOUT_MS = settings.database_statement_timeout_ms
+PGBOUNCER = settings.database_pgbouncer
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# Checkout metrics
+#
+# Checkouts are timed from asking the pool for a connection to getting one,
+# which covers waiting for a connection to come back, opening a new one and
+# the pre-ping. Overflows are checkouts that found the pool_size connections
+# busy and opened one past them, timeouts are checkouts that gave up after
+# POOL_TIMEOUT_SECONDS.
+
+class PoolStats:
+    """ Checkout counts and wait times of a pool """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.checkouts = 0
+        self.overflows = 0
+        self.timeouts = 0
+        self.wait_counts = [0] * (len(WAIT_BUCKETS) + 1)
+        self.wait_sum = 0.0
+        self.wait_max = 0.0
+
+    def record_wait(self, seconds: float) -> None:
+        """ Records the wait of a checkout """
+
+        with self._lock:
+            self.checkouts += 1
+            self.wait_counts[bisect.bisect_left(WAIT_BUCKETS, seconds)] += 1
+            self.wait_sum += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def record_overflow(self) -> None:
+        with self._lock:
+            self.overflows += 1
+
+    def record_timeout(self) -> None:
+        with self._lock:
+            self.timeouts += 1
+
+    def snapshot(self) -> dict:
+        """ Returns the counts, and the wait histogram with cumulative buckets """
+
+        with self._lock:
+            buckets, total = {}, 0
+            for bound, count in zip([*map(str, WAIT_BUCKETS), "+Inf"], self.wait_counts):
+                total += count
+                buckets[bound] = total
+            return {"checkouts": self.checkouts,
+                    "overflows": self.overflows,
+                    "timeouts": self.timeouts,
+                    "wait_seconds": {"buckets": buckets,
+                                     "count": total,
+                                     "sum": self.wait_sum,
+                                     "max": self.wait_max}}
+
+
+class InstrumentedQueuePool(QueuePool):
+    """ QueuePool recording its checkouts in a PoolStats """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            connection = super().connect()
+        except exc.TimeoutError:
+            self.stats.record_timeout()
+            raise
+        self.stats.record_wait(time.perf_counter() - started)
+        return connection
+
+    def _inc_overflow(self):
+        # _overflow starts at -pool_size, so connections opened while it is
+        # positive are past the pool size
+        with self._overflow_lock:
+            if self._max_overflow != -1 and self._overflow >= self._max_overflow:
+                return False
+            self._overflow += 1
+            overflowed = self._overflow > 0
+        if overflowed:
+            self.stats.record_overflow()
+        return True
+
+    def recreate(self):
+        # Keep counting across Engine.dispose()
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+
+# Statement timeout
+#
+# A direct connection gets the timeout for its whole session. PgBouncer in
+# transaction pooling mode hands each transaction to whichever server
+# connection is free, so session settings would leak to other clients and
+# it refuses the startup option anyway. There the timeout is set with
+# SET LOCAL in front of the first statement of each transaction, in the
+# same round trip, and ends with it.
+
+def _set_local_timeout(conn, cursor, statement, parameters, context, executemany):
+    """ Prefixes the first statement of a transaction with its timeout """
+
+    dbapi_connection = cursor.connection
+    if not dbapi_connection.autocommit and \
+            dbapi_connection.get_transaction_status() == TRANSACTION_STATUS_IDLE:
+        statement = f"SET LOCAL statement_timeout = {STATEMENT_TIMEOUT_MS}; {statement}"
+    return statement, parameters
+
+
+# Engines
+
+_engines: Dict[str, Engine] = {}
+
+
+def create_pooled_engine(name: str, url: str) -> Engine:
+    """ Creates an engine with the configured pool, reported as name in stats() """
+
+    connect_args = {}
+    if STATEMENT_TIMEOUT_MS and not PGBOUNCER:
+        connect_args["options"] = f"-c statement_timeout={STATEMENT_TIMEOUT_MS}"
+
+    bound = create_engine(url,
+                          poolclass=InstrumentedQueuePool,
+                          pool_size=POOL_SIZE,
+                          max_overflow=MAX_OVERFLOW,
+                          pool_timeout=POOL_TIMEOUT_SECONDS,
+                          pool_recycle=POOL_RECYCLE_SECONDS,
+                          pool_pre_ping=POOL_PRE_PING,
+                          connect_args=connect_args)
+
+    if STATEMENT_TIMEOUT_MS and PGBOUNCER:
+        event.listen(bound, "before_cursor_execute", _set_local_timeout,
+                     retval=True)
+
+    _engines[name] = bound
+    return bound
+
+
+def stats() -> List[dict]:
+    """ Returns the live connection counts and checkout metrics of each pool """
+
+    pools = []
+    for name, bound in _engines.items():
+        pool = bound.pool
+        pools.append({"name": name,
+                      "size": pool.size(),
+                      "checked_out": pool.checkedout(),
+                      "idle": pool.checkedin(),
+                      "overflow": max(pool.overflow(), 0),
+                      "max_overflow": MAX_OVERFLOW,
+                      **pool.stats.snapshot()})
+    return pools
@@ -0,0 +1,238 @@
+"""
+Module profiling the SQL statements of each request, flagging N+1 query
+patterns and explaining slow statements
+"""
+
+# Imports
+
+import logging
+import os
+import re
+import secrets
+import sys
+import time
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+from sqlalchemy import event
+
+from app.cache.lru import LRUCache
+from app.config import settings
+from app.db.db_setup import engine, replica_engines
+
+
+# Profiling settings
+
+ENABLED = settings.sql_profiling
+N_PLUS_ONE_THRESHOLD = settings.sql_n_plus_one_threshold
+SLOW_QUERY_MS = settings.sql_slow_query_ms
+MAX_REPORTS = settings.sql_profile_reports
+REPORT_TTL_SECONDS = 3600
+STACK_DEPTH = 6
+PROFILE_HEADER = "X-SQL-Profile"
+
+logger = logging.getLogger(__name__)
+
+
+# Statement shapes
+#
+# Statements that differ only in their parameters have the same shape.
+# Parameters are bound separately, but expanding IN lists render one
+# placeholder per value and raw SQL may inline literals, so both are folded.
+
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|%s")
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_LIST = re.compile(r"\?(?:\s*,\s*\?)+")
+_SPACE = re.compile(r"\s+")
+
+
+def shape(statement: str) -> str:
+    """ Returns a statement with its parameters and literals replaced by ? """
+
+    folded = _PLACEHOLDER.sub("?", _LITERAL.sub("?", statement))
+    return _SPACE.sub(" ", _LIST.sub("?", folded)).strip()
+
+
+# Call sites
+#
+# Only frames in this app are kept, innermost first, so a lazy load shows
+# the serializer or handler that touched the relationship rather than
+# SQLAlchemy internals.
+
+_APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_ROOT_DIR = os.path.dirname(_APP_DIR)
+_OWN_FILES = {os.path.abspath(__file__)}
+
+
+def _call_site() -> List[str]:
+    """ Returns the innermost app frames of the current stack """
+
+    frames, frame = [], sys._getframe(2)  # pylint: disable=protected-access
+    while frame is not None and len(frames) < STACK_DEPTH:
+        filename = frame.f_code.co_filename
+        if filename.startswith(_APP_DIR) and filename not in _OWN_FILES:
+            frames.append(f"{os.path.relpath(filename, _ROOT_DIR)}:{frame.f_lineno}"
+                          f" in {frame.f_code.co_name}")
+        frame = frame.f_back
+    return frames
+
+
+# Per-request profiles
+
+class Profile:
+    """ Statements issued while serving a request """
+
+    __slots__ = ("id", "statements")
+
+    def __init__(self):
+        self.id = secrets.token_hex(8)
+        self.statements: List[dict] = []
+
+    def n_plus_one(self) -> List[dict]:
+        """ Returns the statement shapes repeated at least N_PLUS_ONE_THRESHOLD times """
+
+        groups: Dict[str, dict] = {}
+        for statement in self.statements:
+            group = groups.setdefault(shape(statement["sql"]), {
+                "count": 0, "ms": 0.0, "stack": statement["stack"]})
+            group["count"] += 1
+            group["ms"] += statement["ms"]
+
+        return [{"shape": statement_shape, **group}
+                for statement_shape, group in groups.items()
+                if group["count"] >= N_PLUS_ONE_THRESHOLD]
+
+    def report(self, method: str, path: str, status: int) -> dict:
+        """ Returns the statements, their total time and the N+1 patterns """
+
+        return {"id": self.id,
+                "method": method,
+                "path": path,
+                "status": status,
+                "query_count": len(self.statements),
+                "query_ms": sum(statement["ms"] for statement in self.statements),
+                "n_plus_one": self.n_plus_one(),
+                "statements": self.statements}
+
+
+_profile: ContextVar[Optional[Profile]] = ContextVar("sql_profile", default=None)
+_reports = LRUCache(maxsize=MAX_REPORTS, ttl=REPORT_TTL_SECONDS)
+
+
+def get_report(report_id: str) -> Optional[dict]:
+    """ Returns a recent request's report by the id sent in its header """
+    return _reports.get(report_id)
+
+
+# Statement hooks
+#
+# The statement is taken from the execution context when there is one, as
+# listeners such as the PgBouncer statement timeout may have prefixed the
+# one sent.
+
+_EXPLAINABLE = re.compile(r"^\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b", re.IGNORECASE)
+
+
+def _start_statement(conn, cursor, statement, parameters, context, executemany):
+    if SLOW_QUERY_MS or (ENABLED and _profile.get() is not None):
+        conn.info["profile_started"] = time.perf_counter()
+
+
+def _end_statement(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop("profile_started", None)
+    if started is None:
+        return
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    sql = context.statement if context is not None else statement
+
+    profile = _profile.get()
+    if profile is not None:
+        profile.statements.append({"sql": sql,
+                                   "ms": elapsed_ms,
+                                   "rows": cursor.rowcount,
+                                   "stack": _call_site()})
+
+    if SLOW_QUERY_MS and elapsed_ms >= SLOW_QUERY_MS:
+        plan = None
+        if not executemany and _EXPLAINABLE.match(sql):
+            plan = _explain(cursor.connection, sql, parameters)
+        # Parameters are left out, they may hold password hashes
+        logger.warning("Slow statement took %.1fms at %s\n%s%s",
+                       elapsed_ms, " < ".join(_call_site()[:3]) or "unknown",
+                       sql, f"\n{plan}" if plan else "")
+
+
+def _explain(dbapi_connection: any, sql: str, parameters: any) -> Optional[str]:
+    """
+    Returns the plan of a statement, run in a savepoint so that a failure
+    leaves the request's transaction as it was
+    """
+
+    in_transaction = not dbapi_connection.autocommit
+    try:
+        with dbapi_connection.cursor() as cursor:
+            if in_transaction:
+                cursor.execute("SAVEPOINT sql_profile_explain")
+            try:
+                cursor.execute(f"EXPLAIN {sql}", parameters)
+                plan = "\n".join(row[0] for row in cursor.fetchall())
+            except Exception:
+                if in_transaction:
+                    cursor.execute("ROLLBACK TO SAVEPOINT sql_profile_explain")
+                raise
+            if in_transaction:
+                cursor.execute("RELEASE SAVEPOINT sql_profile_explain")
+            return plan
+    except Exception as exc:  # pylint: disable=broad-except
+        logger.debug("Could not explain a slow statement: %s", exc)
+        return None
+
+
+if ENABLED or SLOW_QUERY_MS:
+    for bound in [engine, *replica_engines]:
+        event.listen(bound, "before_cursor_execute", _start_statement)
+        event.listen(bound, "after_cursor_execute", _end_statement)
+
+
+# Middleware
+
+class SQLProfilingMiddleware:
+    """
+    ASGI middleware profiling the statements of each request. The response
+    gets a summary header with the report's id, the full report is served
+    at /debug/sql/{report_id} and N+1 patterns are logged.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        profile = Profile()
+        token = _profile.set(profile)
+
+        async def send_with_profile(message):
+            if message["type"] == "http.response.start":
+                report = profile.report(scope["method"], scope["path"], message["status"])
+                _reports.set(profile.id, report)
+
+                for pattern in report["n_plus_one"]:
+                    logger.warning("%s %s repeated a statement %d times, N+1 at %s: %s",
+                                   scope["method"], scope["path"], pattern["count"],
+                                   " < ".join(pattern["stack"][:3]) or "unknown",
+                                   pattern["shape"])
+
+                summary = (f"id={profile.id}; queries={report['query_count']}; "
+                           f"ms={report['query_ms']:.1f}; "
+                           f"n_plus_one={len(report['n_plus_one'])}")
+                message["headers"] = list(message.get("headers", [])) + [
+                    (PROFILE_HEADER.lower().encode(), summary.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_profile)
+        finally:
+            _profile.reset(token)
@@ -0,0 +1,259 @@
+""" Module routing the sessions of read-only routes to read replicas """
+
+# Imports
+
+import hashlib
+import logging
+import time
+from itertools import count
+from threading import Event, Thread
+from typing import List, Optional
+from anyio import to_thread
+from fastapi import Request
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from starlette.datastructures import Headers
+
+from app.cache import bus
+from app.cache.lru import LRUCache
+from app.config import settings
+from app.db.db_setup import SessionLocal, engine, replica_engines
+
+
+# Replica settings
+
+MAX_LAG_SECONDS = settings.replica_max_lag_seconds
+CHECK_SECONDS = settings.replica_check_seconds
+STICKY_SECONDS = settings.replica_sticky_seconds
+MAX_STICKY_CLIENTS = 100000
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+logger = logging.getLogger(__name__)
+
+
+# Replica health
+#
+# A monitor thread measures the replay lag of each replica every
+# CHECK_SECONDS. Replicas failing the check, lagging more than
+# MAX_LAG_SECONDS or dropping a connection are skipped until a check passes
+# again, and with no replica left reads go to the primary. A replica
+# streaming from the primary that replayed all the WAL it received has no
+# lag, even if the primary was idle. After a restart its receiver starts
+# again from the beginning of the last WAL segment, behind what was
+# replayed. A replica whose receiver is not streaming has an unknown lag,
+# however much it replayed, and is skipped too. Reading the receiver's
+# status takes the pg_read_all_stats role.
+
+LAG_QUERY = text("""
+    SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0
+                WHEN NOT EXISTS (SELECT FROM pg_stat_wal_receiver
+                                 WHERE status = 'streaming') THEN NULL
+                WHEN pg_last_wal_receive_lsn() <= pg_last_wal_replay_lsn() THEN 0
+                ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+           END
+""")
+
+
+class Replica:
+    """ A read replica and its health as of the last check """
+
+    def __init__(self, name: str, bound: Engine):
+        self.name = name
+        self.engine = bound
+        self.healthy = False
+        self.lag: Optional[float] = None
+
+    def check(self) -> None:
+        """ Measures the replica's lag, marking it healthy if known and small enough """
+
+        try:
+            with self.engine.connect() as connection:
+                lag = connection.execute(LAG_QUERY).scalar()
+        except Exception as exc:
+            if self.healthy:
+                logger.warning("Replica %s failed its check: %s",
+                               self.engine.url.host, exc)
+            self.healthy, self.lag = False, None
+            return
+
+        if lag is None:
+            if self.healthy:
+                logger.warning("Replica %s is not streaming from the primary, "
+                               "reading from the primary", self.engine.url.host)
+            self.healthy, self.lag = False, None
+            return
+
+        lag = float(lag)
+        if self.healthy and lag > MAX_LAG_SECONDS:
+            logger.warning("Replica %s is %.1fs behind, reading from the primary",
+                           self.engine.url.host, lag)
+        self.healthy, self.lag = lag <= MAX_LAG_SECONDS, lag
+
+
+_replicas = [Replica(f"replica-{number}", bound)
+             for number, bound in enumerate(replica_engines, 1)]
+_turns = count()
+
+
+def stats() -> List[dict]:
+    """ Returns the health and lag of each replica as of its last check """
+    return [{"name": replica.name, "healthy": replica.healthy, "lag_seconds": replica.lag}
+            for replica in _replicas]
+
+
+def _skip_disconnected(context: any) -> None:
+    """ Stops reading from a replica as soon as one of its connections drops """
+
+    if context.is_disconnect:
+        for replica in _replicas:
+            if replica.engine is context.engine:
+                replica.healthy = False
+
+
+for _replica in _replicas:
+    event.listen(_replica.engine, "handle_error", _skip_disconnected)
+
+
+def _pick() -> Engine:
+    """ Returns the next healthy replica in turn, the primary if there is none """
+
+    healthy = [replica for replica in _replicas if replica.healthy]
+    if not healthy:
+        return engine
+    return healthy[next(_turns) % len(healthy)].engine
+
+
+def staleness(db: Session) -> float:
+    """ Returns how many seconds a session's reads may lag behind the primary """
+
+    bound = db.get_bind()
+    for replica in _replicas:
+        if replica.engine is bound:
+            lag = MAX_LAG_SECONDS if replica.lag is None else replica.lag
+            return lag + CHECK_SECONDS
+    return 0.0
+
+
+# Read your writes
+#
+# Clients read from the primary for STICKY_SECONDS after each successful
+# write, so they see their own changes however far the replicas lag.
+# Clients are told apart by a hash of their Authorization header, shared
+# with the other workers through the invalidation bus. A worker that may
+# have missed messages reads everything from the primary for a while.
+
+_sticky = LRUCache(maxsize=MAX_STICKY_CLIENTS, ttl=STICKY_SECONDS)
+_everyone_sticky_until = {"at": 0.0}
+
+
+def _client_key(authorization: str) -> str:
+    return hashlib.sha256(authorization.encode()).hexdigest()[:32]
+
+
+def _stick(keys: list) -> None:
+    for key in keys:
+        _sticky.set(key, True)
+
+
+def _stick_everyone() -> None:
+    _everyone_sticky_until["at"] = time.monotonic() + STICKY_SECONDS
+
+
+bus.subscribe("sticky", _stick, _stick_everyone)
+
+
+def _is_sticky(authorization: Optional[str]) -> bool:
+    if time.monotonic() < _everyone_sticky_until["at"]:
+        return True
+    return authorization is not None and \
+        _sticky.get(_client_key(authorization)) is not None
+
+
+class ReadYourWritesMiddleware:
+    """
+    ASGI middleware pinning a client's reads to the primary after each of
+    their requests that may have written succeeds
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not _replicas or \
+                scope["method"] in SAFE_METHODS:
+            await self.app(scope, receive, send)
+            return
+
+        authorization = Headers(scope=scope).get("authorization")
+        if authorization is None:
+            await self.app(scope, receive, send)
+            return
+
+        key = _client_key(authorization)
+
+        async def send_marking_writer(message):
+            # Mark before the client sees the response and reads again
+            if message["type"] == "http.response.start" and message["status"] < 400:
+                _stick([key])
+                if bus.ENABLED:
+                    await to_thread.run_sync(bus.publish, "sticky", [key])
+            await send(message)
+
+        await self.app(scope, receive, send_marking_writer)
+
+
+# Sessions
+
+def get_read_db(request: Request) -> any:
+    """
+    Gets a database session for a read-only route, on a healthy replica
+    unless the client wrote recently
+    """
+
+    if not _replicas or _is_sticky(request.headers.get("authorization")):
+        bound = engine
+    else:
+        bound = _pick()
+
+    db = SessionLocal(bind=bound)
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+# Monitor
+
+_stop = Event()
+_monitor: Optional[Thread] = None
+
+
+def _check_periodically() -> None:
+    """ Monitor thread loop """
+
+    while not _stop.is_set():
+        for replica in _replicas:
+            replica.check()
+        _stop.wait(CHECK_SECONDS)
+
+
+def start_monitor() -> None:
+    """ Starts checking the replicas when there are any """
+
+    global _monitor
+    if _replicas and _monitor is None:
+        _stop.clear()
+        _monitor = Thread(target=_check_periodically, name="replica-monitor",
+                          daemon=True)
+        _monitor.start()
+
+
+def stop_monitor() -> None:
+    """ Stops checking the replicas """
+
+    global _monitor
+    if _monitor is not None:
+        _stop.set()
+        _monitor.join()
+        _monitor = None
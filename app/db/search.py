@@ -0,0 +1,76 @@
+""" Module searching users through indexed full text and username prefix queries """
+
+# Imports
+
+import re
+from typing import List, Optional, Tuple
+from sqlalchemy import Float, String, cast, func
+from sqlalchemy.orm import Session
+
+from app.db import models, pagination
+
+
+# Search modes
+#
+# Full text search matches whole words of usernames, names and descriptions
+# against the GIN indexed Users.search_vector, the last word as a prefix so
+# results follow the user's typing, and orders them by relevance.
+# Type-ahead only matches the start of usernames, reading
+# ix_Users_username_prefix in order so even one letter prefixes stop after
+# a page. Both page by keyset, never returning more than one page.
+
+SEARCH_CONFIG = "simple"
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def _ts_query(search: str) -> Optional[str]:
+    """ Turns free text into a tsquery matching all words, the last as a prefix """
+
+    words = WORD_PATTERN.findall(search.lower())
+    if not words:
+        return None
+    return " & ".join(words) + ":*"
+
+
+def _escape_like(value: str) -> str:
+    """ Escapes LIKE wildcards so they match literally """
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _page(db: Session, keys: list, query_filter: any,
+          cursor: Optional[str], limit: Optional[int],
+          descending: bool) -> Tuple[List[models.User], Optional[str]]:
+    """ Pages users along with their keyset values, which are expressions """
+
+    query = db.query(models.User, *keys).filter(query_filter)
+    rows, next_cursor = pagination.paginate(
+        query, keys, cursor, limit, descending=descending,
+        key_values=lambda row: list(row[1:]))
+    return [row.User for row in rows], next_cursor
+
+
+def full_text(db: Session, search: str, cursor: Optional[str],
+              limit: Optional[int]) -> Tuple[List[models.User], Optional[str]]:
+    """ Returns one page of users matching the words of a search, best first """
+
+    ts_query = _ts_query(search)
+    if ts_query is None:
+        return [], None
+
+    query = func.to_tsquery(SEARCH_CONFIG, ts_query)
+    # Ranks are real, whose text form does not round trip through cursors
+    rank = cast(func.ts_rank(models.User.search_vector, query), Float)
+    return _page(db, [rank, models.User.id],
+                 models.User.search_vector.op("@@")(query),
+                 cursor, limit, descending=True)
+
+
+def type_ahead(db: Session, prefix: str, cursor: Optional[str],
+               limit: Optional[int]) -> Tuple[List[models.User], Optional[str]]:
+    """ Returns one page of users whose username starts with a prefix, alphabetically """
+
+    username = func.lower(models.User.username, type_=String).collate("C")
+    return _page(db, [username, models.User.id],
+                 username.like(_escape_like(prefix.strip().lower()) + "%",
+                               escape="\\"),
+                 cursor, limit, descending=False)
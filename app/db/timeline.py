@@ -0,0 +1,224 @@
+""" Module maintaining the materialized home timelines used by the feed """
+
+# Imports
+
+import logging
+import time
+from threading import Event, Lock, Thread
+from typing import Optional
+from sqlalchemy import delete, literal, select, true, tuple_, union_all
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from app.db import models
+from app.db.db_setup import SessionLocal
+from app.config import settings
+
+
+# Timeline settings
+
+FANOUT_LIMIT = settings.timeline_fanout_limit
+MAX_LENGTH = settings.timeline_max_length
+CELEBRITY_REFRESH_SECONDS = settings.timeline_celebrity_refresh_seconds
+TRIM_SECONDS = settings.timeline_trim_seconds
+TRIM_BATCH_SIZE = settings.timeline_trim_batch_size
+
+logger = logging.getLogger(__name__)
+
+_celebrities = {"ids": frozenset(), "expires_at": 0.0}
+_celebrities_lock = Lock()
+
+
+# Fan-out-on-read authors
+
+def celebrity_ids(db: Session) -> frozenset:
+    """
+    Returns the ids of authors with more followers than the fan-out limit.
+    Their posts are not pushed into timelines but read from Posts directly.
+    The set is refreshed periodically so writers and readers agree on it.
+    """
+
+    with _celebrities_lock:
+        if _celebrities["expires_at"] > time.monotonic():
+            return _celebrities["ids"]
+
+        rows = db.execute(
+            select(models.User.id).
+            where(models.User.follower_count > FANOUT_LIMIT)).scalars().all()
+
+        _celebrities["ids"] = frozenset(rows)
+        _celebrities["expires_at"] = time.monotonic() + \
+            CELEBRITY_REFRESH_SECONDS
+        return _celebrities["ids"]
+
+
+# Timeline writes
+
+def fan_out_post(db: Session, post: models.Post) -> None:
+    """ Pushes a new post into its author's and followers' timelines """
+
+    db.flush()
+    posts = models.Post.__table__
+    entry = [posts.c.id, posts.c.author_id, posts.c.created_at]
+
+    own_timeline = select(posts.c.author_id, *entry).\
+        where(posts.c.id == post.id)
+    timelines = own_timeline
+
+    if post.author_id not in celebrity_ids(db):
+        follower_timelines = select(models.user_follow.c.user_id, *entry).\
+            join(models.user_follow,
+                 models.user_follow.c.following_id == posts.c.author_id).\
+            where(posts.c.id == post.id)
+        timelines = union_all(own_timeline, follower_timelines)
+
+    db.execute(insert(models.TimelineEntry).
+               from_select(["user_id", "post_id", "author_id", "created_at"],
+                           timelines).
+               on_conflict_do_nothing())
+
+
+def backfill(db: Session, user_id: int, author_id: int) -> None:
+    """ Adds an author's most recent posts to a new follower's timeline """
+
+    if author_id in celebrity_ids(db):
+        return
+
+    posts = models.Post.__table__
+    recent_posts = select(literal(user_id), posts.c.id,
+                          posts.c.author_id, posts.c.created_at).\
+        where(posts.c.author_id == author_id).\
+        order_by(posts.c.created_at.desc()).\
+        limit(MAX_LENGTH)
+
+    db.execute(insert(models.TimelineEntry).
+               from_select(["user_id", "post_id", "author_id", "created_at"],
+                           recent_posts).
+               on_conflict_do_nothing())
+    trim(db, select(literal(user_id).label("user_id")))
+
+
+def prune(db: Session, user_id: int, author_id: int) -> None:
+    """ Removes an author's posts from a former follower's timeline """
+
+    db.execute(delete(models.TimelineEntry).
+               where(models.TimelineEntry.user_id == user_id,
+                     models.TimelineEntry.author_id == author_id))
+
+
+# Timeline trimming
+#
+# Fan-out only inserts, so timelines grow past MAX_LENGTH between trims.
+# A trimmer thread walks the users TIMELINE_TRIM_BATCH_SIZE at a time, a
+# batch every TIMELINE_TRIM_SECONDS, and drops the entries of their
+# timelines past the newest MAX_LENGTH. Reads never go past MAX_LENGTH, so
+# entries waiting for a trim are never shown. A backfill adds up to
+# MAX_LENGTH entries at once and trims its one timeline right away.
+
+_stop = Event()
+_trimmer: Optional[Thread] = None
+
+
+def trim(db: Session, user_ids: any) -> None:
+    """
+    Deletes the entries past the newest MAX_LENGTH of the timelines of the
+    users selected, walking each timeline newest first on its index
+    """
+
+    timelines = models.TimelineEntry.__table__
+    owners = user_ids.subquery("owners")
+    overflow = select(timelines.c.post_id).\
+        where(timelines.c.user_id == owners.c.user_id).\
+        order_by(timelines.c.created_at.desc(), timelines.c.post_id.desc()).\
+        offset(MAX_LENGTH).\
+        lateral("overflow")
+    excess = select(owners.c.user_id, overflow.c.post_id).\
+        select_from(owners.join(overflow, true()))
+
+    db.execute(delete(models.TimelineEntry).
+               where(tuple_(models.TimelineEntry.user_id,
+                            models.TimelineEntry.post_id).in_(excess)).
+               execution_options(synchronize_session=False))
+
+
+def trim_batch(after_id: int) -> Optional[int]:
+    """
+    Trims the timelines of the next users by id, returning the last id
+    trimmed or None once every user was
+    """
+
+    with SessionLocal() as db:
+        user_ids = db.execute(select(models.User.id).
+                              where(models.User.id > after_id).
+                              order_by(models.User.id).
+                              limit(TRIM_BATCH_SIZE)).scalars().all()
+        if not user_ids:
+            return None
+
+        trim(db, select(models.User.id.label("user_id")).
+             where(models.User.id.in_(user_ids)))
+        db.commit()
+        return user_ids[-1]
+
+
+def _trim_periodically() -> None:
+    """ Trimmer thread loop, starting over once every user was trimmed """
+
+    after_id = 0
+    while not _stop.wait(TRIM_SECONDS):
+        try:
+            after_id = trim_batch(after_id) or 0
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Could not trim timelines, retrying")
+
+
+def start_trimmer() -> None:
+    """ Starts trimming timelines in the background """
+
+    global _trimmer
+    if _trimmer is None:
+        _stop.clear()
+        _trimmer = Thread(target=_trim_periodically, name="timeline-trimmer",
+                          daemon=True)
+        _trimmer.start()
+
+
+def stop_trimmer() -> None:
+    """ Stops trimming timelines """
+
+    global _trimmer
+    if _trimmer is not None:
+        _stop.set()
+        _trimmer.join()
+        _trimmer = None
+
+
+# Timeline reads
+
+def feed_post_ids(db: Session, user_id: int) -> any:
+    """
+    Returns a select of the post ids on a user's home timeline, combining
+    the materialized entries with posts from followed fan-out-on-read authors
+    """
+
+    timeline = select(models.TimelineEntry.post_id).\
+        where(models.TimelineEntry.user_id == user_id).\
+        order_by(models.TimelineEntry.created_at.desc()).\
+        limit(MAX_LENGTH)
+
+    celebrities = celebrity_ids(db)
+    if not celebrities:
+        return timeline
+
+    followed_celebrities = select(models.user_follow.c.following_id).\
+        where(models.user_follow.c.user_id == user_id,
+              models.user_follow.c.following_id.in_(celebrities))
+    celebrity_posts = select(models.Post.id).\
+        where(models.Post.author_id.in_(followed_celebrities),
+              models.Post.published == True,
+              models.Post.status == models.PostStatus.READY).\
+        order_by(models.Post.created_at.desc()).\
+        limit(MAX_LENGTH)
+
+    return union_all(select(timeline.subquery()),
+                     select(celebrity_posts.subquery()))
@@ -0,0 +1,150 @@
+""" Module keeping an in-memory index of the media urls that may be served """
+
+# Imports
+
+import time
+from threading import Lock
+from sqlalchemy import select, union_all
+
+from app.cache import bus
+from app.cache.lru import LRUCache
+from app.config import settings
+from app.db import models
+from app.db.db_setup import SessionLocal
+from app.images import storage
+
+
+# Index settings
+
+REFRESH_SECONDS = settings.media_index_refresh_seconds
+MISS_SECONDS = settings.media_index_miss_seconds
+MAX_MISSES = 10000
+
+_index = {"urls": None, "expires_at": 0.0, "removed": None}
+_index_lock = Lock()
+
+# Urls recently looked up and not found, so that requests repeating a
+# missing url do not each query the database
+_misses = LRUCache(maxsize=MAX_MISSES, ttl=MISS_SECONDS)
+
+
+# Loading the index
+
+def _servable_urls():
+    """ Returns a select of every media url belonging to a ready post or a user """
+
+    return union_all(
+        select(models.Post.image_url).
+        where(models.Post.status == models.PostStatus.READY),
+        select(models.User.profile_pic).
+        where(models.User.profile_pic.isnot(None)))
+
+
+def _rebuild() -> None:
+    """
+    Reloads the index from the database. Urls discarded while the query
+    runs stay discarded, urls added meanwhile are found again on a miss.
+    """
+
+    _index["removed"] = set()
+    try:
+        with SessionLocal() as db:
+            urls = set(db.execute(_servable_urls()).scalars())
+        _index["urls"] = urls - _index["removed"]
+        _index["expires_at"] = time.monotonic() + REFRESH_SECONDS
+    finally:
+        _index["removed"] = None
+
+
+def _current_urls() -> set:
+    """
+    Returns the indexed urls. The first caller builds the index, once it
+    is stale one caller rebuilds it while the others keep using it.
+    """
+
+    if _index["urls"] is None:
+        with _index_lock:
+            if _index["urls"] is None:
+                _rebuild()
+
+    elif _index["expires_at"] <= time.monotonic() and \
+            _index_lock.acquire(blocking=False):
+        try:
+            _rebuild()
+        finally:
+            _index_lock.release()
+
+    return _index["urls"]
+
+
+# Index lookups and updates
+
+def contains(url: str) -> bool:
+    """
+    Checks a media url may be served. Urls missing from the index, such as
+    ones added by another worker since the last rebuild, are looked up in
+    the database unless they are not media names at all or were just
+    looked up and not found.
+    """
+
+    if not storage.is_media_name(url.rsplit("/", 1)[-1]):
+        return False
+
+    if url in _current_urls():
+        return True
+
+    if _misses.get(url) is not None:
+        return False
+
+    version = _misses.version
+    servable = _servable_urls().subquery()
+    with SessionLocal() as db:
+        found = db.execute(select(servable).
+                           where(servable.c.image_url == url).
+                           limit(1)).first() is not None
+
+    if found:
+        add(url)
+    else:
+        _misses.set(url, url, version=version)
+    return found
+
+
+def add(url: str) -> None:
+    """ Marks a media url as servable """
+
+    _misses.invalidate(lambda missed_url: missed_url == url)
+    urls = _index["urls"]
+    if urls is not None:
+        urls.add(url)
+
+
+def _forget(urls: list) -> None:
+    """ Stops serving media urls from this worker """
+
+    removed = _index["removed"]
+    if removed is not None:
+        removed.update(urls)
+
+    indexed = _index["urls"]
+    if indexed is not None:
+        indexed.difference_update(urls)
+
+
+def _reset() -> None:
+    """ Drops the index, the next lookup rebuilds it """
+    _index["urls"] = None
+
+
+def discard(*urls: str) -> None:
+    """
+    Stops serving media urls, from other workers once the invalidation bus
+    delivers it or without the bus at their next rebuild
+    """
+
+    urls = [url for url in urls if url]
+    _forget(urls)
+    bus.publish("media", urls)
+
+
+bus.subscribe("media", _forget, _reset)
@@ -0,0 +1,332 @@
+""" Module running image processing jobs on a pool of worker processes """
+
+# Imports
+
+import logging
+import multiprocessing
+import os
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+from threading import BoundedSemaphore, Lock
+from typing import Callable, Optional
+from fastapi import HTTPException, status
+from sqlalchemy import func, or_, update
+
+from app.cache import responses as response_cache
+from app.config import settings
+from app.db import models
+from app.db.db_setup import SessionLocal
+from app.images import index as media_index
+from app.images import processing, storage
+from app.metrics import registry
+
+
+# Job settings
+
+WORKERS = settings.image_workers
+QUEUE_DEPTH = settings.image_queue_depth
+RETRIES = settings.image_job_retries
+WORKER_NICENESS = settings.image_worker_niceness
+MAX_TRACKED_JOBS = 10000
+RESUME_CLAIM_AFTER = timedelta(seconds=60)
+
+logger = logging.getLogger(__name__)
+
+PROCESSING_SECONDS = registry.histogram(
+    "chitros_image_processing_duration_seconds",
+    "Time a worker process took to resize an upload into its variants",
+    ["kind"])
+JOBS = registry.counter(
+    "chitros_image_jobs_total",
+    "Image jobs finished, by outcome",
+    ["kind", "status"])
+
+
+# Job states
+
+class JobStatus:
+    """ States an image job goes through """
+    PROCESSING = "processing"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class Job:
+    """ An image processing job and the action to run once it is done """
+
+    def __init__(self, kind: str, func: Callable, args: tuple,
+                 on_done: Callable, on_failed: Callable):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.func = func
+        self.args = args
+        self.on_done = on_done
+        self.on_failed = on_failed
+        self.status = JobStatus.PROCESSING
+        self.attempts = 0
+        self.error: Optional[str] = None
+        self.duration: Optional[float] = None
+
+
+_jobs: "OrderedDict[str, Job]" = OrderedDict()
+_jobs_lock = Lock()
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = Lock()
+_slots = BoundedSemaphore(WORKERS + QUEUE_DEPTH)
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    """ Starts the worker processes on first use """
+
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=processing.lower_priority,
+                initargs=(WORKER_NICENESS,))
+        return _pool
+
+
+def _discard_pool(pool: ProcessPoolExecutor) -> None:
+    """ Drops a pool whose worker died so the next job starts a fresh one """
+
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def get_job(job_id: str) -> Optional[Job]:
+    """ Returns a tracked job by id """
+
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+def shutdown() -> None:
+    """ Stops the worker processes, letting queued jobs finish """
+
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True)
+            _pool = None
+
+
+# Running jobs
+
+def _submit(job: Job) -> None:
+    """ Sends a job attempt to the worker processes """
+
+    job.attempts += 1
+    pool = _get_pool()
+    future = pool.submit(job.func, *job.args)
+    future.add_done_callback(lambda done: _finish(job, pool, done))
+
+
+def _finish(job: Job, pool: ProcessPoolExecutor, future: Future) -> None:
+    """ Records the outcome of a job attempt, retrying failed attempts """
+
+    error = future.exception()
+    if isinstance(error, BrokenProcessPool):
+        _discard_pool(pool)
+
+    if error is not None and job.attempts <= RETRIES:
+        logger.warning("Image job %s failed (attempt %d), retrying: %s",
+                       job.id, job.attempts, error)
+        try:
+            _submit(job)
+            return
+        except RuntimeError as exc:
+            error = exc
+
+    try:
+        if error is None:
+            job.duration = future.result()
+            PROCESSING_SECONDS.labels(job.kind).observe(job.duration)
+            job.on_done()
+            job.status = JobStatus.DONE
+        else:
+            logger.error("Image job %s failed: %s", job.id, error)
+            job.error = str(error)
+            job.on_failed()
+            job.status = JobStatus.FAILED
+    except Exception as exc:  # pylint: disable=broad-except
+        logger.exception("Image job %s could not be recorded", job.id)
+        job.error = str(exc)
+        job.status = JobStatus.FAILED
+    finally:
+        JOBS.labels(job.kind, job.status).inc()
+        _slots.release()
+
+
+def run(kind: str, func: Callable, args: tuple,
+        on_done: Callable, on_failed: Callable) -> Job:
+    """
+    Queues a job on the worker processes. Fails fast with a 503 when every
+    worker is busy and the queue is full.
+    """
+
+    if not _slots.acquire(blocking=False):
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Too many uploads in progress, try again",
+                            headers={"Retry-After": "5"})
+
+    job = Job(kind, func, args, on_done, on_failed)
+    with _jobs_lock:
+        _jobs[job.id] = job
+        while len(_jobs) > MAX_TRACKED_JOBS:
+            _jobs.popitem(last=False)
+
+    try:
+        _submit(job)
+    except Exception:
+        _slots.release()
+        raise
+
+    return job
+
+
+# Job kinds
+
+def _set_post_status(post_id: int, post_status: str) -> Optional[int]:
+    """ Updates the processing state of a post, returning its author's id """
+
+    with SessionLocal() as db:
+        author_id = db.execute(update(models.Post).
+                               where(models.Post.id == post_id).
+                               values(status=post_status).
+                               returning(models.Post.author_id).
+                               execution_options(synchronize_session=False)).scalar()
+        db.commit()
+        return author_id
+
+
+def _publish_post(post_id: int, image_url: str) -> None:
+    """ Marks a post ready and starts serving its image """
+
+    author_id = _set_post_status(post_id, models.PostStatus.READY)
+    media_index.add(image_url)
+    if author_id is not None:
+        response_cache.invalidate(response_cache.feed_tag(author_id))
+
+
+def _release_blob(url: str) -> None:
+    """ Drops the reference an unfinished job held on a blob """
+
+    with SessionLocal() as db:
+        storage.release(db, url)
+        db.commit()
+
+
+def _set_profile_picture(user_id: int, profile_pic: str) -> None:
+    """
+    Points a user's profile at their processed picture. The job's
+    reference on the picture passes to the user, who drops the reference
+    on their previous picture.
+    """
+
+    with SessionLocal() as db:
+        user = db.query(models.User.username, models.User.profile_pic).\
+            filter(models.User.id == user_id).with_for_update().first()
+        if user is None or user.profile_pic == profile_pic:
+            storage.release(db, profile_pic)
+            db.commit()
+            return
+
+        username, previous = user.username, user.profile_pic
+        db.execute(update(models.User).
+                   where(models.User.id == user_id).
+                   values(profile_pic=profile_pic).
+                   execution_options(synchronize_session=False))
+        storage.release(db, previous)
+        db.commit()
+        response_cache.invalidate_user(db, user_id, username)
+
+    media_index.add(profile_pic)
+    media_index.discard(previous)
+
+
+def process_post_image(post_id: int, upload_path: str,
+                       path: str, image_url: str) -> Job:
+    """ Processes a post's image, publishing the post once it is ready """
+
+    return run("post_image", processing.process_post_image,
+               (upload_path, path),
+               on_done=lambda: _publish_post(post_id, image_url),
+               on_failed=lambda: _set_post_status(
+                   post_id, models.PostStatus.FAILED))
+
+
+def process_profile_picture(user_id: int, upload_path: str,
+                            path: str, profile_pic: str) -> Job:
+    """ Processes a profile picture, switching to it once it is ready """
+
+    return run("profile_picture", processing.process_profile_picture,
+               (upload_path, path),
+               on_done=lambda: _set_profile_picture(user_id, profile_pic),
+               on_failed=lambda: _release_blob(profile_pic))
+
+
+def _claim_pending() -> list:
+    """
+    Claims the posts left processing that no worker queued in the last
+    RESUME_CLAIM_AFTER, returning their ids and image urls. Uploads are
+    stamped when queued, so jobs still running on live workers are left
+    to them.
+    """
+
+    with SessionLocal() as db:
+        posts = db.execute(update(models.Post).
+                           where(models.Post.status == models.PostStatus.PROCESSING,
+                                 or_(models.Post.resume_claimed_at.is_(None),
+                                     models.Post.resume_claimed_at <
+                                     func.now() - RESUME_CLAIM_AFTER)).
+                           values(resume_claimed_at=func.now()).
+                           returning(models.Post.id, models.Post.image_url).
+                           execution_options(synchronize_session=False)).all()
+        db.commit()
+        return posts
+
+
+def _release_claims(post_ids: list) -> None:
+    """ Lets the next worker to start requeue posts this one could not """
+
+    with SessionLocal() as db:
+        db.execute(update(models.Post).
+                   where(models.Post.id.in_(post_ids)).
+                   values(resume_claimed_at=None).
+                   execution_options(synchronize_session=False))
+        db.commit()
+
+
+def resume_pending() -> None:
+    """
+    Requeues posts left processing by a restart, failing lost uploads.
+    Every worker runs it on startup, each post is claimed by the first, and
+    one queued by a worker that died before finishing it is requeued at a
+    restart at least RESUME_CLAIM_AFTER after it was queued.
+    """
+
+    posts = _claim_pending()
+    for number, (post_id, image_url) in enumerate(posts):
+        path = storage.path_for(image_url)
+        upload_path = path + storage.UPLOAD_SUFFIX
+        if not os.path.exists(upload_path) and not os.path.exists(path):
+            _set_post_status(post_id, models.PostStatus.FAILED)
+            continue
+
+        try:
+            process_post_image(post_id, upload_path, path, image_url)
+        except HTTPException:
+            logger.warning("Image queue full, leaving %d posts processing "
+                           "until the next restart", len(posts) - number)
+            _release_claims([post_id for post_id, _ in posts[number:]])
+            return
+
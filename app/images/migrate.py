@@ -0,0 +1,146 @@
+"""
+Moves media stored under the old flat, timestamped names into content
+addressed blobs and rewrites the image_url and profile_pic columns to match
+
+Usage - python -m app.images.migrate [--batch-size 500]
+"""
+
+# Imports
+
+import argparse
+import hashlib
+import logging
+import os
+import shutil
+from typing import List, Optional
+from sqlalchemy import bindparam, func, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from app.db import models
+from app.db.db_setup import SessionLocal
+from app.images import storage, variants
+
+logger = logging.getLogger(__name__)
+
+
+# Media columns, with the sizes stored for each
+
+MEDIA_COLUMNS = [
+    (models.Post.__table__.c.image_url, "media/posts", variants.POST_IMAGE_SIZES),
+    (models.User.__table__.c.profile_pic, "media/users", variants.PROFILE_PICTURE_SIZES),
+]
+
+
+# Moving files
+
+def _file_digest(path: str) -> str:
+    """ Returns the sha256 of a file's bytes """
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(storage.CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _variant_files(path: str, sizes: dict) -> List[str]:
+    """ Returns the files of an image's variants, the image itself last """
+
+    files = [variants.variant_path(path, size, fmt) for size in sizes
+             for fmt in (None, *variants.MODERN_FORMATS)]
+    return [file for file in files if os.path.exists(file)] + [path]
+
+
+def _link(source: str, destination: str) -> None:
+    """ Makes a file available at a second path without copying if possible """
+
+    if os.path.exists(destination):
+        return
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def _link_into_blob(url: str, prefix: str, sizes: dict) -> Optional[str]:
+    """
+    Links an image and its variants into the blob named after its content,
+    returning the blob's url. The old files stay until the database points
+    at the blob.
+    """
+
+    path = storage.path_for(url)
+    if not os.path.exists(path):
+        logger.warning("Skipping %s, its file is missing", url)
+        return None
+
+    blob_url = storage.url_for(prefix, _file_digest(path), os.path.splitext(path)[1])
+    blob_path = storage.path_for(blob_url)
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+
+    old_stem = os.path.splitext(path)[0]
+    new_stem = os.path.splitext(blob_path)[0]
+    for file in _variant_files(path, sizes):
+        _link(file, new_stem + file[len(old_stem):])
+
+    return blob_url
+
+
+# Migration
+
+def migrate(db: Session, batch_size: int = 500) -> int:
+    """ Moves every image with an old name into a blob, returning how many moved """
+
+    moved = 0
+    for column, prefix, sizes in MEDIA_COLUMNS:
+        urls = [url for url in db.execute(select(column).distinct().
+                                          where(column.like(f"{prefix}/%"))).scalars()
+                if not storage.is_blob(url)]
+
+        for start in range(0, len(urls), batch_size):
+            renames = {}
+            for url in urls[start:start + batch_size]:
+                blob_url = _link_into_blob(url, prefix, sizes)
+                if blob_url:
+                    renames[url] = blob_url
+            if not renames:
+                continue
+
+            references = db.execute(select(column, func.count()).
+                                    where(column.in_(renames)).
+                                    group_by(column)).all()
+            ref_counts = {}
+            for url, count in references:
+                ref_counts[renames[url]] = ref_counts.get(renames[url], 0) + count
+
+            blobs = insert(models.MediaBlob).values(
+                [{"url": url, "ref_count": count} for url, count in ref_counts.items()])
+            db.execute(blobs.on_conflict_do_update(
+                index_elements=[models.MediaBlob.url],
+                set_={"ref_count": models.MediaBlob.ref_count + blobs.excluded.ref_count}))
+
+            db.execute(update(column.table).
+                       where(column == bindparam("old_url")).
+                       values({column.name: bindparam("new_url")}),
+                       [{"old_url": old, "new_url": new} for old, new in renames.items()])
+            db.commit()
+
+            for url in renames:
+                path = storage.path_for(url)
+                for file in _variant_files(path, sizes):
+                    os.remove(file)
+
+            moved += len(renames)
+            print(f"Moved {moved} of {len(urls)} {prefix} files")
+
+    return moved
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    with SessionLocal() as session:
+        print(f"Moved {migrate(session, args.batch_size)} media files into blobs")
@@ -0,0 +1,112 @@
+""" Module with the image processing steps run by the image worker processes """
+
+# Imports
+
+import os
+import time
+from typing import Callable
+from PIL import Image
+
+from app.images import variants
+
+
+# Encoder options of the modern formats
+
+ENCODER_OPTIONS = {
+    "webp": {"quality": 80, "method": 4},
+    "avif": {"quality": 60, "speed": 6},
+}
+
+
+# Processing steps
+#
+# These run in separate processes, so they only take and return plain
+# values and never touch the database or app settings.
+
+def lower_priority(niceness: int) -> None:
+    """ Worker initializer, lets request handling win the CPU over images """
+
+    if niceness and hasattr(os, "nice"):
+        os.nice(niceness)
+
+
+def _save_variants(upload_path: str, path: str, sizes: dict,
+                   default_size: str, resize: Callable) -> None:
+    """
+    Saves every size of an image in its uploaded format and the modern
+    formats, the default size in the uploaded format going to path itself.
+    path is written last so its presence means every variant is stored.
+    """
+
+    with Image.open(upload_path) as image:
+        image.load()
+        for size, dimensions in sizes.items():
+            variant = resize(image, dimensions)
+            if size == default_size:
+                default_variant = variant
+            else:
+                variant.save(variants.variant_path(path, size))
+
+            modern_variant = variant if variant.mode in ("RGB", "RGBA") \
+                else variant.convert("RGBA")
+            for fmt in variants.MODERN_FORMATS:
+                modern_variant.save(variants.variant_path(path, size, fmt),
+                                    format=fmt.upper(), **ENCODER_OPTIONS[fmt])
+
+        # Renamed into place so a crash never leaves a partial file at path
+        extension = os.path.splitext(path)[1].lower()
+        default_variant.save(path + ".partial",
+                             format=Image.registered_extensions()[extension])
+        os.replace(path + ".partial", path)
+
+
+def _already_processed(upload_path: str, path: str) -> bool:
+    """
+    Checks an image's variants were stored by an earlier attempt or an
+    identical upload, discarding the upload if so
+    """
+
+    if not os.path.exists(path):
+        return False
+
+    try:
+        os.remove(upload_path)
+    except FileNotFoundError:
+        pass
+    return True
+
+
+def _fit(image: Image.Image, dimensions: tuple) -> Image.Image:
+    """ Shrinks a copy of an image to fit within dimensions """
+
+    variant = image.copy()
+    variant.thumbnail(dimensions)
+    return variant
+
+
+def process_post_image(upload_path: str, path: str) -> float:
+    """ Saves every variant of an uploaded post image """
+
+    start = time.perf_counter()
+    if _already_processed(upload_path, path):
+        return 0.0
+
+    _save_variants(upload_path, path, variants.POST_IMAGE_SIZES,
+                   variants.POST_IMAGE_DEFAULT_SIZE, _fit)
+
+    os.remove(upload_path)
+    return time.perf_counter() - start
+
+
+def process_profile_picture(upload_path: str, path: str) -> float:
+    """ Saves every variant of an uploaded profile picture """
+
+    start = time.perf_counter()
+    if _already_processed(upload_path, path):
+        return 0.0
+
+    _save_variants(upload_path, path, variants.PROFILE_PICTURE_SIZES,
+                   variants.PROFILE_PICTURE_DEFAULT_SIZE, Image.Image.resize)
+
+    os.remove(upload_path)
+    return time.perf_counter() - start
@@ -0,0 +1,146 @@
+""" Module serving media files with validators, conditional GETs and byte ranges """
+
+# Imports
+
+import os
+import re
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional, Tuple
+import anyio
+from fastapi import HTTPException, Request, status
+from fastapi.responses import FileResponse, Response
+
+
+# Cache policies
+
+REVALIDATE = "public, no-cache"
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+# Responses
+
+class FileRangeResponse(FileResponse):
+    """ File response sending only length bytes of the file from offset """
+
+    def __init__(self, path: str, offset: int, length: int, **kwargs):
+        super().__init__(path, **kwargs)
+        self.offset = offset
+        self.length = length
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start",
+                    "status": self.status_code,
+                    "headers": self.raw_headers})
+
+        async with await anyio.open_file(self.path, mode="rb") as file:
+            await file.seek(self.offset)
+            remaining = self.length
+            while remaining:
+                chunk = await file.read(min(self.chunk_size, remaining))
+                remaining = remaining - len(chunk) if chunk else 0
+                await send({"type": "http.response.body",
+                            "body": chunk,
+                            "more_body": bool(remaining)})
+
+
+# Validators
+
+def entity_tag(stat_result: os.stat_result) -> str:
+    """
+    Returns a strong entity tag for a file. Media files are written once
+    and only ever replaced whole, so their size and modification time
+    identify their bytes.
+    """
+    return f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+
+def _not_modified(request: Request, etag: str,
+                  stat_result: os.stat_result) -> bool:
+    """ Evaluates If-None-Match, or If-Modified-Since when it is absent """
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/")
+                for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(stat_result.st_mtime) <= since
+
+    return False
+
+
+def _byte_range(request: Request, etag: str, last_modified: str,
+                size: int) -> Optional[Tuple[int, int]]:
+    """
+    Returns the first and last byte asked for by a single range Range
+    header. Multiple ranges, malformed headers and stale If-Range
+    validators fall back to the whole file.
+    """
+
+    match = RANGE_PATTERN.match(request.headers.get("range", "").replace(" ", ""))
+    if match is None or match.groups() == ("", ""):
+        return None
+
+    if_range = request.headers.get("if-range")
+    if if_range is not None and if_range not in (etag, last_modified):
+        return None
+
+    first, last = match.groups()
+    if first == "":
+        first, last = max(size - int(last), 0), size - 1
+    else:
+        first, last = int(first), min(int(last), size - 1) if last else size - 1
+
+    if first >= size or first > last:
+        raise HTTPException(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                            detail="Range not satisfiable",
+                            headers={"Content-Range": f"bytes */{size}"})
+
+    return first, last
+
+
+def file_response(request: Request, path: str, media_type: str,
+                  cache_control: str = REVALIDATE,
+                  headers: Optional[dict] = None) -> Response:
+    """
+    Serves a media file, answering conditional requests with a 304 and
+    range requests with a 206
+    """
+
+    try:
+        stat_result = os.stat(path)
+    except FileNotFoundError as error:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail="No media found") from error
+
+    etag = entity_tag(stat_result)
+    last_modified = formatdate(stat_result.st_mtime, usegmt=True)
+    headers = {**(headers or {}),
+               "ETag": etag,
+               "Last-Modified": last_modified,
+               "Cache-Control": cache_control,
+               "Accept-Ranges": "bytes"}
+
+    if _not_modified(request, etag, stat_result):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                        headers=headers)
+
+    byte_range = _byte_range(request, etag, last_modified, stat_result.st_size)
+    if byte_range is None:
+        return FileResponse(path, media_type=media_type, headers=headers,
+                            stat_result=stat_result)
+
+    first, last = byte_range
+    headers["Content-Range"] = f"bytes {first}-{last}/{stat_result.st_size}"
+    headers["Content-Length"] = str(last - first + 1)
+    return FileRangeResponse(path, first, last - first + 1,
+                             status_code=status.HTTP_206_PARTIAL_CONTENT,
+                             media_type=media_type, headers=headers)
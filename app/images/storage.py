@@ -0,0 +1,207 @@
+""" Module storing media files by content hash in sharded, reference counted blobs """
+
+# Imports
+
+import glob
+import hashlib
+import logging
+import os
+import re
+import uuid
+from typing import BinaryIO, Optional, Tuple
+from sqlalchemy import delete, event, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from app.db import models
+from app.db.db_setup import SessionLocal
+
+
+# Storage layout
+#
+# A blob is named after the sha256 of the uploaded bytes, so identical
+# uploads share one set of files. Urls stay flat, media/posts/{hash}.png,
+# while files are sharded by the first two byte pairs of the hash,
+# app/media/posts/ab/cd/{hash}.png, next to their variants. Names from
+# before blobs existed are stored unsharded under their old name.
+
+MEDIA_ROOT = "app/media"
+UPLOAD_DIR = f"{MEDIA_ROOT}/uploads"
+UPLOAD_SUFFIX = ".upload"
+CHUNK_SIZE = 64 * 1024
+
+DIRECTORIES = {
+    "media/posts": f"{MEDIA_ROOT}/posts",
+    "media/users": f"{MEDIA_ROOT}/profile_pictures",
+}
+
+RELEASED_KEY = "released_blobs"
+
+logger = logging.getLogger(__name__)
+
+BLOB_NAME = re.compile(r"^[0-9a-f]{64}\.\w+$")
+MEDIA_NAME = re.compile(r"^(?:[0-9a-f]{64}|\d+_.+)\.(?:png|jpe?g)$")
+
+
+# Names and paths
+
+def is_blob(url: str) -> bool:
+    """ Checks a media url names a content addressed blob """
+    return BLOB_NAME.match(os.path.basename(url)) is not None
+
+
+def is_media_name(name: str) -> bool:
+    """ Checks a name is one a media url may end in, a blob's or an older one """
+    return MEDIA_NAME.match(name) is not None
+
+
+def url_for(prefix: str, digest: str, extension: str) -> str:
+    """ Returns the url of a blob, prefix being media/posts or media/users """
+    return f"{prefix}/{digest}{extension.lower()}"
+
+
+def path_for(url: str) -> str:
+    """ Returns where the file behind a media url is stored """
+
+    prefix, name = url.rsplit("/", 1)
+    directory = DIRECTORIES[prefix]
+    if is_blob(url):
+        return f"{directory}/{name[0:2]}/{name[2:4]}/{name}"
+    return f"{directory}/{name}"
+
+
+def exists(url: str) -> bool:
+    """ Checks a blob has been fully processed """
+    return os.path.exists(path_for(url))
+
+
+# Writing blobs
+
+def save_upload(file: BinaryIO) -> Tuple[str, str]:
+    """
+    Streams an upload to a temporary file while hashing it, returning the
+    temporary path and the sha256 of its bytes
+    """
+
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    temp_path = f"{UPLOAD_DIR}/{uuid.uuid4().hex}{UPLOAD_SUFFIX}"
+    digest = hashlib.sha256()
+
+    with open(temp_path, "wb") as temp_file:
+        while chunk := file.read(CHUNK_SIZE):
+            digest.update(chunk)
+            temp_file.write(chunk)
+
+    return temp_path, digest.hexdigest()
+
+
+def place_upload(temp_path: str, url: str) -> Optional[str]:
+    """
+    Moves a saved upload next to its blob for processing and returns its
+    new path. Returns None when the blob is already processed, the upload
+    being a duplicate.
+    """
+
+    path = path_for(url)
+    if os.path.exists(path):
+        os.remove(temp_path)
+        return None
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    upload_path = path + UPLOAD_SUFFIX
+    # Concurrent uploads of the same bytes write identical files
+    os.replace(temp_path, upload_path)
+    return upload_path
+
+
+def _remove_files(url: str) -> None:
+    """ Deletes a blob, its variants and any pending upload """
+
+    path = path_for(url)
+    stem, _ = os.path.splitext(path)
+    for file_path in [path, path + UPLOAD_SUFFIX, *glob.glob(f"{stem}_*")]:
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+
+
+# Reference counts
+
+def retain(db: Session, url: str) -> int:
+    """ Adds a reference to a blob, returning its reference count """
+
+    return db.execute(insert(models.MediaBlob).
+                      values(url=url, ref_count=1).
+                      on_conflict_do_update(
+                          index_elements=[models.MediaBlob.url],
+                          set_={"ref_count": models.MediaBlob.ref_count + 1}).
+                      returning(models.MediaBlob.ref_count)).scalar_one()
+
+
+def release(db: Session, url: Optional[str]) -> None:
+    """
+    Drops a reference to a blob, deleting it once nothing references it.
+    Its files are removed once the session commits, see _remove_released.
+    Must be followed by a commit.
+    """
+
+    if url is None or not is_blob(url):
+        return
+
+    ref_count = db.execute(update(models.MediaBlob).
+                           where(models.MediaBlob.url == url).
+                           values(ref_count=models.MediaBlob.ref_count - 1).
+                           returning(models.MediaBlob.ref_count).
+                           execution_options(synchronize_session=False)).scalar()
+
+    if ref_count is not None and ref_count <= 0:
+        db.execute(delete(models.MediaBlob).
+                   where(models.MediaBlob.url == url).
+                   execution_options(synchronize_session=False))
+        db.info.setdefault(RELEASED_KEY, []).append(url)
+
+
+# Removing released blobs
+#
+# Files go only once the deletion of their blob is committed, so a failed
+# commit leaves both the rows and the files. Each removal first puts the
+# blob's row back with no references and holds it while the files go. An
+# upload of the same bytes committed in between keeps the files, one in
+# progress waits on the row and then processes its upload anew.
+
+def _remove_unreferenced(url: str) -> None:
+    """ Removes the files of a released blob unless it was uploaded again """
+
+    with SessionLocal() as db:
+        claimed = db.execute(insert(models.MediaBlob).
+                             values(url=url, ref_count=0).
+                             on_conflict_do_nothing().
+                             returning(models.MediaBlob.url)).scalar()
+        if claimed is None:
+            return
+
+        _remove_files(url)
+        db.execute(delete(models.MediaBlob).
+                   where(models.MediaBlob.url == url).
+                   execution_options(synchronize_session=False))
+        db.commit()
+
+
+def _remove_released(session: Session) -> None:
+    """ Removes the files of the blobs a committed session released """
+
+    for url in session.info.pop(RELEASED_KEY, []):
+        try:
+            _remove_unreferenced(url)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Could not remove the files of blob %s", url)
+
+
+def _forget_released(session: Session) -> None:
+    """ Keeps the files of the blobs released by a rolled back session """
+    session.info.pop(RELEASED_KEY, None)
+
+
+event.listen(SessionLocal, "after_commit", _remove_released)
+event.listen(SessionLocal, "after_rollback", _forget_released)
@@ -0,0 +1,107 @@
+""" Module describing the stored variants of each image and picking one to serve """
+
+# Imports
+
+import os
+from typing import Optional, Tuple
+from PIL import Image
+
+try:
+    # Registers the AVIF codec on Pillow releases without built in support
+    import pillow_avif  # pylint: disable=unused-import
+except ImportError:
+    pass
+
+
+# Variant sizes
+#
+# Every image is stored once per size and format. The default size is also
+# kept at the image's original path, in its uploaded format, so existing
+# image urls and clients keep working.
+
+POST_IMAGE_SIZES = {
+    "thumb": (320, 320),
+    "medium": (732, 732),
+    "full": (1464, 1464),
+}
+POST_IMAGE_DEFAULT_SIZE = "medium"
+
+PROFILE_PICTURE_SIZES = {
+    "small": (64, 64),
+    "medium": (160, 160),
+    "large": (400, 400),
+}
+PROFILE_PICTURE_DEFAULT_SIZE = "large"
+
+
+# Variant formats, most preferred first
+
+Image.init()
+MODERN_FORMATS = tuple(fmt for fmt in ("avif", "webp")
+                       if fmt.upper() in Image.SAVE)
+
+MEDIA_TYPES = {
+    "avif": "image/avif",
+    "webp": "image/webp",
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+}
+
+
+# Variant paths
+
+def variant_path(path: str, size: str, fmt: Optional[str] = None) -> str:
+    """
+    Returns where a variant of the image at path is stored, fmt defaults
+    to the uploaded format
+    """
+
+    stem, extension = os.path.splitext(path)
+    return f"{stem}_{size}.{fmt or extension[1:]}"
+
+
+# Content negotiation
+
+def accepted_formats(accept: Optional[str]) -> set:
+    """ Returns the modern formats allowed by an Accept header """
+
+    accepted = set()
+    for media_range in (accept or "").split(","):
+        media_type, *params = [part.strip() for part in media_range.split(";")]
+        quality = dict(param.partition("=")[::2] for param in params).get("q", "1")
+        try:
+            if float(quality) == 0:
+                continue
+        except ValueError:
+            continue
+
+        for fmt in MODERN_FORMATS:
+            if media_type == MEDIA_TYPES[fmt]:
+                accepted.add(fmt)
+
+    return accepted
+
+
+def pick(path: str, size: str, default_size: str,
+         accept: Optional[str], fmt: Optional[str] = None) -> Tuple[str, str]:
+    """
+    Returns the file and media type to serve for an image. The format comes
+    from fmt when given, otherwise the first modern format the client
+    accepts. Falls back to the uploaded format, and to the original file for
+    images stored before variants existed.
+    """
+
+    formats = [fmt] if fmt else \
+        [modern for modern in MODERN_FORMATS if modern in accepted_formats(accept)]
+
+    for candidate in formats:
+        candidate_path = variant_path(path, size, candidate)
+        if os.path.exists(candidate_path):
+            return candidate_path, MEDIA_TYPES[candidate]
+
+    media_type = MEDIA_TYPES[os.path.splitext(path)[1][1:].lower()]
+    if size != default_size and os.path.exists(variant_path(path, size)):
+        return variant_path(path, size), media_type
+
+    return path, media_type
@@ -15,12 +15,23 @@ Developed with 💙️ by Dhruv Shah
 """
 
 # Imports
-from fastapi import FastAPI
+from anyio import to_thread
+from fastapi import FastAPI, HTTPException, Response, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 
+from app.cache import bus
+from app.cache import responses as response_cache
 from app.config import app_settings, settings
-from app.db import models
+from app.db import likes, models, pool, profiling, replicas, timeline
 from app.db.db_setup import engine
+from app.db.instrumentation import QueryCountMiddleware
+from app.db.pagination import NEXT_CURSOR_HEADER
+from app.images import jobs
+from app.metrics import collectors
+from app.metrics.http import MetricsMiddleware
+from app.metrics.registry import CONTENT_TYPE as METRICS_CONTENT_TYPE
 from app.routers import post, user, follow, like, comment, auth, media
 
 
@@ -43,7 +54,91 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
+if settings.request_metrics:
+    app.add_middleware(MetricsMiddleware)
+app.add_middleware(QueryCountMiddleware)
+if settings.sql_profiling:
+    app.add_middleware(profiling.SQLProfilingMiddleware)
+app.add_middleware(replicas.ReadYourWritesMiddleware)
+
+
+# Errors
+@app.exception_handler(PoolTimeoutError)
+async def database_busy(request, exc):
+    """ Fails requests that waited too long for a database connection with a 503 """
+    return JSONResponse(status_code=503,
+                        content={"detail": "Server busy, try again"},
+                        headers={"Retry-After": "1"})
+
+
+# Startup
+@app.on_event("startup")
+async def configure_threadpool():
+    """ Sizes the threadpool that runs the route handlers and their queries """
+    to_thread.current_default_thread_limiter().total_tokens = settings.worker_threads
+
+
+@app.on_event("startup")
+def resume_image_jobs():
+    """ Requeues image processing interrupted by a restart """
+    jobs.resume_pending()
+
+
+@app.on_event("startup")
+def start_like_flusher():
+    """ Starts writing buffered likes when write-behind is enabled """
+    likes.start_flusher()
+
+
+@app.on_event("startup")
+def start_timeline_trimmer():
+    """ Starts dropping timeline entries past the maximum length """
+    timeline.start_trimmer()
+
+
+@app.on_event("startup")
+def start_invalidation_listener():
+    """ Starts hearing of cache invalidations from the other workers """
+    bus.start()
+
+
+@app.on_event("startup")
+def start_replica_monitor():
+    """ Starts checking the health and lag of the read replicas """
+    replicas.start_monitor()
+
+
+# Shutdown
+@app.on_event("shutdown")
+def stop_image_workers():
+    """ Lets queued image jobs finish and stops the worker processes """
+    jobs.shutdown()
+
+
+@app.on_event("shutdown")
+def flush_likes():
+    """ Writes the likes still buffered """
+    likes.stop_flusher()
+
+
+@app.on_event("shutdown")
+def stop_timeline_trimmer():
+    """ Stops trimming timelines """
+    timeline.stop_trimmer()
+
+
+@app.on_event("shutdown")
+def stop_invalidation_listener():
+    """ Stops listening for cache invalidations """
+    bus.stop()
+
+
+@app.on_event("shutdown")
+def stop_replica_monitor():
+    """ Stops checking the read replicas """
+    replicas.stop_monitor()
 
 
 # Root
@@ -53,6 +148,48 @@ async def root():
     return {"message": "Welcome to Chitros API"}
 
 
+# Cache metrics
+@app.get('/cache/stats')
+def cache_stats():
+    """
+    Hits, misses and hit rate of each kind of cached response, and the
+    invalidation bus's message counts and lag, in this worker
+    """
+    return {**response_cache.stats(), "invalidation_bus": bus.stats()}
+
+
+# Connection pool metrics
+@app.get('/db/stats')
+def db_stats():
+    """
+    Connections in use, checkout wait histogram, overflows and timeouts of
+    each database connection pool, and the health and lag of each read
+    replica, in this worker
+    """
+    return {"pools": pool.stats(), "replicas": replicas.stats()}
+
+
+# Prometheus metrics
+@app.get('/metrics', include_in_schema=False)
+def metrics():
+    """ Every metric of this worker in the Prometheus text format """
+    return Response(collectors.exposition(), media_type=METRICS_CONTENT_TYPE)
+
+
+# SQL profiles
+@app.get('/debug/sql/{report_id}', include_in_schema=False)
+def sql_profile(report_id: str):
+    """
+    Statements of a recent request with their timing and call sites, and the
+    N+1 patterns among them, when SQL_PROFILING is on
+    """
+    report = profiling.get_report(report_id)
+    if report is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail="Report does not exist")
+    return report
+
+
 # Registering all routers to the app
 
 app.include_router(follow.router)
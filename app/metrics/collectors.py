@@ -0,0 +1,102 @@
+"""
+Module exposing the statistics kept by the caches, the invalidation bus,
+the connection pools and the replica monitor as metrics
+"""
+
+# Imports
+
+from typing import List
+
+from app.cache import bus
+from app.cache import responses as response_cache
+from app.db import pool, replicas
+from app.metrics.registry import Family, render
+
+
+# Collectors
+#
+# These read the counters the modules already keep for their /stats routes
+# at scrape time, so serving them costs nothing between scrapes.
+
+def _response_cache() -> List[Family]:
+    stats = response_cache.stats()
+    hits = Family("chitros_cache_hits_total", "counter",
+                  "Response cache lookups that found an entry")
+    misses = Family("chitros_cache_misses_total", "counter",
+                    "Response cache lookups that found nothing")
+    ratio = Family("chitros_cache_hit_ratio", "gauge",
+                   "Share of response cache lookups that found an entry")
+    for kind in ("post", "profile", "feed"):
+        hits.add(stats[kind]["hits"], kind=kind)
+        misses.add(stats[kind]["misses"], kind=kind)
+        ratio.add(stats[kind]["hit_rate"], kind=kind)
+
+    errors = Family("chitros_cache_errors_total", "counter",
+                    "Response cache backend failures").add(stats["errors"])
+    return [hits, misses, ratio, errors]
+
+
+def _invalidation_bus() -> List[Family]:
+    stats = bus.stats()
+    lag = Family("chitros_invalidation_bus_lag_seconds", "gauge",
+                 "Time invalidations took from publishing to delivery")
+    for stat, value in stats["lag_seconds"].items():
+        lag.add(value, stat=stat)
+
+    return [Family("chitros_invalidation_bus_connected", "gauge",
+                   "Whether this worker is listening for invalidations").
+            add(int(stats["connected"])),
+            Family("chitros_invalidation_bus_published_total", "counter",
+                   "Invalidations this worker sent").add(stats["published"]),
+            Family("chitros_invalidation_bus_received_total", "counter",
+                   "Invalidations and pings this worker heard").add(stats["received"]),
+            Family("chitros_invalidation_bus_resets_total", "counter",
+                   "Times this worker dropped its caches for missing invalidations").
+            add(stats["resets"]),
+            lag]
+
+
+def _pools() -> List[Family]:
+    checked_out = Family("chitros_db_pool_checked_out", "gauge",
+                         "Connections in use")
+    idle = Family("chitros_db_pool_idle", "gauge",
+                  "Connections waiting in the pool")
+    overflow = Family("chitros_db_pool_overflow", "gauge",
+                      "Connections open past the pool size")
+    overflows = Family("chitros_db_pool_overflows_total", "counter",
+                       "Checkouts that opened a connection past the pool size")
+    timeouts = Family("chitros_db_pool_timeouts_total", "counter",
+                      "Checkouts that gave up waiting for a connection")
+    wait = Family("chitros_db_pool_wait_seconds", "histogram",
+                  "Time checkouts took to get a connection")
+
+    for stats in pool.stats():
+        name = stats["name"]
+        checked_out.add(stats["checked_out"], pool=name)
+        idle.add(stats["idle"], pool=name)
+        overflow.add(stats["overflow"], pool=name)
+        overflows.add(stats["overflows"], pool=name)
+        timeouts.add(stats["timeouts"], pool=name)
+        for bound, count in stats["wait_seconds"]["buckets"].items():
+            wait.add(count, "_bucket", pool=name, le=bound)
+        wait.add(stats["wait_seconds"]["sum"], "_sum", pool=name)
+        wait.add(stats["wait_seconds"]["count"], "_count", pool=name)
+
+    return [checked_out, idle, overflow, overflows, timeouts, wait]
+
+
+def _replicas() -> List[Family]:
+    healthy = Family("chitros_replica_healthy", "gauge",
+                     "Whether a read replica passed its last check")
+    lag = Family("chitros_replica_lag_seconds", "gauge",
+                 "Replay lag of a read replica as of its last check")
+    for stats in replicas.stats():
+        healthy.add(int(stats["healthy"]), replica=stats["name"])
+        if stats["lag_seconds"] is not None:
+            lag.add(stats["lag_seconds"], replica=stats["name"])
+    return [healthy, lag]
+
+
+def exposition() -> bytes:
+    """ Returns every metric of this worker in the Prometheus text format """
+    return render([*_response_cache(), *_invalidation_bus(), *_pools(), *_replicas()])
@@ -0,0 +1,104 @@
+""" Module measuring the latency, size and database work of each request """
+
+# Imports
+
+import time
+from typing import Dict
+
+from app.db.instrumentation import current_stats
+from app.metrics import registry
+
+
+# Request metrics
+
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+REQUEST_SECONDS = registry.histogram(
+    "chitros_http_request_duration_seconds",
+    "Time from receiving a request to sending the last of its response",
+    ["method", "route", "status"])
+REQUESTS_IN_PROGRESS = registry.gauge(
+    "chitros_http_requests_in_progress",
+    "Requests being served",
+    ["method"])
+RESPONSE_BYTES = registry.histogram(
+    "chitros_http_response_size_bytes",
+    "Size of response bodies",
+    ["method", "route"], buckets=SIZE_BUCKETS)
+DB_QUERIES = registry.counter(
+    "chitros_db_queries_total",
+    "SQL statements issued while serving requests",
+    ["route"])
+DB_SECONDS = registry.counter(
+    "chitros_db_query_duration_seconds_total",
+    "Time the database took on the statements of requests",
+    ["route"])
+
+
+# Middleware
+#
+# Requests are labelled with the path template of the route that served
+# them, such as /{post_id}/like, so each route is one series whatever ids
+# it is called with. Requests no route matched share the "unmatched" label.
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording each request's latency, response size and SQL
+    statements. Add it inside QueryCountMiddleware, which counts them.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._templates: Dict[any, str] = {}
+
+    def _route(self, scope: dict) -> str:
+        """ Returns the path template of the route that served a request """
+
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+
+        template = self._templates.get(endpoint)
+        if template is None:
+            for route in scope["router"].routes:
+                if getattr(route, "endpoint", None) is endpoint:
+                    template = route.path
+                    break
+            else:
+                template = "unmatched"
+            self._templates[endpoint] = template
+        return template
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        in_progress = REQUESTS_IN_PROGRESS.labels(method)
+        in_progress.inc()
+        started = time.perf_counter()
+        status, size = 500, 0
+
+        async def send_measuring(message):
+            nonlocal status, size
+
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_measuring)
+        finally:
+            in_progress.dec()
+            route = self._route(scope)
+            REQUEST_SECONDS.labels(method, route, str(status)).observe(
+                time.perf_counter() - started)
+            RESPONSE_BYTES.labels(method, route).observe(size)
+
+            stats = current_stats()
+            if stats is not None:
+                DB_QUERIES.labels(route).inc(stats.query_count)
+                DB_SECONDS.labels(route).inc(stats.query_seconds)
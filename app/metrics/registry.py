@@ -0,0 +1,246 @@
+""" Module with the metric types and their Prometheus text exposition """
+
+# Imports
+
+import bisect
+import math
+from threading import Lock
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+
+# Metric settings
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+# Formatting
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    """ Formats label pairs as {name="value",...}, empty without labels """
+
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"'
+                          for name, value in zip(names, values)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+def _format_bound(bound: float) -> str:
+    return "+Inf" if math.isinf(bound) else repr(float(bound))
+
+
+class Family:
+    """
+    Samples of one metric gathered at scrape time, for values that other
+    modules already keep, such as cache hit counts
+    """
+
+    def __init__(self, name: str, kind: str, documentation: str):
+        self.name = name
+        self.kind = kind
+        self.documentation = documentation
+        self._samples: List[Tuple[str, str, float]] = []
+
+    def add(self, value: float, suffix: str = "", **labels: str) -> "Family":
+        """ Adds a sample, suffix being _bucket, _sum or _count for histograms """
+
+        self._samples.append((self.name + suffix,
+                              format_labels(list(labels), list(labels.values())),
+                              value))
+        return self
+
+    def samples(self) -> Iterable[Tuple[str, str, float]]:
+        return self._samples
+
+
+# Metrics
+#
+# Each labelled series is a child holding its own values behind its own
+# lock, so recording is a dict lookup and an uncontended lock. Callers on
+# hot paths can keep the child returned by labels() to skip the lookup.
+
+class _Metric:
+    """ A metric and its series, one per combination of label values """
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[tuple, any] = {}
+        self._lock = Lock()
+
+    def _new_child(self) -> any:
+        raise NotImplementedError
+
+    def labels(self, *values: str) -> any:
+        """ Returns the series of the given label values """
+
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {self.labelnames}")
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _series(self) -> List[Tuple[tuple, any]]:
+        with self._lock:
+            return list(self._children.items())
+
+
+class _Value:
+    """ A single value, the series of counters and gauges """
+
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class Counter(_Metric):
+    """ A value that only goes up """
+
+    kind = "counter"
+
+    def _new_child(self) -> _Value:
+        return _Value()
+
+    def inc(self, amount: float = 1) -> None:
+        """ Increments the counter of a metric without labels """
+        self.labels().inc(amount)
+
+    def samples(self) -> Iterable[Tuple[str, str, float]]:
+        for values, child in self._series():
+            yield self.name, format_labels(self.labelnames, values), child.value
+
+
+class Gauge(Counter):
+    """ A value that goes up and down """
+
+    kind = "gauge"
+
+    def dec(self, amount: float = 1) -> None:
+        """ Decrements the gauge of a metric without labels """
+        self.labels().dec(amount)
+
+    def set(self, value: float) -> None:
+        """ Sets the gauge of a metric without labels """
+        self.labels().set(value)
+
+
+class _Buckets:
+    """ Observation counts per bucket with their sum, the series of histograms """
+
+    __slots__ = ("bounds", "counts", "sum", "_lock")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self) -> Tuple[List[int], float]:
+        with self._lock:
+            return list(self.counts), self.sum
+
+
+class Histogram(_Metric):
+    """ Observations counted into cumulative buckets """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self) -> _Buckets:
+        return _Buckets(self.buckets)
+
+    def observe(self, value: float) -> None:
+        """ Records an observation of a metric without labels """
+        self.labels().observe(value)
+
+    def samples(self) -> Iterable[Tuple[str, str, float]]:
+        names = self.labelnames + ("le",)
+        bounds = [*map(_format_bound, self.buckets), "+Inf"]
+        for values, child in self._series():
+            counts, total = child.snapshot()
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                yield self.name + "_bucket", format_labels(names, values + (bound,)), cumulative
+            labels = format_labels(self.labelnames, values)
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, cumulative
+
+
+# Registry
+
+_metrics: List[_Metric] = []
+
+
+def _register(metric: _Metric) -> any:
+    _metrics.append(metric)
+    return metric
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    """ Creates and registers a counter """
+    return _register(Counter(name, documentation, labelnames))
+
+
+def gauge(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+    """ Creates and registers a gauge """
+    return _register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = (),
+              buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    """ Creates and registers a histogram """
+    return _register(Histogram(name, documentation, labelnames, buckets))
+
+
+def render(families: Iterable[Family] = ()) -> bytes:
+    """ Encodes the registered metrics and extra families in the text format """
+
+    lines = []
+    for metric in [*_metrics, *families]:
+        documentation = metric.documentation.replace("\\", "\\\\").replace("\n", "\\n")
+        lines.append(f"# HELP {metric.name} {documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(f"{name}{labels} {_format_value(value)}"
+                     for name, labels, value in metric.samples())
+    return ("\n".join(lines) + "\n").encode()
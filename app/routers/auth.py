@@ -7,7 +7,7 @@ from fastapi.security.oauth2 import OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
 
 from app.auth import oauth2
-from app.auth.utils import get_password, verify_password
+from app.auth.utils import get_password, verify_and_update_password
 from app.schema import schemas, forms
 from app.db import models
 from app.db.db_setup import get_db
@@ -21,8 +21,8 @@ router = APIRouter(tags=['Auth'])
 # User signup and login
 
 @router.post("/signup", status_code=status.HTTP_201_CREATED)
-async def signup(user: forms.UserCreate = Depends(forms.UserCreate.as_form),
-                 db: Session = Depends(get_db)) -> any:
+def signup(user: forms.UserCreate = Depends(forms.UserCreate.as_form),
+           db: Session = Depends(get_db)) -> any:
 
     """ Creates a user """
 
@@ -38,15 +38,21 @@ async def signup(user: forms.UserCreate = Depends(forms.UserCreate.as_form),
 
 
 @router.post("/login", response_model=schemas.Token)
-async def login(credentials: OAuth2PasswordRequestForm = Depends(),
-                db: Session = Depends(get_db)) -> any:
+def login(credentials: OAuth2PasswordRequestForm = Depends(),
+          db: Session = Depends(get_db)) -> any:
 
     """ User login and authentication """
 
     user = db.query(models.User).filter(
         models.User.username == credentials.username).first()
     if user:
-        if verify_password(credentials.password, user.password):
+        verified, new_hash = verify_and_update_password(credentials.password,
+                                                        user.password)
+        if verified:
+            if new_hash:
+                user.password = new_hash
+                db.commit()
+
             access_token = oauth2.create_access_token(
                 data={"user_id": user.id})
 
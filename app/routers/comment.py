@@ -2,38 +2,127 @@
 
 # Imports
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from typing import List, Optional
+from fastapi import APIRouter, Depends, HTTPException, Response, status
 from sqlalchemy.orm import Session
 
-from app.schema import schemas
+from app.cache import responses as response_cache
+from app.schema import schemas, serializers
 from app.db import models
 from app.db.db_setup import get_db
-from app.auth.oauth2 import get_current_user
+from app.db.replicas import get_read_db
+from app.db import comments, counters, follow_graph, pagination
+from app.db.instrumentation import query_budget
+from app.auth.oauth2 import Principal, get_current_principal
 
 # Defining router
 
 router = APIRouter(tags=["Comments"])
 
 
+# Query budgets, see app.db.instrumentation
+
+COMMENTS_QUERY_BUDGET = 6
+REPLIES_QUERY_BUDGET = 5
+
+
+# Threads
+#
+# Post ids are matched as integers so these routes leave paths such as
+# /users/comments to the other routers.
+
+@router.get("/{post_id:int}/comments", response_model=List[schemas.CommentResponse],
+            dependencies=[Depends(query_budget(COMMENTS_QUERY_BUDGET))])
+def get_comments(post_id: int,
+                 response: Response,
+                 cursor: Optional[str] = None,
+                 limit: Optional[int] = None,
+                 db: Session = Depends(get_read_db),
+                 current_user: Principal = Depends(get_current_principal)) -> any:
+
+    """ Displays a post's comments newest first, paginated by cursor """
+
+    author_id = db.query(models.Post.author_id).\
+        filter(models.Post.id == post_id,
+               models.Post.status == models.PostStatus.READY).scalar()
+
+    if author_id is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Post not found")
+
+    if not follow_graph.can_view(db, current_user.id, author_id):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="Not following")
+
+    thread, next_cursor = comments.page_comments(db, post_id, cursor, limit)
+    if next_cursor:
+        response.headers[pagination.NEXT_CURSOR_HEADER] = next_cursor
+
+    if serializers.ENABLED:
+        return serializers.json_response(
+            [serializers.comment(comment) for comment in thread], response)
+    return thread
+
+
+@router.get("/{post_id:int}/{comment_id:int}/replies",
+            response_model=List[schemas.ReplyResponse],
+            dependencies=[Depends(query_budget(REPLIES_QUERY_BUDGET))])
+def get_replies(post_id: int,
+                comment_id: int,
+                response: Response,
+                cursor: Optional[str] = None,
+                limit: Optional[int] = None,
+                db: Session = Depends(get_read_db),
+                current_user: Principal = Depends(get_current_principal)) -> any:
+
+    """ Displays a comment's replies oldest first, paginated by cursor """
+
+    author_id = db.query(models.Post.author_id).\
+        join(models.Comment, models.Comment.post_id == models.Post.id).\
+        filter(models.Comment.id == comment_id,
+               models.Comment.post_id == post_id,
+               models.Comment.parent_id == None,
+               models.Post.status == models.PostStatus.READY).scalar()
+
+    if author_id is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Comment not found")
+
+    if not follow_graph.can_view(db, current_user.id, author_id):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="Not following")
+
+    replies, next_cursor = comments.page_replies(db, comment_id, cursor, limit)
+    if next_cursor:
+        response.headers[pagination.NEXT_CURSOR_HEADER] = next_cursor
+
+    if serializers.ENABLED:
+        return serializers.json_response(
+            [serializers.reply(reply) for reply in replies], response)
+    return replies
+
+
 # Comments CRUD
 
 @router.post("/{post_id}/comment", status_code=status.HTTP_201_CREATED)
-async def post_comment(post_id: int,
-                       content: schemas.CommentCreate,
-                       db: Session = Depends(get_db),
-                       current_user: models.User = Depends(get_current_user)) -> any:
+def post_comment(post_id: int,
+                 content: schemas.CommentCreate,
+                 db: Session = Depends(get_db),
+                 current_user: Principal = Depends(get_current_principal)) -> any:
 
     """ Creates a comment """
 
     post = db.query(models.Post).filter(models.Post.id == post_id).first()
 
     if post:
-        if post.author in current_user.following or post.author == current_user:
+        if follow_graph.can_view(db, current_user.id, post.author_id):
             comment = models.Comment(post=post,
-                                     author=current_user,
+                                     author_id=current_user.id,
                                      **content.dict())
             db.add(comment)
+            counters.adjust(db, post.id, comments=1)
             db.commit()
+            response_cache.invalidate(response_cache.post_tag(post_id))
             return {"Success": "Comment added!"}
 
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
@@ -44,9 +133,9 @@ async def post_comment(post_id: int,
 
 
 @router.delete("/{post_id}/{comment_id}/delete", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_comment(comment_id: int,
-                         db: Session = Depends(get_db),
-                         current_user: models.User = Depends(get_current_user)) -> any:
+def delete_comment(comment_id: int,
+                   db: Session = Depends(get_db),
+                   current_user: Principal = Depends(get_current_principal)) -> any:
 
     """ Deletes a comment """
 
@@ -55,9 +144,18 @@ async def delete_comment(comment_id: int,
     comment = comment_query.first()
 
     if comment:
-        if comment.author == current_user:
+        if comment.author_id == current_user.id:
+            thread_post_id = comment.post_id
+            if thread_post_id is not None:
+                counters.adjust(db, thread_post_id, comments=-1)
+            else:
+                # Reply counts show in the top comments of the thread's post
+                thread_post_id = db.query(models.Comment.post_id).\
+                    filter(models.Comment.id == comment.parent_id).scalar()
             comment_query.delete(synchronize_session=False)
             db.commit()
+            if thread_post_id is not None:
+                response_cache.invalidate(response_cache.post_tag(thread_post_id))
             return
 
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
@@ -71,11 +169,11 @@ async def delete_comment(comment_id: int,
 
 
 @router.post("/{post_id}/{comment_id}/reply", status_code=status.HTTP_201_CREATED)
-async def post_reply(post_id: int,
-                     comment_id: int,
-                     content: schemas.CommentCreate,
-                     db: Session = Depends(get_db),
-                     current_user: models.User = Depends(get_current_user)) -> any:
+def post_reply(post_id: int,
+               comment_id: int,
+               content: schemas.CommentCreate,
+               db: Session = Depends(get_db),
+               current_user: Principal = Depends(get_current_principal)) -> any:
 
     """ Creates a reply  """
 
@@ -86,12 +184,13 @@ async def post_reply(post_id: int,
             models.Comment.id == comment_id, models.Comment.post_id == post.id, models.Comment.parent_id == None).first()
 
         if comment:
-            if post.author in current_user.following or post.author == current_user:
+            if follow_graph.can_view(db, current_user.id, post.author_id):
                 reply = models.Comment(parent_id=comment_id,
-                                       author=current_user,
+                                       author_id=current_user.id,
                                        **content.dict())
                 db.add(reply)
                 db.commit()
+                response_cache.invalidate(response_cache.post_tag(post_id))
                 return {"Success": "Reply added!"}
 
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
@@ -105,9 +204,9 @@ async def post_reply(post_id: int,
 
 
 @router.delete("/{post_id}/{comment_id}/{reply_id}/delete", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_reply(reply_id: int,
-                       db: Session = Depends(get_db),
-                       current_user: models.User = Depends(get_current_user)) -> any:
+def delete_reply(reply_id: int,
+                 db: Session = Depends(get_db),
+                 current_user: Principal = Depends(get_current_principal)) -> any:
 
     """ Deletes a reply """
 
@@ -116,10 +215,14 @@ async def delete_reply(reply_id: int,
     reply = reply_query.first()
 
     if reply:
-        if reply.author == current_user:
-
+        if reply.author_id == current_user.id:
+            # Reply counts show in the top comments of the thread's post
+            thread_post_id = db.query(models.Comment.post_id).\
+                filter(models.Comment.id == reply.parent_id).scalar()
             reply_query.delete(synchronize_session=False)
             db.commit()
+            if thread_post_id is not None:
+                response_cache.invalidate(response_cache.post_tag(thread_post_id))
             return
 
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
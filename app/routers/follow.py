@@ -6,10 +6,14 @@ from typing import List
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session
 
+from app.cache import responses as response_cache
 from app.db import models
 from app.db.db_setup import get_db
+from app.db.replicas import get_read_db
+from app.db import follow_graph, loaders, timeline
+from app.db.instrumentation import query_budget
 from app.schema import schemas
-from app.auth.oauth2 import get_current_user
+from app.auth.oauth2 import Principal, get_current_principal
 
 
 # Defining router
@@ -17,24 +21,29 @@ from app.auth.oauth2 import get_current_user
 router = APIRouter(tags=['Follow Requests'])
 
 
+# Query budgets, see app.db.instrumentation
+
+REQUESTS_QUERY_BUDGET = 3
+
+
 # Follow requests and follow feature CRUD
 
 @router.post("/users/{username}/follow", status_code=status.HTTP_201_CREATED)
-async def follow(username: str,
-                 db: Session = Depends(get_db),
-                 current_user: models.User = Depends(get_current_user)) -> any:
+def follow(username: str,
+           db: Session = Depends(get_db),
+           current_user: Principal = Depends(get_current_principal)) -> any:
 
     """ Creates a follow request """
 
     user = db.query(models.User).filter(
         models.User.username == username).first()
 
-    if user == current_user:
+    if user and user.id == current_user.id:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail="Cannot send yourself a request!")
 
     if user:
-        if user not in current_user.following:
+        if not follow_graph.follows(db, current_user.id, user.id):
             request = db.query(models.FollowRequest).\
                 filter(models.FollowRequest.sender_id == current_user.id,
                        models.FollowRequest.receiver_id == user.id).first()
@@ -58,9 +67,9 @@ async def follow(username: str,
 
 
 @router.delete("/users/{username}/unfollow", status_code=status.HTTP_204_NO_CONTENT)
-async def unfollow(username: str,
-                   db: Session = Depends(get_db),
-                   current_user: models.User = Depends(get_current_user)) -> any:
+def unfollow(username: str,
+             db: Session = Depends(get_db),
+             current_user: Principal = Depends(get_current_principal)) -> any:
 
     """ Deletes a following relationship """
 
@@ -68,9 +77,12 @@ async def unfollow(username: str,
         models.User.username == username).first()
 
     if user:
-        if user in current_user.following:
-            current_user.unfollow(user)
+        if follow_graph.unfollow(db, current_user.id, user.id):
+            timeline.prune(db, current_user.id, user.id)
             db.commit()
+            response_cache.invalidate(response_cache.user_tag(current_user.username),
+                                      response_cache.user_tag(username),
+                                      response_cache.feed_tag(current_user.id))
             return
         else:
             raise HTTPException(
@@ -80,17 +92,22 @@ async def unfollow(username: str,
             status_code=status.HTTP_404_NOT_FOUND, detail="User does not exist")
 
 
-@router.get("/requests", response_model=List[schemas.FollowRequest])
-async def get_requests(current_user: models.User = Depends(get_current_user)) -> any:
+@router.get("/requests", response_model=List[schemas.FollowRequest],
+            dependencies=[Depends(query_budget(REQUESTS_QUERY_BUDGET))])
+def get_requests(db: Session = Depends(get_read_db),
+                 current_user: Principal = Depends(get_current_principal)) -> any:
 
     """ Displays all incomming follow requests"""
-    return current_user.received_requests
+
+    return db.query(models.FollowRequest).\
+        options(*loaders.follow_request()).\
+        filter(models.FollowRequest.receiver_id == current_user.id).all()
 
 
 @router.post("/request/{request_id}/accept", status_code=status.HTTP_201_CREATED)
-async def accept_request(request_id: int,
-                         db: Session = Depends(get_db),
-                         current_user: models.User = Depends(get_current_user)) -> any:
+def accept_request(request_id: int,
+                   db: Session = Depends(get_db),
+                   current_user: Principal = Depends(get_current_principal)) -> any:
 
     """ Accepts follow requests and creates a following relationship """
 
@@ -100,9 +117,16 @@ async def accept_request(request_id: int,
 
     if followrequest is not None:
         if followrequest.receiver_id == current_user.id:
-            followrequest.sender.follow(current_user)
+            sender_id = followrequest.sender_id
+            sender = db.query(models.User.username).\
+                filter(models.User.id == sender_id).scalar()
+            follow_graph.follow(db, sender_id, current_user.id)
+            timeline.backfill(db, sender_id, current_user.id)
             followrequest_query.delete(synchronize_session=False)
             db.commit()
+            response_cache.invalidate(response_cache.user_tag(current_user.username),
+                                      response_cache.user_tag(sender),
+                                      response_cache.feed_tag(sender_id))
             return {"Success": "Requested Accepted"}
 
         raise HTTPException(
@@ -113,9 +137,9 @@ async def accept_request(request_id: int,
 
 
 @router.delete("/request/{request_id}/delete", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_request(request_id: int,
-                         db: Session = Depends(get_db),
-                         current_user: models.User = Depends(get_current_user)) -> any:
+def delete_request(request_id: int,
+                   db: Session = Depends(get_db),
+                   current_user: Principal = Depends(get_current_principal)) -> any:
 
     """ Deletes a follow request and declines a following relationship """
 
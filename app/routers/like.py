@@ -5,9 +5,11 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session
 
+from app.cache import responses as response_cache
 from app.db import models
 from app.db.db_setup import get_db
-from app.auth.oauth2 import get_current_user
+from app.db import follow_graph, likes
+from app.auth.oauth2 import Principal, get_current_principal
 
 
 # Defining router
@@ -18,20 +20,21 @@ router = APIRouter(tags=["Likes"])
 # Comments CRUD
 
 @router.post("/{post_id}/like", status_code=status.HTTP_201_CREATED)
-async def like_post(post_id: int,
-                    db: Session = Depends(get_db),
-                    current_user: models.User = Depends(get_current_user)) -> any:
+def like_post(post_id: int,
+              db: Session = Depends(get_db),
+              current_user: Principal = Depends(get_current_principal)) -> any:
 
     """ Creates a like on the post"""
 
-    post = db.query(models.Post).filter(models.Post.id == post_id).first()
+    post = db.query(models.Post.id, models.Post.author_id).\
+        filter(models.Post.id == post_id).first()
 
     if post:
-        if post.author in current_user.following:
-            if current_user not in [like.user for like in post.likes]:
-                like = models.Like(post=post, user=current_user)
-                db.add(like)
+        if follow_graph.follows(db, current_user.id, post.author_id):
+            if likes.like(db, current_user.id, post.id):
                 db.commit()
+                response_cache.invalidate(response_cache.post_tag(post.id),
+                                          response_cache.feed_tag(current_user.id))
                 return {"Success": "Liked post!"}
 
             raise HTTPException(
@@ -45,19 +48,20 @@ async def like_post(post_id: int,
 
 
 @router.delete("/{post_id}/unlike", status_code=status.HTTP_204_NO_CONTENT)
-async def unlike_post(post_id: int, db: Session = Depends(get_db),
-                      current_user: models.User = Depends(get_current_user)) -> any:
+def unlike_post(post_id: int, db: Session = Depends(get_db),
+                current_user: Principal = Depends(get_current_principal)) -> any:
 
     """ Deletes a like from the post """
 
-    post = db.query(models.Post).filter(models.Post.id == post_id).first()
+    post = db.query(models.Post.id, models.Post.author_id).\
+        filter(models.Post.id == post_id).first()
 
     if post:
-        if post.author in current_user.following:
-            if current_user in [like.user for like in post.likes]:
-                db.query(models.Like).filter(models.Like.user_id ==
-                                             current_user.id).delete(synchronize_session=False)
+        if follow_graph.follows(db, current_user.id, post.author_id):
+            if likes.unlike(db, current_user.id, post.id):
                 db.commit()
+                response_cache.invalidate(response_cache.post_tag(post.id),
+                                          response_cache.feed_tag(current_user.id))
                 return
 
             raise HTTPException(
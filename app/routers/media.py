@@ -2,12 +2,12 @@
 
 # Imports
 
-from fastapi import APIRouter, Depends, HTTPException, status
-from fastapi.responses import FileResponse
-from sqlalchemy.orm import Session
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Query, Request, Response, status
 
-from app.db import models
-from app.db.db_setup import get_db
+from app.images import index as media_index
+from app.images import jobs, serving, storage, variants
+from app.schema import schemas
 
 
 # Defining router
@@ -15,18 +15,50 @@ from app.db.db_setup import get_db
 router = APIRouter(tags=["media"], prefix="/media")
 
 
+# Picking image variants
+
+def image_variant(request: Request, url: str, sizes: dict,
+                  default_size: str, size: Optional[str],
+                  fmt: Optional[str]) -> Response:
+    """
+    Serves the requested size of an image, in the format asked for or the
+    best one the client accepts. Content addressed images never change, so
+    clients may cache them for good.
+    """
+
+    size = size or default_size
+    if size not in sizes:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Size must be one of {', '.join(sizes)}")
+
+    if fmt and fmt not in variants.MODERN_FORMATS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Format must be one of "
+                            f"{', '.join(variants.MODERN_FORMATS)}")
+
+    file_path, media_type = variants.pick(storage.path_for(url), size,
+                                          default_size,
+                                          request.headers.get("accept"), fmt)
+    cache_control = serving.IMMUTABLE if storage.is_blob(url) \
+        else serving.REVALIDATE
+    return serving.file_response(request, file_path, media_type,
+                                 cache_control, headers={"Vary": "Accept"})
+
+
 # Getting post images
 @router.get("/posts/{image_url}")
-async def get_post_image(image_url: str,
-                         db: Session = Depends(get_db)) -> any:
+def get_post_image(image_url: str,
+                   request: Request,
+                   size: Optional[str] = None,
+                   fmt: Optional[str] = Query(None, alias="format")) -> any:
 
     """ Displays post images """
 
-    post = db.query(models.Post).filter(
-        models.Post.image_url == f"media/posts/{image_url}").first()
-
-    if post:
-        return FileResponse(f"app/media/posts/{image_url}")
+    if media_index.contains(f"media/posts/{image_url}"):
+        return image_variant(request, f"media/posts/{image_url}",
+                             variants.POST_IMAGE_SIZES,
+                             variants.POST_IMAGE_DEFAULT_SIZE,
+                             size, fmt)
 
     raise HTTPException(
         status_code=status.HTTP_404_NOT_FOUND, detail="No post found")
@@ -34,16 +66,33 @@ async def get_post_image(image_url: str,
 
 # Getting user images
 @router.get("/users/{image_url}")
-async def get_user_image(image_url: str,
-                         db: Session = Depends(get_db)) -> any:
+def get_user_image(image_url: str,
+                   request: Request,
+                   size: Optional[str] = None,
+                   fmt: Optional[str] = Query(None, alias="format")) -> any:
 
     """ Displays user images """
 
-    user = db.query(models.User).filter(
-        models.User.profile_pic == f"media/users/{image_url}").first()
-
-    if user:
-        return FileResponse(f"app/media/profile_pictures/{image_url}")
+    if media_index.contains(f"media/users/{image_url}"):
+        return image_variant(request, f"media/users/{image_url}",
+                             variants.PROFILE_PICTURE_SIZES,
+                             variants.PROFILE_PICTURE_DEFAULT_SIZE,
+                             size, fmt)
 
     raise HTTPException(
         status_code=status.HTTP_404_NOT_FOUND, detail="No user found")
+
+
+# Image processing jobs
+@router.get("/jobs/{job_id}", response_model=schemas.ImageJob)
+def get_image_job(job_id: str) -> any:
+
+    """ Displays the status of an image processing job """
+
+    job = jobs.get_job(job_id)
+
+    if job:
+        return job
+
+    raise HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND, detail="No job found")
@@ -4,56 +4,89 @@
 
 from datetime import datetime
 from typing import List, Optional
-from fastapi import APIRouter, Depends, HTTPException, status, File, UploadFile
-from sqlalchemy import desc
+from fastapi import APIRouter, Depends, HTTPException, Response, status, File, UploadFile
+from sqlalchemy import func
 from sqlalchemy.orm import Session
-from PIL import Image
 
-from app.auth.oauth2 import get_current_user
-from app.schema import schemas, forms
+from app.auth.oauth2 import Principal, get_current_principal
+from app.cache import responses as response_cache
+from app.schema import schemas, forms, serializers
 from app.db import models
 from app.db.db_setup import get_db
+from app.db.replicas import get_read_db
+from app.db import comments, follow_graph, loaders, pagination, timeline
+from app.db.instrumentation import query_budget
+from app.images import index as media_index
+from app.images import jobs, storage
 
 # Router
 
 router = APIRouter(tags=['Posts'])
 
 
-# Feed router
-@router.get("/feed", response_model=List[schemas.PostResponse])
-async def get_posts(page: Optional[int] = 1, sort: Optional[str] = None,
-                    db: Session = Depends(get_db),
-                    current_user: models.User = Depends(get_current_user)) -> any:
+# Query budgets, see app.db.instrumentation
+
+FEED_QUERY_BUDGET = 12
+POST_QUERY_BUDGET = 12
+
 
-    """ Displays users feed"""
+# Feed router
+@router.get("/feed", response_model=List[schemas.PostResponse],
+            dependencies=[Depends(query_budget(FEED_QUERY_BUDGET))])
+def get_posts(response: Response,
+              cursor: Optional[str] = None,
+              limit: Optional[int] = None,
+              sort: Optional[str] = None,
+              db: Session = Depends(get_read_db),
+              current_user: Principal = Depends(get_current_principal)) -> any:
+
+    """
+    Displays users feed, the newest posts of their timeline. Sorting by
+    likes ranks those posts, older ones are not in the feed.
+    """
 
     post_query = db.query(models.Post).\
-        join(models.User).\
-        filter(models.Post.author_id.in_([user.id for user in
-                                          current_user.following +
-                                          [current_user]]),
-               models.Post.published == True)
+        filter(models.Post.id.in_(timeline.feed_post_ids(db, current_user.id)),
+               models.Post.published == True,
+               models.Post.status == models.PostStatus.READY)
 
     if sort == "likes":
-        post_query = post_query.order_by(
-            desc(models.Post.likes_count))
+        keys = [models.Post.like_count, models.Post.id]
     else:
-        post_query = post_query.order_by(models.Post.created_at.desc())
-
-    start = 10*(page-1)
-    stop = start+10
-    posts = post_query.slice(start, stop).all()
-
+        keys = [models.Post.created_at, models.Post.id]
+
+    if response_cache.ENABLED:
+        def load_page():
+            posts, next_cursor = pagination.paginate(post_query, keys, cursor, limit)
+            return [post.id for post in posts], next_cursor
+
+        post_ids, next_cursor = response_cache.page(
+            db, response_cache.feed_tag(current_user.id),
+            f"{sort}:{limit}:{cursor}", load_page)
+        if next_cursor:
+            response.headers[pagination.NEXT_CURSOR_HEADER] = next_cursor
+        return response_cache.json_response(response_cache.encode_list(
+            response_cache.post_bodies(db, post_ids)), response)
+
+    post_query = post_query.options(*loaders.post_response())
+    posts, next_cursor = pagination.paginate(post_query, keys, cursor, limit)
+    comments.attach_previews(db, posts)
+    if next_cursor:
+        response.headers[pagination.NEXT_CURSOR_HEADER] = next_cursor
+
+    if serializers.ENABLED:
+        return serializers.json_response(
+            [serializers.post(post) for post in posts], response)
     return posts
 
 
 # Posts CRUD
 
 @router.post("/createpost", status_code=status.HTTP_201_CREATED)
-async def create_post(post: forms.PostCreate = Depends(forms.PostCreate.as_form),
-                      image: UploadFile = File(...),
-                      db: Session = Depends(get_db),
-                      current_user: int = Depends(get_current_user)) -> any:
+def create_post(post: forms.PostCreate = Depends(forms.PostCreate.as_form),
+                image: UploadFile = File(...),
+                db: Session = Depends(get_db),
+                current_user: Principal = Depends(get_current_principal)) -> any:
 
     """ Create a post """
 
@@ -61,45 +94,84 @@ async def create_post(post: forms.PostCreate = Depends(forms.PostCreate.as_form)
 
     if file_extension in [".png", ".jpg", ".jpeg"]:
 
-        post_datetime = datetime.utcnow().strftime("%Y%d%m%H%M%S")
-        filename = str(current_user.id) + "_" + post_datetime + file_extension
-        path = f"app/media/posts/{filename}"
-        newpost = models.Post(author_id=current_user.id,
-                              **post.dict(), image_url=f"media/posts/{filename}")
-        with open(path, "wb") as file:
-            file.write(await image.read())
-
-        image = Image.open(path)
-        image.thumbnail((732, 732))
-        image.save(path)
+        temp_path, digest = storage.save_upload(image.file)
+        image_url = storage.url_for("media/posts", digest, file_extension)
+        storage.retain(db, image_url)
+        upload_path = storage.place_upload(temp_path, image_url)
 
+        # Queued by this worker, others starting meanwhile leave it alone
+        newpost = models.Post(author_id=current_user.id,
+                              **post.dict(), image_url=image_url,
+                              status=models.PostStatus.PROCESSING if upload_path
+                              else models.PostStatus.READY,
+                              resume_claimed_at=func.now() if upload_path else None)
         db.add(newpost)
+        timeline.fan_out_post(db, newpost)
+        post_id = newpost.id
         db.commit()
-
-        return {"Success": "Added post!"}
+        response_cache.invalidate(response_cache.feed_tag(current_user.id))
+
+        # The same image was uploaded before, its variants are ready
+        if upload_path is None:
+            media_index.add(image_url)
+            return {"Success": "Added post!", "post_id": post_id,
+                    "job_id": None, "status": jobs.JobStatus.DONE}
+
+        try:
+            job = jobs.process_post_image(post_id, upload_path,
+                                          storage.path_for(image_url), image_url)
+        except HTTPException:
+            db.delete(newpost)
+            storage.release(db, image_url)
+            db.commit()
+            raise
+
+        return {"Success": "Added post!", "post_id": post_id,
+                "job_id": job.id, "status": job.status}
 
     raise HTTPException(
         status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 
 
-@router.get("/{username}/{post_id}", response_model=schemas.PostResponse)
-async def get_post(username: str,
-                   post_id: int,
-                   db: Session = Depends(get_db),
-                   current_user: models.User = Depends(get_current_user)) -> any:
+@router.get("/{username}/{post_id}", response_model=schemas.PostResponse,
+            dependencies=[Depends(query_budget(POST_QUERY_BUDGET))])
+def get_post(username: str,
+             post_id: int,
+             response: Response,
+             db: Session = Depends(get_read_db),
+             current_user: Principal = Depends(get_current_principal)) -> any:
 
     """ View user's post """
 
+    if response_cache.ENABLED:
+        card = response_cache.profile_card(db, username)
+        if card is None or not follow_graph.can_view(db, current_user.id, card["id"]):
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED, detail="User not in following")
+
+        body = response_cache.post_body(db, post_id, card["id"])
+        if body is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="Post doesn't exist")
+        return response_cache.json_response(body, response)
+
     user = db.query(models.User).filter(
         models.User.username == username).first()
 
-    if user not in current_user.following and user is not current_user:
+    if user is None or not follow_graph.can_view(db, current_user.id, user.id):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="User not in following")
 
-    post = db.query(models.Post).filter(models.Post.id == post_id).first()
+    post = db.query(models.Post).\
+        options(*loaders.post_response()).\
+        filter(models.Post.id == post_id,
+               models.Post.author_id == user.id,
+               models.Post.status == models.PostStatus.READY).first()
 
     if post:
+        comments.attach_previews(db, [post])
+        if serializers.ENABLED:
+            return serializers.json_response(serializers.post(post), response)
         return post
 
     raise HTTPException(
@@ -108,12 +180,12 @@ async def get_post(username: str,
 
 @router.put("/{username}/{post_id}",
             status_code=status.HTTP_202_ACCEPTED)
-async def edit_post(username: str,
-                    post_id: int,
-                    new_data: forms.PostUpdate = Depends(
-                        forms.PostUpdate.as_form),
-                    db: Session = Depends(get_db),
-                    current_user: models.User = Depends(get_current_user)) -> any:
+def edit_post(username: str,
+              post_id: int,
+              new_data: forms.PostUpdate = Depends(
+                  forms.PostUpdate.as_form),
+              db: Session = Depends(get_db),
+              current_user: Principal = Depends(get_current_principal)) -> any:
 
     """ Edit user's post """
 
@@ -130,6 +202,8 @@ async def edit_post(username: str,
                          if value is not None}
         post_query.update(new_data_dict, synchronize_session=False)
         db.commit()
+        response_cache.invalidate(response_cache.post_tag(post_id),
+                                  response_cache.feed_tag(current_user.id))
 
         return {"Success": "post updated"}
 
@@ -138,10 +212,10 @@ async def edit_post(username: str,
 
 
 @router.delete("/{username}/{post_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_post(username: str,
-                      post_id: int,
-                      db: Session = Depends(get_db),
-                      current_user: models.User = Depends(get_current_user)) -> any:
+def delete_post(username: str,
+                post_id: int,
+                db: Session = Depends(get_db),
+                current_user: Principal = Depends(get_current_principal)) -> any:
 
     """ Delete user's post"""
 
@@ -153,8 +227,13 @@ async def delete_post(username: str,
     post = post_query.first()
 
     if post:
+        image_url = post.image_url
         post_query.delete(synchronize_session=False)
+        storage.release(db, image_url)
         db.commit()
+        response_cache.invalidate(response_cache.post_tag(post_id),
+                                  response_cache.feed_tag(current_user.id))
+        media_index.discard(image_url)
         return
 
     raise HTTPException(
@@ -3,15 +3,21 @@
 # Imports
 
 from typing import List, Optional, Union
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile
-from sqlalchemy import or_
+from fastapi import APIRouter, Depends, HTTPException, Response, status, UploadFile
 from sqlalchemy.orm import Session
-from PIL import Image
 
-from app.schema import schemas, forms
+from app.cache import responses as response_cache
+from app.schema import schemas, forms, serializers
 from app.db import models
 from app.db.db_setup import get_db
-from app.auth.oauth2 import get_current_user
+from app.db.replicas import get_read_db
+from app.db import comments, counters, follow_graph, loaders, pagination
+from app.db import search as user_search
+from app.db.instrumentation import query_budget
+from app.images import index as media_index
+from app.images import jobs, storage
+from app.auth import oauth2
+from app.auth.oauth2 import Principal, get_current_principal
 
 # Defining router
 
@@ -20,95 +26,239 @@ router = APIRouter(prefix="/users",
                    )
 
 
-# User search
-@router.get("/", response_model=List[schemas.UserFollow])
-async def search_users(search: str = " ",
-                       db: Session = Depends(get_db),
-                       current_user: models.User = Depends(get_current_user)) -> any:
-
-    """ Searches for users with similar username/name as the query """
-    
-    if search == " ":
-      users = db.query(models.User).all()
-      return users
-
-    search_query = f"%{search}%"
-    users = db.query(models.User).filter(or_(models.User.username.ilike(search_query),
-                                             models.User.fullname.ilike(
-                                                 search_query),
-                                             models.User.description.ilike(search_query))).all()
+# Query budgets, see app.db.instrumentation
+
+SEARCH_QUERY_BUDGET = 2
+PROFILE_QUERY_BUDGET = 12
+FOLLOWS_QUERY_BUDGET = 4
+
 
+# User search
+@router.get("/", response_model=List[schemas.UserFollow],
+            dependencies=[Depends(query_budget(SEARCH_QUERY_BUDGET))])
+def search_users(response: Response,
+                 search: str = "",
+                 prefix: bool = False,
+                 cursor: Optional[str] = None,
+                 limit: Optional[int] = None,
+                 db: Session = Depends(get_read_db),
+                 current_user: Principal = Depends(get_current_principal)) -> any:
+
+    """
+    Searches for users by the words of their username, name and description,
+    best matches first, or with prefix=true by the start of their username
+    for type-ahead. Without a search every user is listed.
+    """
+
+    if prefix:
+        users, next_cursor = user_search.type_ahead(db, search, cursor, limit)
+    elif search.strip():
+        users, next_cursor = user_search.full_text(db, search, cursor, limit)
+    else:
+        users, next_cursor = pagination.paginate(db.query(models.User),
+                                                 [models.User.id], cursor,
+                                                 limit, descending=False)
+
+    if next_cursor:
+        response.headers[pagination.NEXT_CURSOR_HEADER] = next_cursor
+
+    if serializers.ENABLED:
+        return serializers.json_response(
+            [serializers.user_follow(user) for user in users], response)
     return users
 
 
 # Users CRUD
 
 @router.get("/{username}", response_model=Union[schemas.UserProfileView,
-                                                schemas.UserProfileViewUnfollower])
-async def get_user(username: str, db: Session = Depends(get_db),
-                   current_user: models.User = Depends(get_current_user)) -> any:
+                                                schemas.UserProfileViewUnfollower],
+            dependencies=[Depends(query_budget(PROFILE_QUERY_BUDGET))])
+def get_user(username: str,
+             response: Response,
+             cursor: Optional[str] = None,
+             limit: Optional[int] = None,
+             db: Session = Depends(get_read_db),
+             current_user: Principal = Depends(get_current_principal)) -> any:
 
-    """ Displays a user """
+    """ Displays a user, with their posts paginated by cursor """
 
-    user = db.query(models.User).filter(
-        models.User.username == username).first()
+    if response_cache.ENABLED:
+        return _cached_profile(username, response, cursor, limit, db, current_user)
 
-    if user:
-        if user == current_user:
-            return schemas.UserProfileView.from_orm(user)
-        if user in current_user.following:
-            user_response = schemas.UserProfileView.from_orm(user)
-            user_response.posts = db.query(models.Post).filter(
-                models.Post.author == user, models.Post.published == True).all()
-            return user_response
+    user = db.query(models.User).\
+        filter(models.User.username == username).first()
 
-        user.follower_count = len(user.followers)
-        user.following_count = len(user.following)
-        user_response = schemas.UserProfileViewUnfollower.from_orm(user)
-
-        return user_response
+    if user:
+        if follow_graph.can_view(db, current_user.id, user.id):
+            post_query = db.query(models.Post).\
+                options(*loaders.post_response()).\
+                filter(models.Post.author_id == user.id,
+                       models.Post.status == models.PostStatus.READY)
+            if user.id != current_user.id:
+                post_query = post_query.filter(models.Post.published == True)
+
+            posts, next_cursor = pagination.paginate(
+                post_query, [models.Post.created_at, models.Post.id],
+                cursor, limit)
+            comments.attach_previews(db, posts)
+            if next_cursor:
+                response.headers[pagination.NEXT_CURSOR_HEADER] = next_cursor
+
+            if serializers.ENABLED:
+                return serializers.json_response(
+                    serializers.profile(user, posts), response)
+            return schemas.UserProfileView(id=user.id,
+                                           username=user.username,
+                                           fullname=user.fullname,
+                                           profile_pic=user.profile_pic,
+                                           description=user.description,
+                                           posts=posts,
+                                           follower_count=user.follower_count,
+                                           following_count=user.following_count)
+
+        if serializers.ENABLED:
+            return serializers.json_response(
+                serializers.profile_unfollower(user), response)
+        return schemas.UserProfileViewUnfollower.from_orm(user)
 
     raise HTTPException(
         status_code=status.HTTP_404_NOT_FOUND, detail="User doesn't exist")
 
 
+def _cached_profile(username: str, response: Response, cursor: Optional[str],
+                    limit: Optional[int], db: Session, current_user: Principal) -> any:
+    """ Serves a profile from the cached card and post bodies """
+
+    card = response_cache.profile_card(db, username)
+    if card is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="User doesn't exist")
+
+    if not follow_graph.can_view(db, current_user.id, card["id"]):
+        return response_cache.json_response(serializers.encode(card), response)
+
+    post_query = db.query(models.Post.id, models.Post.created_at).\
+        filter(models.Post.author_id == card["id"],
+               models.Post.status == models.PostStatus.READY)
+    if card["id"] != current_user.id:
+        post_query = post_query.filter(models.Post.published == True)
+
+    posts, next_cursor = pagination.paginate(
+        post_query, [models.Post.created_at, models.Post.id], cursor, limit)
+    if next_cursor:
+        response.headers[pagination.NEXT_CURSOR_HEADER] = next_cursor
+
+    bodies = response_cache.post_bodies(db, [post.id for post in posts])
+    return response_cache.json_response(
+        response_cache.encode_profile(card, bodies), response)
+
+
+def _follow_list(username: str, response: Response, cursor: Optional[str],
+                 limit: Optional[int], db: Session, current_user: Principal,
+                 page: any) -> any:
+    """ Serves one page of a follow list of a user the current user can view """
+
+    user_id = db.query(models.User.id).\
+        filter(models.User.username == username).scalar()
+
+    if user_id is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="User doesn't exist")
+
+    if not follow_graph.can_view(db, current_user.id, user_id):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="User not in following")
+
+    users, next_cursor = page(db, user_id, cursor, limit)
+    if next_cursor:
+        response.headers[pagination.NEXT_CURSOR_HEADER] = next_cursor
+
+    if serializers.ENABLED:
+        return serializers.json_response(
+            [serializers.user_follow(user) for user in users], response)
+    return users
+
+
+@router.get("/{username}/followers", response_model=List[schemas.UserFollow],
+            dependencies=[Depends(query_budget(FOLLOWS_QUERY_BUDGET))])
+def get_followers(username: str,
+                  response: Response,
+                  cursor: Optional[str] = None,
+                  limit: Optional[int] = None,
+                  db: Session = Depends(get_read_db),
+                  current_user: Principal = Depends(get_current_principal)) -> any:
+
+    """ Displays a user's followers, paginated by cursor """
+
+    return _follow_list(username, response, cursor, limit, db, current_user,
+                        follow_graph.followers)
+
+
+@router.get("/{username}/following", response_model=List[schemas.UserFollow],
+            dependencies=[Depends(query_budget(FOLLOWS_QUERY_BUDGET))])
+def get_following(username: str,
+                  response: Response,
+                  cursor: Optional[str] = None,
+                  limit: Optional[int] = None,
+                  db: Session = Depends(get_read_db),
+                  current_user: Principal = Depends(get_current_principal)) -> any:
+
+    """ Displays the users a user follows, paginated by cursor """
+
+    return _follow_list(username, response, cursor, limit, db, current_user,
+                        follow_graph.following)
+
+
 @router.put("/{username}")
-async def edit_user(username: str,
-                    profile_pic: Optional[UploadFile] = None,
-                    new_data: forms.UserUpdate = Depends(
-                        forms.UserUpdate.as_form),
-                    db: Session = Depends(get_db),
-                    current_user: models.User = Depends(get_current_user)) -> any:
+def edit_user(username: str,
+              profile_pic: Optional[UploadFile] = None,
+              new_data: forms.UserUpdate = Depends(
+                  forms.UserUpdate.as_form),
+              db: Session = Depends(get_db),
+              current_user: Principal = Depends(get_current_principal)) -> any:
 
     """ Updates a user """
 
     if username == current_user.username:
+        job = None
         if profile_pic:
             file_extension = "." + profile_pic.filename.split(".")[-1]
             if file_extension in [".png", ".jpg", ".jpeg"]:
-                filename = f"{current_user.id}_{current_user.username}{file_extension}"
-                path = f"app/media/profile_pictures/{filename}"
-                with open(path, "wb") as file:
-                    file.write(await profile_pic.read())
-
-                profile_pic = f"media/users/{filename}"
-                image = Image.open(path)
-                image.resize((400, 400)).save(path)
+                temp_path, digest = storage.save_upload(profile_pic.file)
+                picture_url = storage.url_for("media/users", digest, file_extension)
+                storage.retain(db, picture_url)
+                storage.place_upload(temp_path, picture_url)
+                db.commit()
+
+                # Already processed pictures finish on the first attempt
+                path = storage.path_for(picture_url)
+                try:
+                    job = jobs.process_profile_picture(current_user.id,
+                                                       path + storage.UPLOAD_SUFFIX,
+                                                       path, picture_url)
+                except HTTPException:
+                    storage.release(db, picture_url)
+                    db.commit()
+                    raise
 
             else:
                 raise HTTPException(
                     status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 
-        new_data_dict = {field: value for field,
-                         value in {**new_data.dict(),
-                                   **{"profile_pic": profile_pic}}.items()
+        new_data_dict = {field: value for field, value in new_data.dict().items()
                          if value is not None}
 
-        db.query(models.User).filter(models.User.id == current_user.id).\
-            update(new_data_dict,
-                   synchronize_session=False)
-
-        db.commit()
+        if new_data_dict:
+            db.query(models.User).filter(models.User.id == current_user.id).\
+                update(new_data_dict,
+                       synchronize_session=False)
+            db.commit()
+            oauth2.invalidate_user(current_user.id)
+            response_cache.invalidate_user(db, current_user.id, username)
+
+        if job:
+            return {"Success": "User updated", "job_id": job.id,
+                    "status": job.status}
         return {"Success": "User updated"}
 
     raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
@@ -116,17 +266,33 @@ async def edit_user(username: str,
 
 
 @ router.delete("/{username}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_user(username: str,
-                      db: Session = Depends(get_db),
-                      current_user: models.User = Depends(get_current_user)) -> any:
+def delete_user(username: str,
+                db: Session = Depends(get_db),
+                current_user: Principal = Depends(get_current_principal)) -> any:
 
     """ Deletes a user """
 
     if username == current_user.username:
 
+        counters.release_user(db, current_user.id)
+        posts = db.query(models.Post.id, models.Post.image_url).\
+            filter(models.Post.author_id == current_user.id).all()
+        media_urls = [post.image_url for post in posts]
+        media_urls.append(db.query(models.User.profile_pic).
+                          filter(models.User.id == current_user.id).scalar())
+        for url in media_urls:
+            storage.release(db, url)
+
         db.query(models.User).filter(models.User.username ==
                                      username).delete(synchronize_session=False)
         db.commit()
+
+        oauth2.invalidate_user(current_user.id)
+        response_cache.invalidate(response_cache.user_tag(username),
+                                  response_cache.feed_tag(current_user.id),
+                                  *(response_cache.post_tag(post.id)
+                                    for post in posts))
+        media_index.discard(*media_urls)
         return
 
     raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
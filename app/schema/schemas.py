@@ -38,20 +38,23 @@ class UserProfileViewUnfollower(ORMBase):
 
 class ReplyResponse(ORMBase):
     """ Reply response schema """
+    id: int
     author_id: int
     parent_id: int
     author: UserFollow
     content: str
+    created_at: datetime
 
 
 class CommentResponse(ORMBase):
-    """ Comment response schema """
+    """ Comment response schema, replies are paged separately """
     id: int
     post_id: int
     author_id: int
     author: UserFollow
     content: str
-    replies: List[ReplyResponse]
+    created_at: datetime
+    reply_count: int
 
 
 class LikeResponse(ORMBase):
@@ -70,7 +73,8 @@ class PostResponse(ORMBase):
     location: Optional[str]
     created_at: datetime
     likes: List[LikeResponse]
-    comments: List[CommentResponse]
+    comment_count: int
+    top_comments: List[CommentResponse]
 
 
 class UserProfileView(ORMBase):
@@ -81,8 +85,8 @@ class UserProfileView(ORMBase):
     profile_pic: Optional[str]
     description: Optional[str]
     posts: List[PostResponse]
-    following: List[UserFollow]
-    followers: List[UserFollow]
+    follower_count: int
+    following_count: int
 
 
 class FollowRequestCreate(ORMBase):
@@ -104,6 +108,15 @@ class CommentCreate(ORMBase):
     content: str
 
 
+class ImageJob(ORMBase):
+    """ Image processing job status schema """
+    id: str
+    kind: str
+    status: str
+    attempts: int
+    error: Optional[str]
+
+
 class Token(BaseModel):
     """ JWT Token schema """
     access_token: str
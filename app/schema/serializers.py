@@ -0,0 +1,118 @@
+""" Module encoding hot responses straight from ORM objects, bypassing Pydantic """
+
+# Imports
+
+from typing import List
+import orjson
+from fastapi import Response
+
+from app.config import settings
+from app.db import models
+
+
+# Serializer settings
+
+ENABLED = settings.fast_json_responses
+
+
+# Serializers
+#
+# Each function returns what FastAPI would send for the same object through
+# the matching schema in app.schema.schemas, keys in field order, so both
+# paths encode to the same bytes. Keep them in step with the schemas,
+# python -m benchmarks.serialization checks that they agree.
+
+def user_follow(user: models.User) -> dict:
+    """ Same as schemas.UserFollow """
+
+    return {"id": user.id,
+            "fullname": user.fullname,
+            "username": user.username,
+            "profile_pic": user.profile_pic}
+
+
+def like(post_like: models.Like) -> dict:
+    """ Same as schemas.LikeResponse """
+
+    return {"user_id": post_like.user_id,
+            "post_id": post_like.post_id,
+            "user": user_follow(post_like.user)}
+
+
+def comment(post_comment: models.Comment) -> dict:
+    """ Same as schemas.CommentResponse, reply_count being attached """
+
+    return {"id": post_comment.id,
+            "post_id": post_comment.post_id,
+            "author_id": post_comment.author_id,
+            "author": user_follow(post_comment.author),
+            "content": post_comment.content,
+            "created_at": post_comment.created_at,
+            "reply_count": post_comment.reply_count}
+
+
+def reply(comment_reply: models.Comment) -> dict:
+    """ Same as schemas.ReplyResponse """
+
+    return {"id": comment_reply.id,
+            "author_id": comment_reply.author_id,
+            "parent_id": comment_reply.parent_id,
+            "author": user_follow(comment_reply.author),
+            "content": comment_reply.content,
+            "created_at": comment_reply.created_at}
+
+
+def post(user_post: models.Post) -> dict:
+    """ Same as schemas.PostResponse, top_comments being attached """
+
+    return {"id": user_post.id,
+            "author": user_follow(user_post.author),
+            "image_url": user_post.image_url,
+            "description": user_post.description,
+            "location": user_post.location,
+            "created_at": user_post.created_at,
+            "likes": [like(post_like) for post_like in user_post.likes],
+            "comment_count": user_post.comment_count,
+            "top_comments": [comment(post_comment)
+                             for post_comment in user_post.top_comments]}
+
+
+def profile(user: models.User, posts: List[models.Post]) -> dict:
+    """ Same as schemas.UserProfileView """
+
+    return {"id": user.id,
+            "username": user.username,
+            "fullname": user.fullname,
+            "profile_pic": user.profile_pic,
+            "description": user.description,
+            "posts": [post(user_post) for user_post in posts],
+            "follower_count": user.follower_count,
+            "following_count": user.following_count}
+
+
+def profile_unfollower(user: models.User) -> dict:
+    """ Same as schemas.UserProfileViewUnfollower """
+
+    return {"id": user.id,
+            "fullname": user.fullname,
+            "username": user.username,
+            "profile_pic": user.profile_pic,
+            "description": user.description,
+            "follower_count": user.follower_count,
+            "following_count": user.following_count}
+
+
+# Responses
+
+def encode(content: any) -> bytes:
+    """ Encodes serialized content the way FastAPI's JSONResponse would """
+    return orjson.dumps(content)
+
+
+def json_response(content: any, response: Response) -> Response:
+    """
+    Returns serialized content as a JSON response, keeping the headers
+    set on the route's response, such as the next page cursor
+    """
+    return Response(encode(content), media_type="application/json",
+                    headers=response.headers)
@@ -0,0 +1,139 @@
+"""
+Concurrency benchmark for blocking database calls in route handlers
+
+Serves the same slow and fast queries from `async def` handlers, which run
+the synchronous session on the event loop, and from `def` handlers, which
+FastAPI runs in its threadpool. Slow and fast requests are fired together
+and the throughput and fast request latency of both styles are reported.
+Blocking handlers can also exhaust the connection pool while the sessions
+they hold wait on the blocked loop to be closed, which shows up as errors.
+
+Usage - python -m benchmarks.event_loop [--slow 20] [--fast 200] [--sleep 0.5]
+"""
+
+# Imports
+
+import argparse
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import uvicorn
+from fastapi import Depends, FastAPI
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from app.db.db_setup import get_db
+
+
+# Benchmark apps
+
+def build_app(sleep: float) -> FastAPI:
+    """ Builds an app serving the same queries from both handler styles """
+
+    app = FastAPI()
+
+    @app.get("/async/slow")
+    async def async_slow(db: Session = Depends(get_db)):
+        db.execute(text("SELECT pg_sleep(:s)"), {"s": sleep})
+        return {}
+
+    @app.get("/async/fast")
+    async def async_fast(db: Session = Depends(get_db)):
+        db.execute(text("SELECT 1"))
+        return {}
+
+    @app.get("/sync/slow")
+    def sync_slow(db: Session = Depends(get_db)):
+        db.execute(text("SELECT pg_sleep(:s)"), {"s": sleep})
+        return {}
+
+    @app.get("/sync/fast")
+    def sync_fast(db: Session = Depends(get_db)):
+        db.execute(text("SELECT 1"))
+        return {}
+
+    return app
+
+
+def serve(app: FastAPI, port: int) -> uvicorn.Server:
+    """ Starts a single worker uvicorn server in a background thread """
+
+    server = uvicorn.Server(uvicorn.Config(app, port=port, log_level="error"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+# Load generation
+
+def timed_get(url: str) -> float:
+    """ Returns the latency of a GET request in milliseconds, None on failure """
+
+    start = time.perf_counter()
+    try:
+        requests.get(url, timeout=60).raise_for_status()
+    except requests.RequestException:
+        return None
+    return (time.perf_counter() - start) * 1000
+
+
+def percentile(latencies: list, fraction: float) -> float:
+    """ Returns a percentile of sorted latencies, nan when all requests failed """
+
+    if not latencies:
+        return float("nan")
+    return latencies[max(0, math.ceil(len(latencies) * fraction) - 1)]
+
+
+def run(base_url: str, style: str, slow: int, fast: int) -> dict:
+    """ Fires slow and fast requests together and collects their latencies """
+
+    urls = [f"{base_url}/{style}/slow"] * slow + \
+        [f"{base_url}/{style}/fast"] * fast
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        latencies = list(executor.map(timed_get, urls))
+    elapsed = time.perf_counter() - start
+
+    fast_latencies = sorted(latency for latency in latencies[slow:]
+                            if latency is not None)
+    return {
+        "style": style,
+        "throughput": len(urls) / elapsed,
+        "errors": latencies.count(None),
+        "fast_p50": percentile(fast_latencies, 0.50),
+        "fast_p95": percentile(fast_latencies, 0.95),
+    }
+
+
+def main() -> None:
+    """ Runs the benchmark for both handler styles and prints the results """
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--slow", type=int, default=20)
+    parser.add_argument("--fast", type=int, default=200)
+    parser.add_argument("--sleep", type=float, default=0.5)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    server = serve(build_app(args.sleep), args.port)
+    base_url = f"http://127.0.0.1:{args.port}"
+
+    print(f"{'handlers':<10}{'req/s':>10}{'errors':>8}"
+          f"{'fast p50 ms':>14}{'fast p95 ms':>14}")
+    # The blocking style runs last as it can leave pool connections stuck
+    for style in ("sync", "async"):
+        result = run(base_url, style, args.slow, args.fast)
+        print(f"{result['style']:<10}{result['throughput']:>10.1f}"
+              f"{result['errors']:>8}{result['fast_p50']:>14.1f}"
+              f"{result['fast_p95']:>14.1f}")
+
+    server.should_exit = True
+
+
+if __name__ == "__main__":
+    main()
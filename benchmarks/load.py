@@ -0,0 +1,331 @@
+"""
+Load test of a running server on the synthetic social graph
+
+Logs in users of the graph loaded by benchmarks.social_graph, then keeps a
+number of concurrent clients calling /login, /feed, /{post_id}/like,
+/createpost and /users/ in a weighted mix for a while and reports the
+throughput, errors and p50, p95 and p99 latencies of each endpoint. Likes
+go to other authors' posts the user saw in their feed, so they succeed or
+find the post already liked, and uploads are new images so they are
+processed. Results are saved under benchmarks/results/ with the commit
+they ran on, and can be compared with an earlier run.
+
+Usage - python -m benchmarks.load [--url http://127.0.0.1:8000] [--duration 60] [--concurrency 16] [--mix feed=50,like=20,users=15,createpost=5,login=10] [--label name] [--compare latest|path]
+"""
+
+# Imports
+
+import argparse
+import glob
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+import requests
+from PIL import Image
+
+from benchmarks.event_loop import percentile
+from benchmarks.social_graph import MANIFEST_PATH, RESULTS_DIR
+
+
+# Load test settings
+
+DEFAULT_MIX = "feed=50,like=20,users=15,createpost=5,login=10"
+# Statuses the app answers correctly under load, a like of a post already
+# liked is a 409
+EXPECTED = {"login": {200}, "feed": {200}, "like": {201, 409},
+            "users": {200}, "createpost": {201}}
+TIMEOUT_SECONDS = 30
+
+
+# Clients
+
+class VirtualUser:
+    """ A logged in user of the graph and the posts their feed showed """
+
+    def __init__(self, username: str, token: str):
+        self.username = username
+        self.token = token
+        self.seen_posts: List[int] = []
+
+    @property
+    def headers(self) -> dict:
+        return {"Authorization": f"Bearer {self.token}"}
+
+
+class Client:
+    """ Calls the endpoints for virtual users over one HTTP session """
+
+    def __init__(self, base_url: str, manifest: dict, rng: random.Random):
+        self.base_url = base_url
+        self.manifest = manifest
+        self.rng = rng
+        self.session = requests.Session()
+
+    def login(self, username: str) -> requests.Response:
+        return self.session.post(f"{self.base_url}/login",
+                                 data={"username": username,
+                                       "password": self.manifest["password"]},
+                                 timeout=TIMEOUT_SECONDS)
+
+    def feed(self, user: VirtualUser) -> requests.Response:
+        response = self.session.get(f"{self.base_url}/feed", headers=user.headers,
+                                    timeout=TIMEOUT_SECONDS)
+        if response.status_code == 200:
+            seen_posts = [post["id"] for post in response.json()
+                          if post["author"]["username"] != user.username]
+            # Kept when empty, so a like never finds none after checking
+            if seen_posts:
+                user.seen_posts = seen_posts
+        return response
+
+    def like(self, user: VirtualUser) -> requests.Response:
+        return self.session.post(f"{self.base_url}/{self.rng.choice(user.seen_posts)}/like",
+                                 headers=user.headers, timeout=TIMEOUT_SECONDS)
+
+    def users(self, user: VirtualUser) -> requests.Response:
+        term = self.rng.choice(self.manifest["search_terms"])
+        return self.session.get(f"{self.base_url}/users/",
+                                params={"search": term,
+                                        "prefix": self.rng.random() < 0.5},
+                                headers=user.headers, timeout=TIMEOUT_SECONDS)
+
+    def createpost(self, user: VirtualUser) -> requests.Response:
+        image = io.BytesIO()
+        color = tuple(self.rng.randrange(256) for _ in range(3))
+        Image.new("RGB", (320, 320), color).save(image, "PNG")
+        return self.session.post(f"{self.base_url}/createpost",
+                                 files={"image": ("load.png", image.getvalue(), "image/png")},
+                                 data={"description": "load test", "published": "true"},
+                                 headers=user.headers, timeout=TIMEOUT_SECONDS)
+
+
+def log_in(base_url: str, manifest: dict, count: int, rng: random.Random) -> List[VirtualUser]:
+    """ Logs in sample users of the graph, they share one password """
+
+    client = Client(base_url, manifest, rng)
+    users = []
+    for username in rng.sample(manifest["usernames"], min(count, len(manifest["usernames"]))):
+        response = client.login(username)
+        if response.status_code != 200:
+            sys.exit(f"Could not log in {username}: {response.status_code} {response.text}")
+        users.append(VirtualUser(username, response.json()["access_token"]))
+    return users
+
+
+# Load
+
+class Recorder:
+    """ Latencies and statuses of each endpoint, shared by the clients """
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Counter] = defaultdict(Counter)
+        self._lock = threading.Lock()
+
+    def record(self, endpoint: str, milliseconds: float, status: str) -> None:
+        with self._lock:
+            self.latencies[endpoint].append(milliseconds)
+            self.statuses[endpoint][status] += 1
+
+
+def run_client(client: Client, users: List[VirtualUser], mix: Dict[str, int],
+               recorder: Optional[Recorder], deadline: float) -> None:
+    """ Calls endpoints picked by weight for random users until the deadline """
+
+    endpoints, weights = list(mix), list(mix.values())
+    while time.monotonic() < deadline:
+        endpoint = client.rng.choices(endpoints, weights)[0]
+        user = client.rng.choice(users)
+        # Only followed authors' posts can be liked, users look at their feed first
+        if endpoint == "like" and not user.seen_posts:
+            endpoint = "feed"
+        start = time.perf_counter()
+        try:
+            if endpoint == "login":
+                response = client.login(user.username)
+            else:
+                response = getattr(client, endpoint)(user)
+            status = str(response.status_code)
+        except requests.RequestException as exc:
+            status = type(exc).__name__
+        if recorder is not None:
+            recorder.record(endpoint, (time.perf_counter() - start) * 1000, status)
+
+
+def run(base_url: str, manifest: dict, users: List[VirtualUser], mix: Dict[str, int],
+        concurrency: int, seconds: float, recorder: Optional[Recorder], seed: int) -> float:
+    """ Runs the clients for a number of seconds and returns the time taken """
+
+    deadline = time.monotonic() + seconds
+    threads = [threading.Thread(target=run_client,
+                                args=(Client(base_url, manifest, random.Random(seed + number)),
+                                      users, mix, recorder, deadline))
+               for number in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def summarize(recorder: Recorder, elapsed: float) -> dict:
+    """ Returns the throughput, errors and latency percentiles of each endpoint """
+
+    def summary(latencies: List[float], requests_made: int, errors: int) -> dict:
+        latencies = sorted(latencies)
+        return {"requests": requests_made,
+                "errors": errors,
+                "throughput": requests_made / elapsed,
+                "p50": percentile(latencies, 0.50),
+                "p95": percentile(latencies, 0.95),
+                "p99": percentile(latencies, 0.99),
+                "max": latencies[-1] if latencies else float("nan")}
+
+    endpoints = {}
+    for endpoint, statuses in sorted(recorder.statuses.items()):
+        errors = sum(count for status, count in statuses.items()
+                     if not status.isdigit() or int(status) not in EXPECTED[endpoint])
+        endpoints[endpoint] = {**summary(recorder.latencies[endpoint],
+                                         sum(statuses.values()), errors),
+                               "statuses": dict(statuses)}
+
+    every = [latency for latencies in recorder.latencies.values() for latency in latencies]
+    total = summary(every, len(every), sum(endpoint["errors"] for endpoint in endpoints.values()))
+    return {"endpoints": endpoints, "total": total}
+
+
+# Results
+
+def commit() -> Optional[str]:
+    """ Returns the checked out commit, with a mark if the tree has changes """
+
+    try:
+        head = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{head}-dirty" if dirty else head
+
+
+def save(result: dict) -> str:
+    """ Writes a run's results and returns the file's path """
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    name = "load-" + result["started_at"].replace(":", "").replace("-", "")[:15]
+    if result["label"]:
+        name += f"-{result['label']}"
+    path = os.path.join(RESULTS_DIR, f"{name}.json")
+    with open(path, "w", encoding="utf-8") as results:
+        json.dump(result, results, indent=2)
+    return path
+
+
+def load_baseline(compare: str) -> dict:
+    """ Reads the results to compare with, latest being the last saved run """
+
+    if compare == "latest":
+        runs = sorted(glob.glob(os.path.join(RESULTS_DIR, "load-*.json")))
+        if not runs:
+            sys.exit(f"No saved runs in {RESULTS_DIR} to compare with")
+        compare = runs[-1]
+    with open(compare, encoding="utf-8") as results:
+        return json.load(results)
+
+
+def print_results(result: dict) -> None:
+    print(f"{'endpoint':<12}{'requests':>10}{'errors':>8}{'req/s':>10}"
+          f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for endpoint, stats in [*result["endpoints"].items(), ("total", result["total"])]:
+        print(f"{endpoint:<12}{stats['requests']:>10}{stats['errors']:>8}"
+              f"{stats['throughput']:>10.1f}{stats['p50']:>10.1f}{stats['p95']:>10.1f}"
+              f"{stats['p99']:>10.1f}{stats['max']:>10.1f}")
+
+
+def print_comparison(baseline: dict, result: dict) -> None:
+    """ Prints the change of each endpoint's throughput and latencies from a baseline """
+
+    print(f"\nCompared with {baseline['label'] or baseline['started_at']}"
+          f" ({baseline['commit']}), change in %")
+    print(f"{'endpoint':<12}{'req/s':>10}{'p50':>10}{'p95':>10}{'p99':>10}")
+    current = {**result["endpoints"], "total": result["total"]}
+    before = {**baseline["endpoints"], "total": baseline["total"]}
+    for endpoint, stats in current.items():
+        if endpoint not in before:
+            continue
+        changes = [(stats[key] - before[endpoint][key]) / before[endpoint][key] * 100
+                   if before[endpoint][key] else float("nan")
+                   for key in ("throughput", "p50", "p95", "p99")]
+        print(f"{endpoint:<12}" + "".join(f"{change:>+10.1f}" for change in changes))
+
+
+def main() -> None:
+    """ Logs in users, warms up, runs the load and reports, saves and compares it """
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--warmup", type=float, default=5)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--users", type=int, default=200,
+                        help="logged in users the clients act as")
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help="weights of the endpoints")
+    parser.add_argument("--label", default="")
+    parser.add_argument("--compare", help="latest or the path of saved results")
+    parser.add_argument("--no-save", action="store_true")
+    parser.add_argument("--manifest", default=MANIFEST_PATH)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    mix = {endpoint: int(weight) for endpoint, weight in
+           (part.split("=") for part in args.mix.split(","))}
+    unknown = set(mix) - set(EXPECTED)
+    if unknown:
+        sys.exit(f"Unknown endpoints {', '.join(sorted(unknown))}, "
+                 f"the mix takes {', '.join(EXPECTED)}")
+
+    with open(args.manifest, encoding="utf-8") as manifest_file:
+        manifest = json.load(manifest_file)
+    # Loaded before the run so a saved run is not its own baseline
+    baseline = load_baseline(args.compare) if args.compare else None
+
+    rng = random.Random(args.seed)
+    users = log_in(args.url.rstrip("/"), manifest, args.users, rng)
+    run(args.url.rstrip("/"), manifest, users, mix, args.concurrency, args.warmup,
+        None, args.seed)
+
+    recorder = Recorder()
+    started_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    elapsed = run(args.url.rstrip("/"), manifest, users, mix, args.concurrency,
+                  args.duration, recorder, args.seed + args.concurrency)
+
+    result = {"label": args.label,
+              "started_at": started_at,
+              "commit": commit(),
+              "url": args.url,
+              "duration": elapsed,
+              "concurrency": args.concurrency,
+              "users": len(users),
+              "mix": mix,
+              "graph": {"users": manifest["users"], "posts": manifest["posts"]},
+              **summarize(recorder, elapsed)}
+    print_results(result)
+    if not args.no_save:
+        print(f"Saved the results to {save(result)}")
+    if baseline is not None:
+        print_comparison(baseline, result)
+
+
+if __name__ == "__main__":
+    main()
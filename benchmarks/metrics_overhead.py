@@ -0,0 +1,136 @@
+"""
+Benchmark of the overhead of the request metrics
+
+Serves the same trivial routes with and without MetricsMiddleware, calling
+the ASGI app directly so no network or database time hides the difference,
+and reports the cost the middleware adds to each request, the cost of each
+kind of observation and the time a scrape of many series takes. Both apps
+are timed in turns and the best round of each is kept, as the difference
+is small next to the noise. Exits with an error if the recorded requests
+do not add up.
+
+Usage - python -m benchmarks.metrics_overhead [--requests 10000] [--rounds 7] [--routes 50]
+"""
+
+# Imports
+
+import argparse
+import asyncio
+import sys
+import time
+from fastapi import FastAPI
+
+from app.db.instrumentation import QueryCountMiddleware
+from app.metrics import registry
+from app.metrics.http import REQUEST_SECONDS, MetricsMiddleware
+
+
+# Benchmark apps
+
+def build_app(measured: bool) -> FastAPI:
+    """ Builds an app with a static and a templated route """
+
+    app = FastAPI()
+
+    @app.get("/ping")
+    async def ping():
+        return {"ok": True}
+
+    @app.get("/posts/{post_id}")
+    async def get_post(post_id: int):
+        return {"id": post_id}
+
+    if measured:
+        app.add_middleware(MetricsMiddleware)
+    app.add_middleware(QueryCountMiddleware)
+    return app
+
+
+async def call(app: FastAPI, path: str) -> None:
+    """ Sends a GET request straight to the ASGI app """
+
+    scope = {"type": "http", "http_version": "1.1", "method": "GET",
+             "scheme": "http", "path": path, "raw_path": path.encode(),
+             "root_path": "", "query_string": b"", "headers": [],
+             "client": ("127.0.0.1", 1234), "server": ("testserver", 80)}
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    await app(scope, receive, send)
+
+
+def time_requests(app: FastAPI, requests: int) -> float:
+    """ Returns the average time of a request in microseconds """
+
+    async def run():
+        for number in range(requests):
+            await call(app, "/ping" if number % 2 else f"/posts/{number}")
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(call(app, "/ping"))
+    start = time.perf_counter()
+    loop.run_until_complete(run())
+    elapsed = time.perf_counter() - start
+    loop.close()
+    return elapsed / requests * 1000000
+
+
+def time_per_call(function, rounds: int) -> float:
+    """ Returns the average time of a call in microseconds """
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        function()
+    return (time.perf_counter() - start) / rounds * 1000000
+
+
+def main() -> None:
+    """ Times requests with and without the middleware, then the primitives """
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=7)
+    parser.add_argument("--routes", type=int, default=50)
+    args = parser.parse_args()
+
+    plain_app, measured_app = build_app(measured=False), build_app(measured=True)
+    plain, measured = float("inf"), float("inf")
+    for _ in range(args.rounds):
+        plain = min(plain, time_requests(plain_app, args.requests))
+        measured = min(measured, time_requests(measured_app, args.requests))
+    print(f"{'request without metrics':<28}{plain:>9.1f} us")
+    print(f"{'request with metrics':<28}{measured:>9.1f} us")
+    print(f"{'overhead':<28}{measured - plain:>9.1f} us"
+          f" ({(measured - plain) / plain * 100:.1f}%)")
+
+    counter = registry.Counter("bench_total", "", ["route"])
+    histogram = registry.Histogram("bench_seconds", "", ["route"])
+    child = histogram.labels("/ping")
+    rounds = args.requests * 5
+    print(f"{'counter inc':<28}{time_per_call(lambda: counter.labels('/ping').inc(), rounds):>9.2f} us")
+    print(f"{'histogram observe':<28}{time_per_call(lambda: histogram.labels('/ping').observe(0.01), rounds):>9.2f} us")
+    print(f"{'kept series observe':<28}{time_per_call(lambda: child.observe(0.01), rounds):>9.2f} us")
+
+    # A scrape of a worker that served many routes with a few statuses
+    for route in range(args.routes):
+        for status in ("200", "404", "500"):
+            REQUEST_SECONDS.labels("GET", f"/bench/{route}", status).observe(0.01)
+    start = time.perf_counter()
+    body = registry.render()
+    scrape = (time.perf_counter() - start) * 1000
+    print(f"{'scrape':<28}{scrape:>9.2f} ms for {len(body.splitlines())} lines")
+
+    recorded = sum(sum(REQUEST_SECONDS.labels("GET", route, "200").snapshot()[0])
+                   for route in ("/ping", "/posts/{post_id}"))
+    served = (args.requests + 1) * args.rounds
+    if recorded != served:
+        sys.exit(f"Recorded {recorded} requests, served {served}")
+    print("Every request was recorded under its route template")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Query budget check of the routes declaring one
+
+Seeds the scratch schema of benchmarks.query_plans with a small synthetic
+social graph and calls the same hot routes through the app with
+QUERY_BUDGET_STRICT on, so a route issuing more statements than its
+query_budget answers 500. Each route is called once with the response
+cache cold, its most expensive path. The check exits with an error if any
+route goes over its budget, or if a route declaring a budget is not
+called at all. The app's own tables are untouched.
+
+Usage - python -m benchmarks.query_budgets [--users 5000] [--fanout-limit 200] [--keep]
+"""
+
+# Imports
+
+import argparse
+import sys
+from typing import Dict, List, Tuple
+from fastapi.routing import APIRoute
+from fastapi.testclient import TestClient
+
+from app.auth import oauth2
+from app.db import instrumentation, timeline
+from app.db.db_setup import get_db
+from app.db.replicas import get_read_db
+from app.main import app
+from benchmarks import query_plans
+
+
+# Budgets
+
+def declared_budgets() -> Dict[str, int]:
+    """ Returns the query budget of each route declaring one, by method and path """
+
+    budgets = {}
+    for route in app.routes:
+        if not isinstance(route, APIRoute):
+            continue
+        for dependency in route.dependencies:
+            limit = getattr(dependency.dependency, "limit", None)
+            if limit is not None:
+                for method in route.methods:
+                    budgets[f"{method} {route.path}"] = limit
+    return budgets
+
+
+def call_routes(budgets: Dict[str, int]) -> Tuple[Dict[str, int], List[str]]:
+    """
+    Calls each route as the chosen reader, returning the most statements a
+    call of each budgeted route issued and the calls that failed
+    """
+
+    subjects = query_plans.pick_subjects()
+    token = oauth2.create_access_token(data={"user_id": subjects["reader_id"]})
+    client = TestClient(app)
+    # Replicas hold a copy of the scratch schema only once they catch up
+    app.dependency_overrides[get_read_db] = get_db
+
+    counts, failed = {}, []
+    for route, method, path, arguments in query_plans.calls(subjects):
+        response = client.request(method, path, headers={"Authorization": f"Bearer {token}"},
+                                  **arguments)
+        expected = 404 if route in query_plans.MISSING_ROUTES else None
+        if response.status_code >= 400 and response.status_code != expected:
+            failed.append(f"{method} {path} answered {response.status_code} {response.text}")
+        if route not in budgets:
+            continue
+        # Calls over their budget answer with their count instead of the header
+        if "x-query-count" in response.headers:
+            count = int(response.headers["x-query-count"])
+        else:
+            count = response.json().get("query_count", 0)
+        counts[route] = max(count, counts.get(route, 0))
+
+    app.dependency_overrides.pop(get_read_db)
+    return counts, failed
+
+
+def main() -> None:
+    """ Seeds the scratch schema and calls the routes under strict budgets """
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--fanout-limit", type=int, default=200,
+                        help="followers past which authors are read on fan out, "
+                             "so the seeded graph has some")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the scratch schema to replay calls by hand")
+    args = parser.parse_args()
+
+    timeline.FANOUT_LIMIT = args.fanout_limit
+    instrumentation.QUERY_BUDGET_STRICT = True
+    instrumentation.QUERY_COUNT_HEADER = True
+    budgets = declared_budgets()
+    query_plans.create_schema(args.users, args.seed)
+    try:
+        counts, failed_calls = call_routes(budgets)
+    finally:
+        if not args.keep:
+            query_plans.drop_schema()
+
+    print(f"{'route':<46}{'queries':>8}{'budget':>8}")
+    for route, budget in sorted(budgets.items()):
+        print(f"{route:<46}{counts.get(route, '-'):>8}{budget:>8}")
+
+    uncalled = sorted(set(budgets) - set(counts))
+    if failed_calls:
+        print("Routes that failed or went over their budget:", *failed_calls, sep="\n")
+    if uncalled:
+        print("Routes with a budget that were not called, add them to "
+              "benchmarks.query_plans.calls:", *uncalled, sep="\n")
+    if failed_calls or uncalled:
+        sys.exit(1)
+    print("Every route stays within its query budget")
+
+
+if __name__ == "__main__":
+    main()
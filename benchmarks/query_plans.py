@@ -0,0 +1,362 @@
+"""
+Query plan regression check of the routes' hot queries
+
+Builds the app's tables with the indexes the models declare in a scratch
+schema, seeds a small synthetic social graph into it with
+benchmarks.social_graph, then calls the feed, profile, post, comment,
+like, follow, search and media routes through the app with every connection
+pointed at the scratch schema. Each statement the routes issue is
+explained and the check exits with an error if any plan scans a table
+sequentially, or walks a whole index filtering its rows, as both read
+every row of a production sized table. The seeded graph is small, so
+sequential scans are disabled while explaining to show whether an index
+could serve each statement at all, rather than whether the planner
+prefers one on a few thousand rows. The app's own tables are untouched.
+
+Usage - python -m benchmarks.query_plans [--users 5000] [--fanout-limit 200] [--verbose] [--keep]
+"""
+
+# Imports
+
+import argparse
+import random
+import re
+import sys
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+from fastapi.testclient import TestClient
+from sqlalchemy import event, text
+
+from app.auth import oauth2
+from app.db import timeline
+from app.db.db_setup import Base, SessionLocal, engine, get_db
+from app.db.profiling import shape
+from app.db.replicas import get_read_db
+from app.images import index as media_index
+from app.images import storage
+from app.main import app
+from benchmarks import social_graph
+
+
+# Check settings
+
+SCHEMA = "query_plan_check"
+EXPLAINABLE = re.compile(r"^\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b", re.IGNORECASE)
+
+# Scans that read a whole table by design, with the reason they are fine
+ALLOWED_SCANS = [
+    ("Users", "follower_count >",
+     "celebrity_ids reads the fan-out-on-read authors once per refresh interval"),
+]
+
+# Routes answering 404 to the calls made, for urls that do not exist
+MISSING_ROUTES = ("GET /media/posts/{image_url}", "GET /media/users/{image_url}")
+
+
+# Scratch schema
+
+def _use_schema(dbapi_connection: any, connection_record: any) -> None:
+    with dbapi_connection.cursor() as cursor:
+        cursor.execute(f"SET search_path TO {SCHEMA}")
+    dbapi_connection.commit()
+
+
+def create_schema(users: int, seed: int) -> None:
+    """
+    Creates the models' tables and indexes in the scratch schema and seeds
+    a graph, with some posts hidden and some follow requests pending
+    """
+
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+        conn.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+        Base.metadata.create_all(conn.execution_options(
+            schema_translate_map={None: SCHEMA}))
+
+    # Every connection opened from here on, the app's included, uses the schema
+    event.listen(engine, "connect", _use_schema)
+    engine.dispose()
+
+    graph = social_graph.Graph(random.Random(seed), users, 3.0)
+    authors = [author_id for author_id in range(1, users + 1)
+               for _ in range(graph.count(2, 1000))]
+    span = timedelta(days=30)
+    start = datetime.now(timezone.utc) - span
+
+    dbapi_connection = engine.raw_connection()
+    try:
+        social_graph.copy(dbapi_connection, "Users",
+                          ["id", "username", "fullname", "email", "password",
+                           "description", "created_at"],
+                          social_graph.user_rows(graph, "", start, span))
+        social_graph.copy(dbapi_connection, "user_follow", ["user_id", "following_id"],
+                          social_graph.follow_rows(graph, 20))
+        social_graph.copy(dbapi_connection, "Posts",
+                          ["id", "author_id", "image_url", "description", "status",
+                           "created_at", "modified_at"],
+                          social_graph.post_rows(graph, authors, start, span))
+        social_graph.copy(dbapi_connection, "Likes", ["user_id", "post_id"],
+                          social_graph.like_rows(graph, len(authors), 5))
+        social_graph.copy(dbapi_connection, "Comments",
+                          ["id", "author_id", "content", "post_id", "parent_id",
+                           "created_at"],
+                          social_graph.comment_rows(graph, len(authors), 2, 1, start, span))
+    finally:
+        dbapi_connection.close()
+
+    with engine.begin() as conn:
+        conn.execute(text("""
+            UPDATE "Posts" SET published = id % 10 <> 0,
+                               status = CASE WHEN id % 50 = 0 THEN 'processing'
+                                             ELSE status END
+        """))
+        conn.execute(text("""
+            INSERT INTO "Follow_Requests" (sender_id, receiver_id)
+            SELECT sender_id, 1 + (sender_id * 7919) % :users
+            FROM generate_series(1, :users) AS sender_id
+            WHERE sender_id <> 1 + (sender_id * 7919) % :users
+        """), {"users": users})
+        for table in ("Users", "Posts", "Comments"):
+            conn.execute(text(f"SELECT setval(pg_get_serial_sequence('\"{table}\"', 'id'), "
+                              f"(SELECT max(id) FROM \"{table}\"))"))
+
+    with SessionLocal() as db:
+        social_graph.count_totals(db)
+        social_graph.materialize_timelines(db)
+
+    with engine.connect() as conn:
+        conn.execution_options(isolation_level="AUTOCOMMIT").\
+            execute(text(f"ANALYZE {social_graph.TABLES}"))
+
+
+def drop_schema() -> None:
+    event.remove(engine, "connect", _use_schema)
+    engine.dispose()
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP SCHEMA {SCHEMA} CASCADE"))
+
+
+# Route calls
+
+class Statements:
+    """ Statements issued by the database while each route was called """
+
+    def __init__(self):
+        self.route: Optional[str] = None
+        self.issued: Dict[str, Dict[str, Tuple[str, any]]] = {}
+
+    def capture(self, conn, cursor, statement, parameters, context, executemany):
+        if self.route is None or executemany:
+            return
+        sql = context.statement if context is not None else statement
+        if EXPLAINABLE.match(sql):
+            self.issued.setdefault(self.route, {}).setdefault(shape(sql), (sql, parameters))
+
+
+def pick_subjects() -> dict:
+    """
+    Picks an ordinary user, an author they follow and a post of theirs with
+    comments and replies, and a user they do not follow
+    """
+
+    with engine.connect() as conn:
+        subjects = dict(conn.execute(text("""
+            SELECT reader.username AS reader, reader.id AS reader_id,
+                   author.username AS author, post.id AS post_id, comment.id AS comment_id
+            FROM "Users" AS reader
+            JOIN user_follow AS follow ON follow.user_id = reader.id
+            JOIN "Users" AS author ON author.id = follow.following_id
+            JOIN "Posts" AS post ON post.author_id = author.id
+                 AND post.published AND post.status = 'ready'
+            JOIN "Comments" AS comment ON comment.post_id = post.id
+            WHERE reader.following_count BETWEEN 10 AND 40
+              AND EXISTS (SELECT FROM "Comments" WHERE parent_id = comment.id)
+              AND NOT EXISTS (SELECT FROM "Likes"
+                              WHERE user_id = reader.id AND post_id = post.id)
+            LIMIT 1
+        """)).mappings().one())
+
+        subjects["stranger"] = conn.execute(text("""
+            SELECT username FROM "Users" AS stranger
+            WHERE id <> :reader_id
+              AND NOT EXISTS (SELECT FROM user_follow
+                              WHERE user_id = :reader_id AND following_id = stranger.id)
+              AND NOT EXISTS (SELECT FROM "Follow_Requests"
+                              WHERE sender_id = :reader_id AND receiver_id = stranger.id)
+            LIMIT 1
+        """), subjects).scalar_one()
+        return subjects
+
+
+def calls(subjects: dict) -> Iterator[Tuple[str, str, str, dict]]:
+    """ Yields the route, method, path and request arguments of each call """
+
+    post, comment = subjects["post_id"], subjects["comment_id"]
+    author, stranger = subjects["author"], subjects["stranger"]
+    yield "GET /feed", "GET", "/feed", {}
+    yield "GET /feed", "GET", "/feed?sort=likes", {}
+    yield "GET /users/{username}", "GET", f"/users/{subjects['reader']}", {}
+    yield "GET /users/{username}", "GET", f"/users/{author}", {}
+    yield "GET /users/{username}/followers", "GET", f"/users/{author}/followers", {}
+    yield "GET /users/{username}/following", "GET", f"/users/{author}/following", {}
+    yield "GET /users/", "GET", "/users/?search=sharma", {}
+    yield "GET /users/", "GET", "/users/?search=pri&prefix=true", {}
+    yield "GET /{username}/{post_id}", "GET", f"/{author}/{post}", {}
+    yield "GET /{post_id:int}/comments", "GET", f"/{post}/comments", {}
+    yield "GET /{post_id:int}/{comment_id:int}/replies", "GET", f"/{post}/{comment}/replies", {}
+    yield "POST /{post_id}/comment", "POST", f"/{post}/comment", {"json": {"content": "nice"}}
+    yield "POST /{post_id}/{comment_id}/reply", "POST", f"/{post}/{comment}/reply", \
+        {"json": {"content": "thanks"}}
+    yield "POST /{post_id}/like", "POST", f"/{post}/like", {}
+    yield "DELETE /{post_id}/unlike", "DELETE", f"/{post}/unlike", {}
+    yield "GET /requests", "GET", "/requests", {}
+    yield "POST /users/{username}/follow", "POST", f"/users/{stranger}/follow", {}
+    yield "DELETE /users/{username}/unfollow", "DELETE", f"/users/{author}/unfollow", {}
+    missing = "f" * 64 + ".png"
+    yield "GET /media/posts/{image_url}", "GET", f"/media/posts/{missing}", {}
+    yield "GET /media/users/{image_url}", "GET", f"/media/users/{missing}", {}
+
+
+def call_routes(statements: Statements) -> List[str]:
+    """ Calls each route as the chosen reader and returns the failed calls """
+
+    subjects = pick_subjects()
+    token = oauth2.create_access_token(data={"user_id": subjects["reader_id"]})
+    client = TestClient(app)
+    # Replicas hold a copy of the scratch schema only once they catch up
+    app.dependency_overrides[get_read_db] = get_db
+    # Each worker loads its media index whole once per refresh interval,
+    # the media routes only look up the urls missing from it
+    media_index.contains(storage.url_for("media/posts", "0" * 64, ".png"))
+
+    failed = []
+    for route, method, path, arguments in calls(subjects):
+        statements.route = route
+        response = client.request(method, path, headers={"Authorization": f"Bearer {token}"},
+                                  **arguments)
+        statements.route = None
+        expected = 404 if route in MISSING_ROUTES else None
+        if response.status_code >= 400 and response.status_code != expected:
+            failed.append(f"{method} {path} answered {response.status_code} {response.text}")
+
+    app.dependency_overrides.pop(get_read_db)
+    return failed
+
+
+# Plans
+#
+# A scan of an index whose condition leaves out its leading column, such
+# as a lookup of Likes by post_id through the (user_id, post_id) key, walks
+# the whole index just as a scan without a condition does.
+
+INDEX_SCANS = ("Index Scan", "Index Only Scan", "Bitmap Index Scan")
+
+
+def leading_columns(dbapi_connection: any) -> Dict[str, Tuple[str, str]]:
+    """ Returns the table and leading column of each index on plain columns """
+
+    with dbapi_connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT index.relname, tables.relname, attribute.attname
+            FROM pg_index AS keys
+            JOIN pg_class AS index ON index.oid = keys.indexrelid
+            JOIN pg_class AS tables ON tables.oid = keys.indrelid
+            JOIN pg_attribute AS attribute ON attribute.attrelid = keys.indrelid
+                 AND attribute.attnum = keys.indkey[0]
+            WHERE index.relnamespace = current_schema()::regnamespace
+        """)
+        return {index: (table, column) for index, table, column in cursor.fetchall()}
+
+
+def full_scans(plan: dict, indexes: Dict[str, Tuple[str, str]]) -> Iterator[Tuple[str, str]]:
+    """ Yields the table and a description of each node of a plan reading all of a table """
+
+    node = plan["Node Type"]
+    if node == "Seq Scan":
+        yield plan["Relation Name"], f"Seq Scan on {plan['Relation Name']}"
+    elif node in INDEX_SCANS and plan["Index Name"] in indexes:
+        table, column = indexes[plan["Index Name"]]
+        condition = plan.get("Index Cond")
+        if condition is None and "Filter" in plan:
+            yield table, f"{node} of all of {plan['Index Name']} filtering {plan['Filter']}"
+        elif condition is not None and not re.search(rf"\b{column}\b", condition):
+            yield table, (f"{node} of all of {plan['Index Name']}, "
+                          f"{condition} leaves out its leading column {column}")
+    for child in plan.get("Plans", []):
+        yield from full_scans(child, indexes)
+
+
+def explain(dbapi_connection: any, sql: str, parameters: any) -> dict:
+    with dbapi_connection.cursor() as cursor:
+        cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", parameters)
+        return cursor.fetchone()[0][0]["Plan"]
+
+
+def check_plans(statements: Statements, verbose: bool) -> List[str]:
+    """ Explains every statement and returns the scans that are not allowed """
+
+    failures = []
+    dbapi_connection = engine.raw_connection()
+    try:
+        dbapi_connection.autocommit = True
+        with dbapi_connection.cursor() as cursor:
+            cursor.execute("SET enable_seqscan = off")
+        indexes = leading_columns(dbapi_connection)
+
+        for route, issued in statements.issued.items():
+            print(f"{route:<40}{len(issued):>3} statements")
+            for sql, parameters in issued.values():
+                if verbose:
+                    print(f"  {shape(sql)[:110]}")
+                plan = explain(dbapi_connection, sql, parameters)
+                for relation, scan in full_scans(plan, indexes):
+                    allowed = [reason for table, marker, reason in ALLOWED_SCANS
+                               if table == relation and marker in sql]
+                    if allowed:
+                        if verbose:
+                            print(f"    allowed {scan}, {allowed[0]}")
+                        continue
+                    failures.append(f"{route}: {scan}\n  {' '.join(sql.split())}")
+    finally:
+        dbapi_connection.close()
+    return failures
+
+
+def main() -> None:
+    """ Seeds the scratch schema, calls the routes and checks their plans """
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--fanout-limit", type=int, default=200,
+                        help="followers past which authors are read on fan out, "
+                             "so the seeded graph has some")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true",
+                        help="print each statement explained")
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the scratch schema to look at plans by hand")
+    args = parser.parse_args()
+
+    timeline.FANOUT_LIMIT = args.fanout_limit
+    statements = Statements()
+    create_schema(args.users, args.seed)
+    try:
+        event.listen(engine, "before_cursor_execute", statements.capture)
+        failed_calls = call_routes(statements)
+        event.remove(engine, "before_cursor_execute", statements.capture)
+        failures = check_plans(statements, args.verbose)
+    finally:
+        if not args.keep:
+            drop_schema()
+
+    if failed_calls:
+        print("Routes that failed:", *failed_calls, sep="\n")
+    if failures:
+        print("Plans that read whole tables:", *failures, sep="\n")
+    if failed_calls or failures:
+        sys.exit(1)
+    print("No hot query reads a whole table")
+
+
+if __name__ == "__main__":
+    main()
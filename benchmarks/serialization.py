@@ -0,0 +1,183 @@
+"""
+Contract check and benchmark of the fast JSON serializers
+
+Builds synthetic posts, profiles, comments and users in memory, encodes
+them through app.schema.serializers and through FastAPI's response_model
+path, exits with an error if any response differs by a single byte, then
+reports the time each path takes per response. No database is needed.
+
+Usage - python -m benchmarks.serialization [--posts 10] [--likes 50] [--comments 3] [--rounds 200]
+"""
+
+# Imports
+
+import argparse
+import asyncio
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, List, Union
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from app.db import models
+from app.schema import schemas, serializers
+
+
+# Synthetic objects
+#
+# Values cover what the database hands back, optional fields both set and
+# empty, non ASCII text and timestamps with and without microseconds in
+# several offsets.
+
+OFFSETS = [timezone.utc, timezone(timedelta(hours=5, minutes=30)),
+           timezone(timedelta(hours=-7))]
+
+
+def build_users(count: int) -> List[models.User]:
+    """ Builds users with and without pictures and descriptions """
+
+    return [models.User(id=index,
+                        username=f"user{index}",
+                        fullname=f"Üser {index} ✨" if index % 3 else f"User {index}",
+                        profile_pic=f"media/users/{index:064x}.png" if index % 2 else None,
+                        description="Café \"quotes\" \\ and\nnew lines" if index % 4 else None,
+                        follower_count=index * 7,
+                        following_count=index * 3)
+            for index in range(1, count + 1)]
+
+
+def timestamp(index: int) -> datetime:
+    """ Returns varied timezone aware timestamps """
+
+    return datetime(2026, 10, 18, 12, index % 60, index % 60,
+                    0 if index % 5 == 0 else index * 7919 % 1000000,
+                    tzinfo=OFFSETS[index % len(OFFSETS)])
+
+
+def build_comment(index: int, post_id: int, author: models.User,
+                  parent_id: int = None) -> models.Comment:
+    """ Builds a comment, or a reply when it has a parent """
+
+    comment = models.Comment(id=index, post_id=None if parent_id else post_id,
+                             parent_id=parent_id, author_id=author.id,
+                             author=author, content=f"Comment {index} 👋",
+                             created_at=timestamp(index))
+    comment.reply_count = index % 4
+    return comment
+
+
+def build_posts(users: List[models.User], count: int, likes: int,
+                comments: int) -> List[models.Post]:
+    """ Builds posts with likes and top comments attached like the routes do """
+
+    posts = []
+    for index in range(1, count + 1):
+        author = users[index % len(users)]
+        post = models.Post(id=index, author_id=author.id, author=author,
+                           image_url=f"media/posts/{index:064x}.jpg",
+                           description=f"Post {index} — ünïcode" if index % 2 else None,
+                           location="Vellore" if index % 3 else None,
+                           created_at=timestamp(index),
+                           like_count=likes, comment_count=comments * 10)
+        post.likes = [models.Like(user_id=user.id, post_id=index, user=user)
+                      for user in users[:likes]]
+        post.top_comments = [build_comment(index * 1000 + number, index,
+                                           users[number % len(users)])
+                             for number in range(comments)]
+        posts.append(post)
+    return posts
+
+
+# Both paths
+
+_loop = asyncio.new_event_loop()
+
+
+def reference(schema: any, content: any) -> bytes:
+    """ Encodes content exactly as a route with a response_model would """
+
+    field = create_response_field(name="Response", type_=schema)
+    value = _loop.run_until_complete(serialize_response(
+        field=field, response_content=content, is_coroutine=True))
+    return JSONResponse(value).body
+
+
+def cases(args: argparse.Namespace) -> dict:
+    """ Returns each response as (schema, route content, fast serializer) """
+
+    users = build_users(max(args.likes, 20))
+    posts = build_posts(users, args.posts, args.likes, args.comments)
+    user = users[1]
+    profile = schemas.UserProfileView(id=user.id, username=user.username,
+                                      fullname=user.fullname,
+                                      profile_pic=user.profile_pic,
+                                      description=user.description,
+                                      posts=posts,
+                                      follower_count=user.follower_count,
+                                      following_count=user.following_count)
+    profile_schema = Union[schemas.UserProfileView,
+                           schemas.UserProfileViewUnfollower]
+    comments = [build_comment(number, 1, users[number % len(users)])
+                for number in range(1, 11)]
+    replies = [build_comment(number, 1, users[number % len(users)], parent_id=1)
+               for number in range(11, 21)]
+
+    return {
+        "feed": (List[schemas.PostResponse], posts,
+                 lambda: [serializers.post(post) for post in posts]),
+        "post": (schemas.PostResponse, posts[0],
+                 lambda: serializers.post(posts[0])),
+        "profile": (profile_schema, profile,
+                    lambda: serializers.profile(user, posts)),
+        "unfollower": (profile_schema, schemas.UserProfileViewUnfollower.from_orm(users[2]),
+                       lambda: serializers.profile_unfollower(users[2])),
+        "search": (List[schemas.UserFollow], users,
+                   lambda: [serializers.user_follow(user) for user in users]),
+        "comments": (List[schemas.CommentResponse], comments,
+                     lambda: [serializers.comment(comment) for comment in comments]),
+        "replies": (List[schemas.ReplyResponse], replies,
+                    lambda: [serializers.reply(reply) for reply in replies]),
+    }
+
+
+def time_per_call(function: Callable, rounds: int) -> float:
+    """ Returns the average time of a call in microseconds """
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        function()
+    return (time.perf_counter() - start) / rounds * 1000000
+
+
+def main() -> None:
+    """ Checks both paths agree, then times them """
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--posts", type=int, default=10)
+    parser.add_argument("--likes", type=int, default=50)
+    parser.add_argument("--comments", type=int, default=3)
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    mismatches = []
+    print(f"{'response':<12}{'bytes':>9}{'model us':>12}{'fast us':>10}{'speedup':>9}")
+    for name, (schema, content, fast) in cases(args).items():
+        expected = reference(schema, content)
+        if serializers.encode(fast()) != expected:
+            mismatches.append(name)
+
+        model_time = time_per_call(lambda: reference(schema, content), args.rounds)
+        fast_time = time_per_call(lambda: serializers.encode(fast()), args.rounds)
+        print(f"{name:<12}{len(expected):>9}{model_time:>12.1f}"
+              f"{fast_time:>10.1f}{model_time / fast_time:>8.1f}x")
+
+    if mismatches:
+        sys.exit(f"Fast serializers differ from the response models for: "
+                 f"{', '.join(mismatches)}")
+    print("Fast serializers match the response models byte for byte")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+"""
+Generator of a synthetic social graph for load tests
+
+Bulk loads users, a power-law follow graph, posts, likes and comments with
+replies into the app's own tables through COPY, then materializes the home
+timelines the way fan-out-on-write would have, recomputes the denormalized
+counters and analyzes the tables. Followees, likers and commenters are
+drawn from a Zipf-like popularity ranking and follow, post, like and
+comment counts from Pareto distributions, so a few users have most of the
+followers and a few posts most of the likes. Every user shares one
+password. A manifest of sample usernames and the loaded ids is written for
+benchmarks.load.
+
+The database must hold no users, or be emptied with --truncate, which
+deletes everything in it. Tables keep their indexes during the load, as
+the app needs them all, so a million users take several minutes.
+
+Usage - python -m benchmarks.social_graph [--users 1000000] [--follows 20] [--posts 2] [--likes 5] [--comments 1] [--replies 0.5] [--truncate]
+"""
+
+# Imports
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, List
+from sqlalchemy import text
+
+from app.auth.utils import pwd_context
+from app.db import models, timeline
+from app.db.db_setup import SessionLocal, engine
+from benchmarks.user_search import FIRST_NAMES, LAST_NAMES, WORDS
+
+
+# Generator settings
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+MANIFEST_PATH = os.path.join(RESULTS_DIR, "social_graph.json")
+MANIFEST_USERNAMES = 1000
+IMAGE_URL = "media/posts/synthetic.jpg"
+TABLES = ", ".join(f'"{table}"' for table in [
+    "Users", "user_follow", "Follow_Requests", "Posts", "Comments", "Likes",
+    "Timelines", "MediaBlobs"])
+
+
+# Distributions
+
+class Graph:
+    """ Draws the degrees and endpoints of the synthetic graph """
+
+    def __init__(self, rng: random.Random, users: int, skew: float):
+        self.rng = rng
+        self.users = users
+        self.skew = skew
+        # Popularity ranks are shuffled so that low ids are not all celebrities
+        self.ranked = list(range(1, users + 1))
+        rng.shuffle(self.ranked)
+
+    def popular_user(self) -> int:
+        """ Returns a user id, rank r drawn with probability falling as a power of r """
+        return self.ranked[int(self.users * self.rng.random() ** self.skew)]
+
+    def count(self, mean: float, limit: int) -> int:
+        """ Returns a heavy tailed count with the given mean, at most limit """
+
+        if mean <= 0:
+            return 0
+        # A Pareto of shape 2 has a mean of twice its scale
+        return min(limit, int(self.rng.paretovariate(2) * mean / 2 + self.rng.random()))
+
+    def distinct_users(self, count: int, excluded: int = 0) -> set:
+        """ Returns up to count distinct popular users other than excluded """
+
+        chosen = set()
+        for _ in range(count * 2):
+            if len(chosen) >= count:
+                break
+            user_id = self.popular_user()
+            if user_id != excluded:
+                chosen.add(user_id)
+        return chosen
+
+    def sentence(self, words: int) -> str:
+        return " ".join(self.rng.choice(WORDS) for _ in range(words))
+
+
+# Bulk loading
+
+class CopyStream:
+    """ File-like view of generated rows, read by COPY as it needs them """
+
+    def __init__(self, rows: Iterator[str]):
+        self._rows = rows
+        self._buffer = b""
+        self.rows = 0
+
+    def read(self, size: int = 65536) -> bytes:
+        chunks, length = [self._buffer], len(self._buffer)
+        for row in self._rows:
+            chunks.append(row.encode())
+            length += len(chunks[-1])
+            self.rows += 1
+            if length >= size:
+                break
+        data = b"".join(chunks)
+        self._buffer = data[size:]
+        return data[:size]
+
+
+def copy(dbapi_connection: any, table: str, columns: List[str],
+         rows: Iterator[str]) -> int:
+    """ Copies tab separated rows into a table and returns how many there were """
+
+    stream = CopyStream(rows)
+    started = time.perf_counter()
+    with dbapi_connection.cursor() as cursor:
+        cursor.copy_expert(f'COPY "{table}" ({", ".join(columns)}) FROM STDIN', stream)
+    dbapi_connection.commit()
+    print(f"Loaded {stream.rows:>11} rows into {table:<12} in "
+          f"{time.perf_counter() - started:.1f}s")
+    return stream.rows
+
+
+def _timestamp(moment: datetime) -> str:
+    return moment.isoformat()
+
+
+# Rows
+#
+# Ids are assigned here rather than by the sequences so that later tables
+# can refer to them, the sequences are moved past them once loaded.
+
+def user_rows(graph: Graph, password: str, start: datetime,
+              span: timedelta) -> Iterator[str]:
+    rng = graph.rng
+    for user_id in range(1, graph.users + 1):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        description = graph.sentence(3) if rng.random() < 0.6 else "\\N"
+        created_at = start + span * (user_id / graph.users) / 2
+        yield (f"{user_id}\t{first}_{last}{user_id}\t{first.title()} {last.title()}\t"
+               f"{first}.{last}{user_id}@example.com\t{password}\t{description}\t"
+               f"{_timestamp(created_at)}\n")
+
+
+def follow_rows(graph: Graph, mean: float) -> Iterator[str]:
+    for user_id in range(1, graph.users + 1):
+        for following_id in graph.distinct_users(graph.count(mean, graph.users // 2),
+                                                 excluded=user_id):
+            yield f"{user_id}\t{following_id}\n"
+
+
+def post_rows(graph: Graph, authors: List[int], start: datetime,
+              span: timedelta) -> Iterator[str]:
+    total = len(authors)
+    for index, author_id in enumerate(authors):
+        created_at = _timestamp(start + span * (0.5 + index / total / 2))
+        yield (f"{index + 1}\t{author_id}\t{IMAGE_URL}\t{graph.sentence(6)}\t"
+               f"{models.PostStatus.READY}\t{created_at}\t{created_at}\n")
+
+
+def like_rows(graph: Graph, posts: int, mean: float) -> Iterator[str]:
+    for post_id in range(1, posts + 1):
+        for user_id in graph.distinct_users(graph.count(mean, graph.users)):
+            yield f"{user_id}\t{post_id}\n"
+
+
+def comment_rows(graph: Graph, posts: int, comments: float, replies: float,
+                 start: datetime, span: timedelta) -> Iterator[str]:
+    """
+    Yields comments on posts and replies to them. Replies point at their
+    comment only, as the app stores them.
+    """
+
+    comment_id = 0
+    for post_id in range(1, posts + 1):
+        posted_at = start + span * (0.5 + (post_id - 1) / posts / 2)
+        for _ in range(graph.count(comments, 1000)):
+            comment_id += 1
+            parent_id = comment_id
+            commented_at = _timestamp(posted_at + timedelta(minutes=comment_id % 600))
+            yield (f"{comment_id}\t{graph.popular_user()}\t{graph.sentence(8)}\t"
+                   f"{post_id}\t\\N\t{commented_at}\n")
+            for _ in range(graph.count(replies, 100)):
+                comment_id += 1
+                yield (f"{comment_id}\t{graph.popular_user()}\t{graph.sentence(5)}\t"
+                       f"\\N\t{parent_id}\t{commented_at}\n")
+
+
+# Derived data
+
+def count_totals(db: any) -> None:
+    """
+    Sets the denormalized counters from grouped totals. The rows start at
+    zero, and counting a whole table at once is much faster on a fresh
+    graph than the per row recount of app.db.counters.reconcile.
+    """
+
+    for table, column, source, key, condition in [
+            ("Users", "follower_count", "user_follow", "following_id", "TRUE"),
+            ("Users", "following_count", "user_follow", "user_id", "TRUE"),
+            ("Posts", "like_count", "Likes", "post_id", "TRUE"),
+            ("Posts", "comment_count", "Comments", "post_id", "post_id IS NOT NULL")]:
+        db.execute(text(f"""
+            UPDATE "{table}" SET {column} = totals.total
+            FROM (SELECT {key} AS id, count(*) AS total FROM "{source}"
+                  WHERE {condition} GROUP BY {key}) AS totals
+            WHERE "{table}".id = totals.id
+        """))
+    db.commit()
+
+
+def materialize_timelines(db: any) -> int:
+    """
+    Fills the home timelines with the latest posts of each user and the
+    authors they follow, leaving out authors past the fan-out limit as
+    fan_out_post would
+    """
+
+    result = db.execute(text("""
+        INSERT INTO "Timelines" (user_id, post_id, author_id, created_at)
+        SELECT user_id, post_id, author_id, created_at
+        FROM (SELECT entries.*,
+                     row_number() OVER (PARTITION BY user_id
+                                        ORDER BY created_at DESC, post_id DESC) AS position
+              FROM (SELECT author_id AS user_id, id AS post_id, author_id, created_at
+                    FROM "Posts"
+                    UNION ALL
+                    SELECT follows.user_id, posts.id, posts.author_id, posts.created_at
+                    FROM user_follow AS follows
+                    JOIN "Users" AS authors ON authors.id = follows.following_id
+                    JOIN "Posts" AS posts ON posts.author_id = follows.following_id
+                    WHERE authors.follower_count <= :fanout_limit) AS entries) AS ranked
+        WHERE position <= :max_length
+    """), {"fanout_limit": timeline.FANOUT_LIMIT, "max_length": timeline.MAX_LENGTH})
+    db.commit()
+    return result.rowcount
+
+
+def write_manifest(graph: Graph, password: str, posts: int) -> None:
+    """ Records what benchmarks.load needs to log in and pick posts """
+
+    with engine.connect() as conn:
+        usernames = conn.execute(
+            text('SELECT username FROM "Users" WHERE id = ANY(:ids)'),
+            {"ids": sorted({graph.popular_user() for _ in range(MANIFEST_USERNAMES)})}).\
+            scalars().all()
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    with open(MANIFEST_PATH, "w", encoding="utf-8") as manifest:
+        json.dump({"users": graph.users, "posts": posts, "password": password,
+                   "usernames": usernames,
+                   "search_terms": sorted({name[:3] for name in FIRST_NAMES})},
+                  manifest, indent=2)
+    print(f"Wrote the manifest to {MANIFEST_PATH}")
+
+
+def main() -> None:
+    """ Generates and loads the graph, then derives timelines and counters """
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--follows", type=float, default=20,
+                        help="mean followees of a user")
+    parser.add_argument("--posts", type=float, default=2,
+                        help="mean posts of a user")
+    parser.add_argument("--likes", type=float, default=5,
+                        help="mean likes of a post")
+    parser.add_argument("--comments", type=float, default=1,
+                        help="mean comments on a post")
+    parser.add_argument("--replies", type=float, default=0.5,
+                        help="mean replies to a comment")
+    parser.add_argument("--skew", type=float, default=3.0,
+                        help="popularity skew, 1 is uniform")
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--password", default="loadtest")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--truncate", action="store_true",
+                        help="delete everything in the database first")
+    args = parser.parse_args()
+
+    with engine.connect() as conn:
+        if args.truncate:
+            with conn.begin():
+                conn.execute(text(f"TRUNCATE {TABLES} RESTART IDENTITY CASCADE"))
+        elif conn.execute(text('SELECT EXISTS (SELECT FROM "Users")')).scalar():
+            sys.exit("The database has users, pass --truncate to delete everything in it")
+
+    started = time.perf_counter()
+    graph = Graph(random.Random(args.seed), args.users, args.skew)
+    span = timedelta(days=args.days)
+    start = datetime.now(timezone.utc) - span
+    # Hashing once keeps a million users from taking a day of bcrypt
+    password = pwd_context.hash(args.password)
+
+    authors = [author_id for author_id in range(1, args.users + 1)
+               for _ in range(graph.count(args.posts, 1000))]
+    graph.rng.shuffle(authors)
+
+    dbapi_connection = engine.raw_connection()
+    try:
+        copy(dbapi_connection, "Users",
+             ["id", "username", "fullname", "email", "password", "description", "created_at"],
+             user_rows(graph, password, start, span))
+        copy(dbapi_connection, "user_follow", ["user_id", "following_id"],
+             follow_rows(graph, args.follows))
+        copy(dbapi_connection, "Posts",
+             ["id", "author_id", "image_url", "description", "status",
+              "created_at", "modified_at"],
+             post_rows(graph, authors, start, span))
+        copy(dbapi_connection, "Likes", ["user_id", "post_id"],
+             like_rows(graph, len(authors), args.likes))
+        copy(dbapi_connection, "Comments",
+             ["id", "author_id", "content", "post_id", "parent_id", "created_at"],
+             comment_rows(graph, len(authors), args.comments, args.replies, start, span))
+    finally:
+        dbapi_connection.close()
+
+    with SessionLocal() as db:
+        for table in ("Users", "Posts", "Comments"):
+            db.execute(text(f"SELECT setval(pg_get_serial_sequence('\"{table}\"', 'id'), "
+                            f"(SELECT coalesce(max(id), 0) + 1 FROM \"{table}\"), false)"))
+        db.commit()
+
+        step = time.perf_counter()
+        count_totals(db)
+        print(f"Recomputed the counters in {time.perf_counter() - step:.1f}s")
+
+        step = time.perf_counter()
+        entries = materialize_timelines(db)
+        print(f"Materialized {entries} timeline entries in {time.perf_counter() - step:.1f}s")
+
+    with engine.connect() as conn:
+        conn.execution_options(isolation_level="AUTOCOMMIT").\
+            execute(text(f"ANALYZE {TABLES}"))
+
+    write_manifest(graph, args.password, len(authors))
+    print(f"Generated the graph in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+Latency benchmark of user search on a large synthetic Users table
+
+Loads synthetic users into a scratch schema holding a copy of the Users
+table, with its generated search column and indexes, then times the old
+ILIKE substring search against the full text search and username
+type-ahead of app.db.search, reporting p50 and p99 latencies. The app's
+own tables are only read, to copy their definitions.
+
+Usage - python -m benchmarks.user_search [--users 1000000] [--queries 200] [--keep]
+"""
+
+# Imports
+
+import argparse
+import random
+import re
+import time
+from typing import Callable, List
+from sqlalchemy import or_, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+from app.db import models, pagination
+from app.db import search as user_search
+from app.db.db_setup import engine
+from benchmarks.event_loop import percentile
+
+
+# Synthetic data
+
+SCHEMA = "user_search_benchmark"
+
+FIRST_NAMES = ["james", "mary", "robert", "patricia", "john", "jennifer",
+               "michael", "linda", "david", "elizabeth", "william", "barbara",
+               "richard", "susan", "joseph", "jessica", "thomas", "sarah",
+               "aarav", "priya", "dhruv", "ananya", "rohan", "kavya", "wei",
+               "mei", "hiroshi", "yuki", "omar", "fatima", "lucas", "sofia",
+               "mateo", "valentina", "noah", "emma", "liam", "olivia",
+               "ethan", "ava", "ivan", "olga", "pierre", "chloe", "kwame",
+               "amara", "lars", "ingrid", "diego", "lucia"]
+LAST_NAMES = ["smith", "johnson", "williams", "brown", "jones", "garcia",
+              "miller", "davis", "rodriguez", "martinez", "hernandez",
+              "lopez", "gonzalez", "wilson", "anderson", "taylor", "moore",
+              "sharma", "patel", "gupta", "singh", "kumar", "iyer", "wang",
+              "li", "zhang", "chen", "tanaka", "suzuki", "sato", "hassan",
+              "ali", "silva", "santos", "rossi", "russo", "muller",
+              "schmidt", "dubois", "laurent", "ivanov", "petrov", "nowak",
+              "kowalski", "mensah", "okafor", "larsen", "nielsen", "costa",
+              "ferreira"]
+WORDS = ["photography", "travel", "coffee", "music", "hiking", "design",
+         "football", "cooking", "books", "art", "film", "cats", "dogs",
+         "running", "yoga", "code", "gaming", "fashion", "science", "poetry",
+         "mountains", "beaches", "street", "food", "nature", "vintage",
+         "cycling", "painting", "dance", "tech"]
+
+
+def create_table(conn: Connection, users: int) -> None:
+    """
+    Copies the Users table into the scratch schema, loads synthetic users
+    into it and only then builds its indexes, as a bulk load would
+    """
+
+    conn.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+    conn.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+    conn.execute(text(f'CREATE TABLE {SCHEMA}."Users" '
+                      f'(LIKE "Users" INCLUDING ALL EXCLUDING INDEXES)'))
+
+    conn.execute(text("SELECT setseed(0.5)"))
+    conn.execute(text(f"""
+        INSERT INTO {SCHEMA}."Users"
+            (id, username, fullname, email, password, description)
+        SELECT id, first || '_' || last || id, initcap(first) || ' ' || initcap(last),
+               'user' || id || '@example.com', '',
+               (:words)[1 + id * 7 % cardinality(:words)] || ' ' ||
+               (:words)[1 + id * 13 % cardinality(:words)] || ' and ' ||
+               (:words)[1 + id * 29 % cardinality(:words)]
+        FROM (SELECT id,
+                     (:first_names)[1 + floor(random() * cardinality(:first_names))::int] AS first,
+                     (:last_names)[1 + floor(random() * cardinality(:last_names))::int] AS last
+              FROM generate_series(1, :users) AS id) AS names
+    """), {"words": WORDS, "first_names": FIRST_NAMES,
+           "last_names": LAST_NAMES, "users": users})
+
+    indexes = conn.execute(text("SELECT indexdef FROM pg_indexes "
+                                "WHERE schemaname = current_schema() "
+                                "AND tablename = 'Users'")).scalars().all()
+    for index in indexes:
+        conn.execute(text(re.sub(r' ON (\S+\.)?"Users" ',
+                                 f' ON {SCHEMA}."Users" ', index)))
+
+
+# Search modes
+
+def substring(db: Session, search: str) -> list:
+    """ The ILIKE search across all three columns that full text search replaced """
+
+    search_query = f"%{search}%"
+    users, _ = pagination.paginate(
+        db.query(models.User).filter(or_(models.User.username.ilike(search_query),
+                                         models.User.fullname.ilike(search_query),
+                                         models.User.description.ilike(search_query))),
+        [models.User.id], None, None, descending=False)
+    return users
+
+
+def full_text(db: Session, search: str) -> list:
+    """ First page of a full text search """
+    return user_search.full_text(db, search, None, None)[0]
+
+
+def type_ahead(db: Session, search: str) -> list:
+    """ First page of a username type-ahead """
+    return user_search.type_ahead(db, search, None, None)[0]
+
+
+def searches(rng: random.Random, count: int, users: int) -> dict:
+    """
+    Picks the searches of each mode. Names match thousands of users,
+    handles one user or none and prefixes are typed usernames.
+    """
+
+    names = [rng.choice([rng.choice(FIRST_NAMES),
+                         rng.choice(LAST_NAMES),
+                         f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"])
+             for _ in range(count)]
+    handles = [f"{rng.choice(FIRST_NAMES)}_{rng.choice(LAST_NAMES)}{rng.randint(1, users)}"
+               for _ in range(count)]
+    prefixes = [rng.choice(FIRST_NAMES)[:rng.randint(1, 4)] for _ in range(count)]
+    return {"substring names": (substring, names),
+            "substring handles": (substring, handles),
+            "full text names": (full_text, names),
+            "full text handles": (full_text, handles),
+            "type-ahead": (type_ahead, prefixes)}
+
+
+def time_searches(db: Session, search: Callable, terms: List[str]) -> List[float]:
+    """ Returns the sorted latencies of searches in milliseconds """
+
+    for term in terms[:5]:
+        search(db, term)
+
+    latencies = []
+    for term in terms:
+        start = time.perf_counter()
+        search(db, term)
+        latencies.append((time.perf_counter() - start) * 1000)
+        db.expunge_all()
+    return sorted(latencies)
+
+
+def main() -> None:
+    """ Loads the synthetic users, times every search mode and prints the results """
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the scratch schema for later runs")
+    args = parser.parse_args()
+
+    with engine.connect() as conn:
+        exists = conn.execute(text(f'SELECT count(*) FROM {SCHEMA}."Users"')).scalar() \
+            if args.keep and conn.dialect.has_table(conn, "Users", schema=SCHEMA) else 0
+        if exists != args.users:
+            start = time.perf_counter()
+            with conn.begin():
+                create_table(conn, args.users)
+            conn.execution_options(isolation_level="AUTOCOMMIT").\
+                execute(text(f'VACUUM ANALYZE {SCHEMA}."Users"'))
+            print(f"Loaded {args.users} users in {time.perf_counter() - start:.1f}s")
+
+        conn.execute(text(f"SET search_path TO {SCHEMA}"))
+        with Session(bind=conn) as db:
+            print(f"{'search':<20}{'p50 ms':>10}{'p99 ms':>10}")
+            for mode, (search, terms) in searches(random.Random(args.seed),
+                                                  args.queries,
+                                                  args.users).items():
+                latencies = time_searches(db, search, terms)
+                print(f"{mode:<20}{percentile(latencies, 0.50):>10.2f}"
+                      f"{percentile(latencies, 0.99):>10.2f}")
+            db.rollback()
+
+        conn.execute(text("RESET search_path"))
+        if not args.keep:
+            with conn.begin():
+                conn.execute(text(f"DROP SCHEMA {SCHEMA} CASCADE"))
+
+
+if __name__ == "__main__":
+    main()